@@ -12,10 +12,32 @@ import os
 import pty
 import threading
 import uuid
+import shlex
 import select
+import mmap
+import codecs
+import collections
+import heapq
+import itertools
+import functools
+import contextlib
 import json
+import hmac
+import queue
+import contextvars
+import hashlib
+import struct
+import stat
+import zlib
+import bisect
+from array import array
+import sqlite3
+import sys
+import atexit
+import gzip
 import time
 import signal
+import resource
 import psutil
 import subprocess
 from datetime import datetime, timedelta
@@ -24,7 +46,7 @@ import telebot
 from telebot import types
 import traceback
 import logging
-from logging.handlers import RotatingFileHandler
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
 
 # ========== CONFIGURATION ==========
 BOT_TOKEN = os.environ.get("BOT_TOKEN", "YOUR_BOT_TOKEN_HERE")
@@ -32,28 +54,175 @@ MAIN_ADMIN_ID = int(os.environ.get("MAIN_ADMIN_ID", "0"))
 PORT = int(os.environ.get("PORT", 10000))
 BASE_DIR = os.getcwd()
 DATA_FILE = "bot_data.json"
+DB_FILE = "bot_data.db"
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "sqlite")  # "sqlite" or "json"
 USER_DATA_DIR = os.path.join(BASE_DIR, "user_data")
+HISTORY_DIR = os.path.join(BASE_DIR, "history")
+VERSIONS_DIR = os.path.join(BASE_DIR, "versions")  # prior file versions, one store per user outside their tree
 LOG_FILE = "bot.log"
 MAX_LOG_SIZE = 5 * 1024 * 1024  # 5MB
 BACKUP_COUNT = 3
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "text")  # "text" or "json" (one JSON object per line)
+LOG_QUEUE_SIZE = 10000  # records buffered for the log writer before new ones are dropped
+SAVE_INTERVAL = float(os.environ.get("SAVE_INTERVAL", "5"))  # max seconds a change waits before hitting disk
+SAVE_BATCH = 100  # changes that force an early write
+USER_STATS_LIMIT = 25  # users listed in the admin stats view
+HISTORY_MAX_ENTRIES = 5000  # compact a user's history log beyond this many records
+HISTORY_KEEP = 2000  # records kept by compaction
+HISTORY_PAGE = 10  # entries shown by /history
+OUTPUT_REFRESH_INTERVAL = float(os.environ.get("OUTPUT_REFRESH_INTERVAL", "1.5"))  # seconds between live edits
+OUTPUT_WINDOW = 3500  # chars per live output message before rolling over
+OUTBOX_GLOBAL_RATE = 30  # messages/second across all chats
+OUTBOX_CHAT_RATE = 1  # messages/second per chat
+OUTBOX_CHAT_BURST = 3
+MAX_MESSAGE_LENGTH = 4096
+SPILL_THRESHOLD = int(os.environ.get("SPILL_THRESHOLD", 16 * 1024))  # bytes of output before spilling to a file
+SPILL_COMPRESS = os.environ.get("SPILL_COMPRESS", "1") == "1"  # gzip spilled output on the fly
+SPILL_MAX_SIZE = 45 * 1024 * 1024  # stay below Telegram's 50MB upload limit
+SPILL_PREVIEW = 1000  # chars of tail shown inline after spilling
+RING_BUFFER_SIZE = 64 * 1024  # bytes of recent output kept per session
+RING_BUFFER_TOTAL = 16 * 1024 * 1024  # bytes kept across all sessions
+RING_BUFFER_GRACE = 30 * 60  # seconds a finished session's output stays available
+TAIL_PAGE_SIZE = 3000  # bytes per /tail page
+MAX_CONCURRENT_JOBS = int(os.environ.get("MAX_CONCURRENT_JOBS", 32))  # running commands across all users
+MAX_JOBS_PER_USER = int(os.environ.get("MAX_JOBS_PER_USER", 3))  # running commands per user
+# Kernel-enforced limits per user class; None means unlimited.
+# cpu: RLIMIT_CPU seconds, as: RLIMIT_AS bytes, nofile: RLIMIT_NOFILE,
+# memory_max/cpu_max/pids_max: cgroup v2 memory.max, cpu.max ("quota period") and pids.max.
+# nproc (RLIMIT_NPROC) is counted per UID across every session and the bot's own
+# threads, not per session, so it is off by default; pids_max caps a session instead.
+RESOURCE_PROFILES = {
+    'admin': {'cpu': None, 'as': None, 'nproc': None, 'nofile': None, 'memory_max': None, 'cpu_max': None, 'pids_max': None},
+    'user': {'cpu': 600, 'as': 2 * 1024**3, 'nproc': None, 'nofile': 1024, 'memory_max': 1024**3, 'cpu_max': "100000 100000",
+             'pids_max': 512},
+}
+RESOURCE_PROFILES.update(json.loads(os.environ.get("RESOURCE_PROFILES", "{}")))
+CGROUP_ROOT = os.environ.get("CGROUP_ROOT", "/sys/fs/cgroup/tharmux")  # delegated cgroup v2 subtree
+COMMAND_TIMEOUT = int(os.environ.get("COMMAND_TIMEOUT", 3600))  # default wall-clock limit in seconds, 0 = none
+TIMEOUT_KILL_GRACE = 5  # seconds between SIGTERM and SIGKILL when a command times out
+SAMPLE_INTERVAL = float(os.environ.get("SAMPLE_INTERVAL", "1"))  # seconds between system stats samples
+HISTORY_METRICS = ('cpu', 'memory', 'disk')
+METRICS_RESOLUTIONS = ((1, 3600), (60, 1440), (3600, 720))  # (seconds per point, points kept): 1h, 1d, 30d
+SPARKLINE_POINTS = 30  # one-minute points in the /status sparklines
+MAX_ALERTS = 50  # alerts kept for the admin panel
+# Alert rules over sampler metrics. "threshold" compares the sample, "rate" its change
+# per minute across `window` samples. A rule fires after `for` consecutive samples
+# above `above` and resolves after `for` consecutive samples below `clear`.
+ALERT_RULES = [
+    {'name': "high_cpu", 'metric': 'cpu', 'kind': 'threshold', 'above': 80, 'clear': 70, 'for': 30, 'message': "High CPU usage"},
+    {'name': "high_memory", 'metric': 'memory', 'kind': 'threshold', 'above': 80, 'clear': 75, 'for': 10, 'message': "High memory usage"},
+    {'name': "low_disk", 'metric': 'disk', 'kind': 'threshold', 'above': 90, 'clear': 88, 'for': 5, 'message': "Low disk space"},
+    {'name': "memory_climb", 'metric': 'memory', 'kind': 'rate', 'window': 30, 'above': 20, 'clear': 5, 'for': 3, 'message': "Memory usage climbing fast"},
+]
+ALERT_RULES = json.loads(os.environ["ALERT_RULES"]) if os.environ.get("ALERT_RULES") else ALERT_RULES
+ALERT_REPEAT_INTERVAL = 30 * 60  # seconds before the same alert is pushed to admins again
+ALERT_NOTIFY_RATE = 1 / 60  # admin notifications per second
+ALERT_NOTIFY_BURST = 5
+STREAM_BACKLOG = 30  # stats events kept for dashboard clients that fall behind
+STREAM_KEEPALIVE = 15  # seconds between SSE keepalive comments
+ADMIN_API_TOKEN = os.environ.get("ADMIN_API_TOKEN", "")  # bearer token for admin HTTP endpoints, unset = disabled
+PROFILE_RATE = int(os.environ.get("PROFILE_RATE", 100))  # profiler samples per second
+PROFILE_MAX_SECONDS = 60
+EDITOR_WINDOW_THRESHOLD = 1024 * 1024  # files larger than this open read-only in windowed mode
+EDITOR_WINDOW_LINES = 500  # lines per window in windowed mode
+EDITOR_LINE_STRIDE = 1000  # lines between cached line offsets in a file view
+EDITOR_CHUNK_SIZE = 64 * 1024  # bytes per chunk when streaming file content
+MAX_FILE_VIEWS = 16  # memory-mapped files kept open for the editor
+VERSION_MAX_PER_FILE = 50  # versions kept per file
+VERSION_MAX_BYTES = 20 * 1024 * 1024  # compressed delta bytes kept per user across all files
+VERSION_PAGE = 15  # versions listed by /versions
+PROCESS_SAMPLE_INTERVAL = float(os.environ.get("PROCESS_SAMPLE_INTERVAL", "5"))  # seconds between process table scans
+TOP_PROCESSES = 20  # processes kept per top-N list
+MAX_SESSION_ROWS = 30  # sessions listed by /sessions
+PERSISTENT_SHELL_DEFAULT = os.environ.get("PERSISTENT_SHELL", "0") == "1"  # keep one bash per user
 
 # Create directories
 os.makedirs(USER_DATA_DIR, exist_ok=True)
+os.makedirs(HISTORY_DIR, exist_ok=True)
+os.makedirs(VERSIONS_DIR, exist_ok=True)
 os.makedirs(os.path.join(BASE_DIR, "logs"), exist_ok=True)
 
 # ========== LOGGING SETUP ==========
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        RotatingFileHandler(
-            os.path.join(BASE_DIR, "logs", LOG_FILE),
-            maxBytes=MAX_LOG_SIZE,
-            backupCount=BACKUP_COUNT
-        ),
-        logging.StreamHandler()
-    ]
-)
+LOG_CONTEXT_FIELDS = ('user_id', 'chat_id', 'session_id')
+_log_context = contextvars.ContextVar('log_context', default={})
+
+@contextlib.contextmanager
+def log_context(**fields):
+    """Attach fields (see LOG_CONTEXT_FIELDS) to records logged inside the block"""
+    token = _log_context.set({**_log_context.get(), **fields})
+    try:
+        yield
+    finally:
+        _log_context.reset(token)
+
+class DroppingQueueHandler(QueueHandler):
+    """Hands records to the log writer thread; drops them when its queue is full.
+
+    Context fields are copied onto the record here, on the logging thread,
+    since the writer thread runs outside the caller's context.
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        for key, value in _log_context.get().items():
+            setattr(record, key, value)
+        return super().prepare(record)
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+class JsonLinesFormatter(logging.Formatter):
+    """Compact one-line JSON records"""
+
+    def format(self, record):
+        entry = {
+            'ts': round(record.created, 3),
+            'level': record.levelname,
+            'logger': record.name,
+            'thread': record.threadName,
+            'msg': record.getMessage(),
+        }
+        for key in LOG_CONTEXT_FIELDS:
+            value = getattr(record, key, None)
+            if value is not None:
+                entry[key] = value
+        return json.dumps(entry, ensure_ascii=False, separators=(',', ':'), default=str)
+
+class LogListener(QueueListener):
+    """QueueListener whose writer thread has a recognizable name"""
+
+    def start(self):
+        self._thread = threading.Thread(target=self._monitor, name="log-writer", daemon=True)
+        self._thread.start()
+
+    def enqueue_sentinel(self):
+        # Block rather than drop: the writer drains the queue before it stops
+        self.queue.put(self._sentinel)
+
+log_formatter = (JsonLinesFormatter() if LOG_FORMAT == "json"
+                 else logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+log_writers = [
+    RotatingFileHandler(
+        os.path.join(BASE_DIR, "logs", LOG_FILE),
+        maxBytes=MAX_LOG_SIZE,
+        backupCount=BACKUP_COUNT
+    ),
+    logging.StreamHandler()
+]
+for writer in log_writers:
+    writer.setFormatter(log_formatter)
+log_queue_handler = DroppingQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+logging.getLogger().setLevel(logging.INFO)
+logging.getLogger().addHandler(log_queue_handler)
+log_listener = LogListener(log_queue_handler.queue, *log_writers)
+log_listener.start()
+atexit.register(log_listener.stop)
 logger = logging.getLogger(__name__)
 
 print("🔧 Configuration loaded:")
@@ -73,9 +242,204 @@ input_wait = {}
 active_sessions = {}
 admins = set()
 user_stats = {}  # Track user usage stats
-system_alerts = []  # Store system alerts
-MAX_ALERTS = 50
+system_alerts = collections.deque(maxlen=MAX_ALERTS)  # Store system alerts
 authorized_users = set()  # All users who can use basic features
+persistent_shells = {}  # user_id -> PersistentShell
+session_resources = {}  # session_id -> resource limits applied to its process
+session_timers = {}  # session_id -> pending timeout timer
+session_outputs = collections.OrderedDict()  # session_id -> output history, LRU order
+tail_cursors = {}  # user_id -> (session_id, offset) of the last /tail page shown
+
+# ========== METRICS ==========
+metrics_registry = []
+
+class MetricShards:
+    """Per-thread cells for one instrument.
+
+    Each thread updates its own dict of label values -> cell list without
+    taking a lock; a scrape adds the shards up, folding those of finished
+    threads into a retired total so short-lived request threads don't pile up.
+    """
+
+    def __init__(self, width):
+        self.width = width
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.shards = []
+        self.retired = {}
+
+    def cell(self, labels):
+        try:
+            shard = self.local.shard
+        except AttributeError:
+            shard = self.local.shard = {}
+            with self.lock:
+                self.shards.append((threading.current_thread(), shard))
+        cell = shard.get(labels)
+        if cell is None:
+            cell = shard[labels] = [0] * self.width
+        return cell
+
+    def totals(self):
+        def merge(into, shard):
+            for labels, cell in list(shard.items()):
+                total = into.setdefault(labels, [0] * self.width)
+                for i, value in enumerate(list(cell)):
+                    total[i] += value
+
+        with self.lock:
+            alive = []
+            for thread, shard in self.shards:
+                if thread.is_alive():
+                    alive.append((thread, shard))
+                else:
+                    merge(self.retired, shard)
+            self.shards = alive
+            totals = {}
+            merge(totals, self.retired)
+            for _, shard in alive:
+                merge(totals, shard)
+        return totals
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_labels(names, values, extra=""):
+    pairs = [f'{name}="{escape_label(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+class Counter:
+    """Monotonic counter, optionally split by label values"""
+
+    def __init__(self, name, doc, labels=()):
+        self.name, self.doc, self.labels = name, doc, labels
+        self.shards = MetricShards(1)
+        metrics_registry.append(self)
+
+    def inc(self, *labels, amount=1):
+        self.shards.cell(labels)[0] += amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} counter"]
+        for labels, cell in sorted(self.shards.totals().items()):
+            lines.append(f"{self.name}{format_labels(self.labels, labels)} {cell[0]}")
+        return lines
+
+class Histogram:
+    """Bucketed distribution with sum and count, optionally split by label values"""
+
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, name, doc, labels=(), buckets=BUCKETS):
+        self.name, self.doc, self.labels, self.buckets = name, doc, labels, buckets
+        # One cell per bucket plus +Inf, then sum and count
+        self.shards = MetricShards(len(buckets) + 3)
+        metrics_registry.append(self)
+
+    def observe(self, value, *labels):
+        cell = self.shards.cell(labels)
+        cell[bisect.bisect_left(self.buckets, value)] += 1
+        cell[-2] += value
+        cell[-1] += 1
+
+    @contextlib.contextmanager
+    def time(self, *labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} histogram"]
+        for labels, cell in sorted(self.shards.totals().items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), cell):
+                cumulative += count
+                le = f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{format_labels(self.labels, labels, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(self.labels, labels)} {cell[-2]}")
+            lines.append(f"{self.name}_count{format_labels(self.labels, labels)} {cell[-1]}")
+        return lines
+
+class Gauge:
+    """Value computed at scrape time by collect(), a dict of label values -> number"""
+
+    def __init__(self, name, doc, labels, collect, kind="gauge"):
+        self.name, self.doc, self.labels, self.collect, self.kind = name, doc, labels, collect, kind
+        metrics_registry.append(self)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} {self.kind}"]
+        for labels, value in sorted(self.collect().items()):
+            lines.append(f"{self.name}{format_labels(self.labels, labels)} {value}")
+        return lines
+
+def timed(histogram, label):
+    """Decorator recording a function's run time in histogram under label(*args, **kwargs)"""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - started, label(*args, **kwargs))
+        return wrapper
+    return decorator
+
+def render_metrics():
+    """All instruments in the Prometheus text exposition format"""
+    lines = []
+    for metric in metrics_registry:
+        try:
+            lines.extend(metric.render())
+        except Exception as e:
+            logger.error(f"Error rendering metric {metric.name}: {e}")
+    return "\n".join(lines) + "\n"
+
+telegram_request_seconds = Histogram("tharmux_telegram_request_seconds", "Telegram API call latency.", ("method",))
+telegram_failures = Counter("tharmux_telegram_failures_total", "Telegram API calls that failed.", ("method",))
+telegram_rate_limited = Counter("tharmux_telegram_rate_limited_total", "Telegram API calls rejected with 429.")
+commands_started = Counter("tharmux_commands_started_total", "Commands started.")
+commands_finished = Counter("tharmux_commands_finished_total", "Commands finished, by outcome.", ("outcome",))
+command_seconds = Histogram(
+    "tharmux_command_duration_seconds", "Command wall-clock duration.",
+    buckets=(0.1, 0.5, 1, 5, 15, 60, 300, 900, 3600)
+)
+pty_read_bytes = Counter("tharmux_pty_read_bytes_total", "Bytes read from command PTYs.")
+save_seconds = Histogram("tharmux_save_duration_seconds", "Time to flush pending data to storage.")
+editor_seconds = Histogram("tharmux_editor_request_seconds", "Web editor load and save latency.", ("operation",))
+handler_seconds = Histogram("tharmux_handler_seconds", "Bot handler latency per command or callback.", ("handler",))
+Gauge(
+    "tharmux_active_sessions", "Running commands per user.", ("user",),
+    lambda: {(str(uid),): len(sessions) for uid, sessions in list(active_sessions.items()) if sessions}
+)
+Gauge(
+    "tharmux_log_records_dropped_total", "Log records dropped because the log queue was full.", (),
+    lambda: {(): log_queue_handler.dropped}, kind="counter"
+)
+
+def with_log_context(fn):
+    """Tag records logged by a bot handler with the chat and user it serves"""
+    @functools.wraps(fn)
+    def wrapper(update, *args, **kwargs):
+        message = getattr(update, 'message', None) or update
+        user = getattr(update, 'from_user', None)
+        with log_context(chat_id=message.chat.id, user_id=getattr(user, 'id', None)):
+            return fn(update, *args, **kwargs)
+    return wrapper
+
+def instrument_handlers():
+    """Wrap the registered bot handlers to record their latency and log context"""
+    for handler in bot.message_handlers:
+        commands = handler['filters'].get('commands')
+        name = f"/{commands[0]}" if commands else handler['function'].__name__
+        handler['function'] = with_log_context(timed(handler_seconds, lambda *args, name=name, **kwargs: name)(handler['function']))
+    for handler in bot.callback_query_handlers:
+        handler['function'] = with_log_context(timed(handler_seconds, lambda call: "callback:" + call.data.split('_', 1)[0])(handler['function']))
 
 # ========== HELPER FUNCTIONS ==========
 def get_user_directory(user_id):
@@ -108,6 +472,10 @@ def sanitize_path(user_id, path):
     
     return clean_path
 
+def markdown_code(text):
+    """Text safe inside a legacy-Markdown `code` span, which has no escapes: backticks become ˋ"""
+    return text.replace("`", "ˋ")
+
 def get_user_dict(user_id, dict_obj):
     """Get user-specific dictionary, create if not exists"""
     if user_id not in dict_obj:
@@ -119,56 +487,13 @@ def generate_session_id():
     return str(uuid.uuid4())
 
 def get_system_stats():
-    """Get system statistics with progress bars"""
-    try:
-        # CPU usage
-        cpu_percent = psutil.cpu_percent(interval=0.1)
-        cpu_bars = int(cpu_percent / 10)
-        cpu_bar = "▰" * cpu_bars + "▱" * (10 - cpu_bars)
-        
-        # Memory usage
-        memory = psutil.virtual_memory()
-        mem_percent = memory.percent
-        mem_bars = int(mem_percent / 10)
-        mem_bar = "▰" * mem_bars + "▱" * (10 - mem_bars)
-        
-        # Disk usage
-        disk = psutil.disk_usage('/')
-        disk_percent = disk.percent
-        disk_bars = int(disk_percent / 10)
-        disk_bar = "▰" * disk_bars + "▱" * (10 - disk_bars)
-        
-        # Additional stats
-        boot_time = datetime.fromtimestamp(psutil.boot_time())
-        uptime = datetime.now() - boot_time
-        uptime_str = str(uptime).split('.')[0]
-        
-        processes_count = len(psutil.pids())
-        
-        return {
-            'cpu': cpu_percent,
-            'cpu_bar': cpu_bar,
-            'memory': mem_percent,
-            'memory_bar': mem_bar,
-            'disk': disk_percent,
-            'disk_bar': disk_bar,
-            'uptime': uptime_str,
-            'processes': processes_count,
-            'boot_time': boot_time.strftime("%Y-%m-%d %H:%M:%S")
-        }
-    except Exception as e:
-        logger.error(f"Error getting system stats: {e}")
-        return {
-            'cpu': 0,
-            'cpu_bar': "▱" * 10,
-            'memory': 0,
-            'memory_bar': "▱" * 10,
-            'disk': 0,
-            'disk_bar': "▱" * 10,
-            'uptime': "N/A",
-            'processes': 0,
-            'boot_time': "N/A"
-        }
+    """Latest system statistics snapshot with progress bars"""
+    return system_sampler.latest()
+
+def usage_bar(percent):
+    """Ten-segment progress bar for a percentage"""
+    bars = max(0, min(10, int(percent / 10)))
+    return "▰" * bars + "▱" * (10 - bars)
 
 def add_system_alert(alert_type, message):
     """Add system alert"""
@@ -177,19 +502,549 @@ def add_system_alert(alert_type, message):
         'message': message,
         'time': datetime.now().strftime("%H:%M:%S")
     })
-    if len(system_alerts) > MAX_ALERTS:
-        system_alerts.pop(0)
+
+# ========== SYSTEM SAMPLER ==========
+class SystemSampler:
+    """Refreshes a system statistics snapshot on a background thread.
+
+    Readers get the latest snapshot without touching psutil, so HTTP and
+    bot handlers never sleep on cpu_percent or repeat the same syscalls.
+    CPU usage is measured between consecutive samples.
+    """
+
+    EMPTY = {
+        'cpu': 0,
+        'cpu_bar': "▱" * 10,
+        'cpu_count': 0,
+        'memory': 0,
+        'memory_bar': "▱" * 10,
+        'memory_total': 0,
+        'memory_used': 0,
+        'memory_available': 0,
+        'disk': 0,
+        'disk_bar': "▱" * 10,
+        'disk_total': 0,
+        'disk_used': 0,
+        'disk_free': 0,
+        'uptime': "N/A",
+        'processes': 0,
+        'boot_time': "N/A",
+        'timestamp': 0,
+    }
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.snapshot = dict(self.EMPTY)
+        self.listeners = []
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def subscribe(self, listener):
+        """Call listener(snapshot) on the sampler thread after every sample"""
+        self.listeners.append(listener)
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                psutil.cpu_percent(interval=None)
+                self.sample()
+                self.thread = threading.Thread(target=self._loop, name="sampler", daemon=True)
+                self.thread.start()
+
+    def latest(self):
+        if self.thread is None:
+            self.start()
+        return dict(self.snapshot)
+
+    def sample(self):
+        try:
+            cpu_percent = psutil.cpu_percent(interval=None)
+            memory = psutil.virtual_memory()
+            disk = psutil.disk_usage('/')
+            boot_time = datetime.fromtimestamp(psutil.boot_time())
+            uptime = datetime.now() - boot_time
+
+            self.snapshot = {
+                'cpu': cpu_percent,
+                'cpu_bar': usage_bar(cpu_percent),
+                'cpu_count': psutil.cpu_count(),
+                'memory': memory.percent,
+                'memory_bar': usage_bar(memory.percent),
+                'memory_total': memory.total,
+                'memory_used': memory.used,
+                'memory_available': memory.available,
+                'disk': disk.percent,
+                'disk_bar': usage_bar(disk.percent),
+                'disk_total': disk.total,
+                'disk_used': disk.used,
+                'disk_free': disk.free,
+                'uptime': str(uptime).split('.')[0],
+                'processes': len(psutil.pids()),
+                'boot_time': boot_time.strftime("%Y-%m-%d %H:%M:%S"),
+                'timestamp': time.time(),
+            }
+        except Exception as e:
+            logger.error(f"Error getting system stats: {e}")
+
+    def _loop(self):
+        while True:
+            time.sleep(self.interval)
+            self.sample()
+            snapshot = self.snapshot
+            for listener in self.listeners:
+                try:
+                    listener(snapshot)
+                except Exception as e:
+                    logger.error(f"Error in sampler listener: {e}")
+
+system_sampler = SystemSampler(SAMPLE_INTERVAL)
+
+# ========== METRICS HISTORY ==========
+class MetricSeries:
+    """Fixed-size ring of min/avg/max rollups for one metric at one resolution.
+
+    Slot i holds time bucket b where b % size == i; a slot whose stored
+    bucket differs from the one asked for is stale and skipped, so no
+    clearing pass is needed when samples stop for a while.
+    """
+
+    def __init__(self, step, size):
+        self.step = step
+        self.size = size
+        self.buckets = array('q', [-1]) * size
+        self.mins = array('d', [0.0]) * size
+        self.maxs = array('d', [0.0]) * size
+        self.sums = array('d', [0.0]) * size
+        self.counts = array('L', [0]) * size
+
+    def add(self, timestamp, value):
+        bucket = int(timestamp // self.step)
+        slot = bucket % self.size
+        if self.buckets[slot] != bucket:
+            self.buckets[slot] = bucket
+            self.mins[slot] = self.maxs[slot] = self.sums[slot] = value
+            self.counts[slot] = 1
+        else:
+            if value < self.mins[slot]:
+                self.mins[slot] = value
+            if value > self.maxs[slot]:
+                self.maxs[slot] = value
+            self.sums[slot] += value
+            self.counts[slot] += 1
+
+    def _slices(self, first, last):
+        """Slot ranges covering buckets first..last, in time order"""
+        start, end = first % self.size, last % self.size + 1
+        if start < end:
+            return [(start, end)]
+        return [(start, self.size), (0, end)]
+
+    def query(self, since, until):
+        """[timestamp, min, avg, max] points for buckets in [since, until]"""
+        last = int(until // self.step)
+        first = max(int(since // self.step), last - self.size + 1)
+        points = []
+        for start, end in self._slices(first, last):
+            buckets = self.buckets[start:end]
+            mins, maxs = self.mins[start:end], self.maxs[start:end]
+            sums, counts = self.sums[start:end], self.counts[start:end]
+            for bucket, low, high, total, count in zip(buckets, mins, maxs, sums, counts):
+                if first <= bucket <= last:
+                    points.append([bucket * self.step, low, total / count, high])
+        return points
+
+class MetricsHistory:
+    """Constant-memory time series of sampled metrics at several resolutions"""
+
+    def __init__(self, metrics, resolutions):
+        self.lock = threading.Lock()
+        self.series = {
+            metric: [MetricSeries(step, size) for step, size in resolutions]
+            for metric in metrics
+        }
+
+    def record(self, snapshot):
+        timestamp = snapshot['timestamp']
+        with self.lock:
+            for metric, series in self.series.items():
+                for ring in series:
+                    ring.add(timestamp, snapshot[metric])
+
+    def query(self, metric, seconds, step=None):
+        """Points covering the last seconds at the finest resolution that spans them,
+        or at the resolution of `step` seconds per point when given"""
+        series = self.series[metric]
+        ring = next((r for r in series if (r.step == step if step else r.step * r.size >= seconds)), series[-1])
+        now = time.time()
+        with self.lock:
+            return ring.step, ring.query(now - seconds, now)
+
+def parse_duration(text):
+    """Seconds in a duration such as 90, 15m, 6h or 7d"""
+    units = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+    text = text.strip().lower()
+    if text and text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(float(text))
+
+def sparkline(values):
+    """Unicode block sparkline scaled 0-100"""
+    blocks = "▁▂▃▄▅▆▇█"
+    return "".join(blocks[min(len(blocks) - 1, max(0, int(value / 100 * len(blocks))))] for value in values)
+
+metrics_history = MetricsHistory(HISTORY_METRICS, METRICS_RESOLUTIONS)
+system_sampler.subscribe(metrics_history.record)
+
+# ========== PROCESS TRACKER ==========
+class ProcessTracker:
+    """Keeps psutil.Process handles across samples for real CPU deltas.
+
+    Each pass drops handles of PIDs that went away, opens handles for new
+    ones (their first CPU reading is primed, not reported), and keeps the
+    TOP_PROCESSES busiest processes by CPU and by RSS. The same pass
+    totals each running session's process tree (its cgroup members when
+    it has one) into `sessions`.
+    """
+
+    def __init__(self, interval, top):
+        self.interval = interval
+        self.top = top
+        self.handles = {}
+        self.stats = {}
+        self.sessions = {}
+        self.snapshot = {'timestamp': 0, 'count': 0, 'cpu': [], 'rss': []}
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.sample()
+                self.thread = threading.Thread(target=self._loop, name="process-tracker", daemon=True)
+                self.thread.start()
+
+    def latest(self):
+        if self.thread is None:
+            self.start()
+        return self.snapshot
+
+    def sample(self):
+        try:
+            pids = set(psutil.pids())
+        except Exception as e:
+            logger.error(f"Error listing processes: {e}")
+            return
+        for pid in self.handles.keys() - pids:
+            del self.handles[pid]
+        fresh = pids - self.handles.keys()
+        for pid in fresh:
+            try:
+                proc = psutil.Process(pid)
+                proc.cpu_percent(None)
+                self.handles[pid] = proc
+            except psutil.Error:
+                pass
+
+        total_memory = system_sampler.snapshot['memory_total'] or psutil.virtual_memory().total
+        stats = {}
+        for pid, proc in list(self.handles.items()):
+            try:
+                with proc.oneshot():
+                    cpu = 0.0 if pid in fresh else proc.cpu_percent(None)
+                    rss = proc.memory_info().rss
+                    name = proc.name()
+                    ppid = proc.ppid()
+                    threads = proc.num_threads()
+            except psutil.NoSuchProcess:
+                del self.handles[pid]
+                continue
+            except psutil.Error:
+                continue
+            stats[pid] = {'pid': pid, 'ppid': ppid, 'name': name, 'cpu': cpu, 'rss': rss,
+                          'memory': rss * 100 / total_memory, 'threads': threads}
+
+        self.stats = stats
+        self.sessions = self._account_sessions(stats)
+        self.snapshot = {
+            'timestamp': time.time(),
+            'count': len(stats),
+            'cpu': heapq.nlargest(self.top, stats.values(), key=lambda info: info['cpu']),
+            'rss': heapq.nlargest(self.top, stats.values(), key=lambda info: info['rss']),
+        }
+
+    def _account_sessions(self, stats):
+        """Per-session totals of CPU%, RSS, I/O bytes and threads over the process tree"""
+        children = collections.defaultdict(list)
+        for info in stats.values():
+            children[info['ppid']].append(info['pid'])
+
+        sessions = {}
+        for user_id, proc_dict in list(processes.items()):
+            for session_id, entry in list(proc_dict.items()):
+                limits = session_resources.get(session_id)
+                pids = None
+                if limits and limits['cgroup']:
+                    try:
+                        pids = cgroup_pids(limits['cgroup'])
+                    except OSError:
+                        pass
+                if pids is None:
+                    pids, stack = [], [entry[0]]
+                    while stack:
+                        pid = stack.pop()
+                        pids.append(pid)
+                        stack.extend(children.get(pid, ()))
+
+                usage = {'user_id': user_id, 'cpu': 0.0, 'rss': 0, 'threads': 0,
+                         'read_bytes': 0, 'write_bytes': 0, 'processes': 0}
+                for pid in pids:
+                    info = stats.get(pid)
+                    if info is None:
+                        continue
+                    usage['cpu'] += info['cpu']
+                    usage['rss'] += info['rss']
+                    usage['threads'] += info['threads']
+                    usage['processes'] += 1
+                    try:
+                        io = self.handles[pid].io_counters()
+                        usage['read_bytes'] += io.read_bytes
+                        usage['write_bytes'] += io.write_bytes
+                    except (KeyError, AttributeError, psutil.Error):
+                        pass
+                sessions[session_id] = usage
+        return sessions
+
+    def _loop(self):
+        while True:
+            time.sleep(self.interval)
+            self.sample()
+
+SESSION_SORTS = {
+    'cpu': ("CPU", lambda row: row['usage'].get('cpu', 0)),
+    'mem': ("MEMORY", lambda row: row['usage'].get('rss', 0)),
+    'io': ("I/O", lambda row: row['usage'].get('read_bytes', 0) + row['usage'].get('write_bytes', 0)),
+    'age': ("AGE", lambda row: -row['started']),
+}
+
+def render_sessions(sort='cpu'):
+    """Text and sort buttons for the running sessions view, busiest first"""
+    rows = []
+    accounting = process_tracker.sessions
+    for user_id, sess_dict in list(active_sessions.items()):
+        proc_dict = processes.get(user_id, {})
+        for session_id, started in list(sess_dict.items()):
+            entry = proc_dict.get(session_id)
+            rows.append({
+                'user_id': user_id,
+                'session_id': session_id,
+                'started': started,
+                'cmd': entry[3] if entry else "",
+                'usage': accounting.get(session_id, {}),
+            })
+    title, key = SESSION_SORTS[sort]
+    rows.sort(key=key, reverse=True)
+
+    text = f"🔄 *ACTIVE SESSIONS* (by {title})\n\n"
+    if not rows:
+        text += "📭 No active sessions"
+    for row in rows[:MAX_SESSION_ROWS]:
+        limits = session_resources.get(row['session_id'])
+        cmd = row['cmd'] if len(row['cmd']) <= 40 else row['cmd'][:37] + "..."
+        text += f"• `{row['session_id'][:8]}` 👤 {row['user_id']}"
+        if limits:
+            text += f" [{limits['profile']}{', cgroup' if limits['cgroup'] else ''}]"
+        text += f" `{markdown_code(cmd)}`\n"
+        usage = row['usage']
+        elapsed = int(time.time() - row['started'])
+        if usage:
+            io = (usage['read_bytes'] + usage['write_bytes']) / 1024**2
+            text += (f"   CPU {usage['cpu']:.1f}% • MEM {usage['rss'] / 1024**2:.1f} MB • IO {io:.1f} MB"
+                     f" • {usage['processes']} proc/{usage['threads']} thr • {elapsed}s\n")
+        else:
+            text += f"   {elapsed}s, not sampled yet\n"
+    if len(rows) > MAX_SESSION_ROWS:
+        text += f"\n… and {len(rows) - MAX_SESSION_ROWS} more"
+
+    markup = types.InlineKeyboardMarkup(row_width=4)
+    markup.add(*[
+        types.InlineKeyboardButton(("• " if name == sort else "") + label, callback_data=f"sessions_{name}")
+        for name, (label, _) in SESSION_SORTS.items()
+    ])
+    return text, markup
+
+process_tracker = ProcessTracker(PROCESS_SAMPLE_INTERVAL, TOP_PROCESSES)
+
+# ========== STORAGE ==========
+class JsonStorage:
+    """Original storage: one JSON document rewritten on every flush"""
+
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return set(), {}, set()
+        with open(self.path, 'r') as f:
+            data = json.load(f)
+        return set(data.get('admins', [])), data.get('user_stats', {}), set(data.get('authorized_users', []))
+
+    def flush(self, users, roles, commands):
+        # The whole document is rewritten, deltas are not needed
+        # dict()/list() copies are atomic under the GIL, handlers may keep mutating
+        stats = {uid: dict(entry) for uid, entry in dict(user_stats).items()}
+        data = {
+            'admins': list(admins),
+            'user_stats': stats,
+            'authorized_users': list(authorized_users)
+        }
+        write_file_atomic(self.path, json.dumps(data, separators=(",", ":")).encode())
+
+    def recent_users(self, limit):
+        entries = sorted(dict(user_stats).values(), key=lambda e: e.get('last_seen', ''), reverse=True)
+        return entries[:limit], len(entries)
+
+class SqliteStorage:
+    """SQLite in WAL mode with one row per user, role and finished command.
+
+    Flushes apply only what changed since the last one, in a single
+    transaction, so the cost of a write is independent of the number of
+    users.
+    """
+
+    USER_FIELDS = ('user_id', 'username', 'commands', 'first_seen', 'last_seen')
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            commands INTEGER NOT NULL DEFAULT 0,
+            first_seen TEXT,
+            last_seen TEXT,
+            settings TEXT NOT NULL DEFAULT '{}'
+        );
+        CREATE INDEX IF NOT EXISTS idx_users_last_seen ON users(last_seen);
+        CREATE TABLE IF NOT EXISTS roles (
+            user_id INTEGER NOT NULL,
+            role TEXT NOT NULL,
+            PRIMARY KEY (user_id, role)
+        );
+        CREATE INDEX IF NOT EXISTS idx_roles_role ON roles(role);
+        CREATE TABLE IF NOT EXISTS commands (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            session_id TEXT,
+            command TEXT NOT NULL,
+            started REAL NOT NULL,
+            duration REAL,
+            exit_code INTEGER
+        );
+        CREATE INDEX IF NOT EXISTS idx_commands_user ON commands(user_id, started);
+    """
+    UPSERT_USER = """
+        INSERT INTO users (user_id, username, commands, first_seen, last_seen, settings)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT(user_id) DO UPDATE SET
+            username = excluded.username, commands = excluded.commands,
+            first_seen = excluded.first_seen, last_seen = excluded.last_seen,
+            settings = excluded.settings
+    """
+    INSERT_COMMAND = """
+        INSERT INTO commands (user_id, session_id, command, started, duration, exit_code)
+        VALUES (?, ?, ?, ?, ?, ?)
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(self.SCHEMA)
+
+    def load(self):
+        with self.lock:
+            empty = self.conn.execute("SELECT NOT EXISTS (SELECT 1 FROM users) AND NOT EXISTS (SELECT 1 FROM roles)").fetchone()[0]
+        if empty and os.path.exists(DATA_FILE):
+            self.migrate_json(DATA_FILE)
+
+        with self.lock:
+            rows = self.conn.execute("SELECT user_id, username, commands, first_seen, last_seen, settings FROM users").fetchall()
+            roles = self.conn.execute("SELECT user_id, role FROM roles").fetchall()
+        stats = {}
+        for user_id, username, commands, first_seen, last_seen, settings in rows:
+            entry = json.loads(settings or "{}")
+            entry.update(user_id=user_id, username=username, commands=commands, first_seen=first_seen)
+            if last_seen is not None:
+                entry['last_seen'] = last_seen
+            stats[str(user_id)] = entry
+        loaded_admins = {uid for uid, role in roles if role == 'admin'}
+        loaded_authorized = {uid for uid, role in roles if role == 'authorized'}
+        return loaded_admins, stats, loaded_authorized
+
+    def migrate_json(self, path):
+        """One-time import of an existing bot_data.json"""
+        loaded_admins, stats, loaded_authorized = JsonStorage(path).load()
+        roles = {(int(uid), 'admin') for uid in loaded_admins} | {(int(uid), 'authorized') for uid in loaded_authorized}
+        self.flush(stats, roles, [])
+        os.replace(path, f"{path}.migrated")
+        logger.info(f"Migrated {len(stats)} users from {path} to {self.path}")
+
+    def flush(self, users, roles, commands):
+        """Apply changed users, the full role set (if changed) and new command records"""
+        user_rows = []
+        for uid, entry in users.items():
+            settings = {k: v for k, v in entry.items() if k not in self.USER_FIELDS}
+            user_rows.append((int(uid), entry.get('username'), entry.get('commands', 0),
+                              entry.get('first_seen'), entry.get('last_seen'), json.dumps(settings)))
+        with self.lock:
+            self.conn.execute("BEGIN")
+            try:
+                if user_rows:
+                    self.conn.executemany(self.UPSERT_USER, user_rows)
+                if roles is not None:
+                    self.conn.execute("DELETE FROM roles")
+                    self.conn.executemany("INSERT INTO roles (user_id, role) VALUES (?, ?)", sorted(roles))
+                if commands:
+                    self.conn.executemany(self.INSERT_COMMAND, commands)
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+
+    def recent_users(self, limit):
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT user_id, username, commands, first_seen, last_seen FROM users ORDER BY last_seen DESC LIMIT ?",
+                (limit,)).fetchall()
+            total = self.conn.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+        return [dict(zip(self.USER_FIELDS, row)) for row in rows], total
+
+def write_file_atomic(path, payload):
+    """Replace path with payload via temp file + fsync + rename"""
+    tmp_file = f"{path}.tmp"
+    with open(tmp_file, 'wb') as f:
+        f.write(payload)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_file, path)
+    dir_fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+storage = None
+
+def get_storage():
+    global storage
+    if storage is None:
+        storage = SqliteStorage(DB_FILE) if STORAGE_BACKEND == "sqlite" else JsonStorage(DATA_FILE)
+    return storage
 
 def load_data():
-    """Load bot data from file"""
+    """Load bot data from storage"""
     global admins, user_stats, authorized_users
     try:
-        if os.path.exists(DATA_FILE):
-            with open(DATA_FILE, 'r') as f:
-                data = json.load(f)
-                admins = set(data.get('admins', []))
-                user_stats = data.get('user_stats', {})
-                authorized_users = set(data.get('authorized_users', []))
+        admins, user_stats, authorized_users = get_storage().load()
         admins.add(MAIN_ADMIN_ID)
         logger.info(f"Data loaded. Admins: {len(admins)}, Authorized users: {len(authorized_users)}")
     except Exception as e:
@@ -198,19 +1053,220 @@ def load_data():
         user_stats = {}
         authorized_users = set()
 
-def save_data():
-    """Save bot data to file"""
+_save_cond = threading.Condition()
+_save_lock = threading.Lock()
+_save_thread = None
+_dirty_count = 0
+_dirty_since = None
+_dirty_users = set()
+_roles_dirty = False
+_pending_commands = []
+
+def save_data(user_id=None):
+    """Mark bot data dirty; a background flusher writes it within SAVE_INTERVAL.
+
+    Pass user_id when only that user's stats changed; without it the
+    admin and authorized-user sets are written.
+    """
+    global _roles_dirty
+    with _save_cond:
+        if user_id is None:
+            _roles_dirty = True
+        else:
+            _dirty_users.add(str(user_id))
+        _mark_dirty()
+
+def record_command(user_id, session_id, cmd, started, duration, exit_code):
+    """Queue a finished command for the commands table and append it to history"""
+    commands_finished.inc("success" if exit_code == 0 else "unknown" if exit_code is None else "signal" if exit_code < 0 else "failure")
+    command_seconds.observe(duration)
     try:
-        data = {
-            'admins': list(admins),
-            'user_stats': user_stats,
-            'authorized_users': list(authorized_users)
-        }
-        with open(DATA_FILE, 'w') as f:
-            json.dump(data, f, indent=2)
-        logger.info("Data saved successfully")
+        command_history.append(user_id, cmd, started, duration, exit_code)
     except Exception as e:
-        logger.error(f"⚠️ Save data failed: {e}")
+        logger.error(f"Error appending command history: {e}")
+    with _save_cond:
+        _pending_commands.append((user_id, session_id, cmd, started, duration, exit_code))
+        _mark_dirty()
+
+def _mark_dirty():
+    global _dirty_count, _dirty_since, _save_thread
+    _dirty_count += 1
+    if _dirty_since is None:
+        _dirty_since = time.monotonic()
+    if _dirty_count >= SAVE_BATCH or _dirty_count == 1:
+        _save_cond.notify()
+    if _save_thread is None:
+        _save_thread = threading.Thread(target=_save_loop, name="data-flusher", daemon=True)
+        _save_thread.start()
+
+def _save_loop():
+    while True:
+        with _save_cond:
+            while not _dirty_count:
+                _save_cond.wait()
+            while _dirty_count < SAVE_BATCH:
+                remaining = _dirty_since + SAVE_INTERVAL - time.monotonic()
+                if remaining <= 0:
+                    break
+                _save_cond.wait(remaining)
+        flush_data()
+
+def flush_data():
+    """Write pending changes to storage now, in one batch"""
+    global _dirty_count, _dirty_since, _dirty_users, _roles_dirty, _pending_commands
+    with _save_lock:
+        with _save_cond:
+            dirty_users, roles_dirty, commands = _dirty_users, _roles_dirty, _pending_commands
+            _dirty_users, _roles_dirty, _pending_commands = set(), False, []
+            _dirty_count, _dirty_since = 0, None
+        if not (dirty_users or roles_dirty or commands):
+            return
+        try:
+            users = {uid: dict(user_stats[uid]) for uid in dirty_users if uid in user_stats}
+            roles = None
+            if roles_dirty:
+                roles = {(int(uid), 'admin') for uid in list(admins)} | {(int(uid), 'authorized') for uid in list(authorized_users)}
+            with save_seconds.time():
+                get_storage().flush(users, roles, commands)
+            logger.debug("Data saved successfully")
+        except Exception as e:
+            logger.error(f"⚠️ Save data failed: {e}")
+            # Keep the changes so the next flush retries them
+            with _save_cond:
+                _dirty_users |= dirty_users
+                _roles_dirty = _roles_dirty or roles_dirty
+                _pending_commands[:0] = commands
+                _mark_dirty()
+
+# ========== COMMAND HISTORY ==========
+class CommandHistory:
+    """Append-only, length-prefixed command log per user with an in-memory index.
+
+    Each record is a 4-byte length followed by a fixed header (sequence
+    number, timestamp, duration, exit code) and the UTF-8 command. The
+    index holds every record's sequence number and file offset, plus the
+    sorted distinct commands with the latest sequence of each, so recent
+    and prefix lookups only read the records they return. Logs are
+    compacted to the last HISTORY_KEEP records once they pass
+    HISTORY_MAX_ENTRIES.
+    """
+
+    LENGTH = struct.Struct("<I")
+    HEADER = struct.Struct("<Qddi")
+    NO_EXIT_CODE = -2**31
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.indexes = {}
+        self.lock = threading.Lock()
+
+    def _path(self, user_id):
+        return os.path.join(self.directory, f"{user_id}.log")
+
+    def _index(self, user_id):
+        index = self.indexes.get(user_id)
+        if index is None:
+            index = self.indexes[user_id] = self._load(user_id)
+        return index
+
+    def _load(self, user_id):
+        """Build the index with one pass over the log, dropping a torn tail"""
+        index = {'seqs': array('Q'), 'offsets': array('Q'), 'latest': {}, 'commands': [], 'size': 0, 'next_seq': 1}
+        path = self._path(user_id)
+        if not os.path.exists(path):
+            return index
+        with open(path, 'rb') as f:
+            data = f.read()
+        offset = 0
+        while offset + self.LENGTH.size <= len(data):
+            (length,) = self.LENGTH.unpack_from(data, offset)
+            end = offset + self.LENGTH.size + length
+            if length < self.HEADER.size or end > len(data):
+                break
+            seq = self.HEADER.unpack_from(data, offset + self.LENGTH.size)[0]
+            command = data[offset + self.LENGTH.size + self.HEADER.size:end].decode(errors="replace")
+            self._add(index, seq, offset, command)
+            offset = end
+        index['size'] = offset
+        if offset < len(data):
+            logger.warning(f"Truncating damaged history log {path} at byte {offset}")
+            with open(path, 'r+b') as f:
+                f.truncate(offset)
+        return index
+
+    def _add(self, index, seq, offset, command):
+        index['seqs'].append(seq)
+        index['offsets'].append(offset)
+        if command not in index['latest']:
+            bisect.insort(index['commands'], command)
+        index['latest'][command] = seq
+        index['next_seq'] = seq + 1
+
+    def append(self, user_id, command, started, duration, exit_code):
+        encoded = command.encode()
+        with self.lock:
+            index = self._index(user_id)
+            seq = index['next_seq']
+            header = self.HEADER.pack(seq, started, duration, self.NO_EXIT_CODE if exit_code is None else exit_code)
+            record = self.LENGTH.pack(len(header) + len(encoded)) + header + encoded
+            with open(self._path(user_id), 'ab') as f:
+                f.write(record)
+            self._add(index, seq, index['size'], command)
+            index['size'] += len(record)
+            if len(index['seqs']) > HISTORY_MAX_ENTRIES:
+                self._compact(user_id, index)
+
+    def _compact(self, user_id, index):
+        """Rewrite the log keeping only the newest HISTORY_KEEP records"""
+        path = self._path(user_id)
+        keep_from = index['offsets'][-HISTORY_KEEP]
+        with open(path, 'rb') as f:
+            f.seek(keep_from)
+            data = f.read()
+        write_file_atomic(path, data)
+        self.indexes[user_id] = self._load(user_id)
+
+    def _read(self, user_id, offset):
+        with open(self._path(user_id), 'rb') as f:
+            f.seek(offset)
+            (length,) = self.LENGTH.unpack(f.read(self.LENGTH.size))
+            payload = f.read(length)
+        seq, started, duration, exit_code = self.HEADER.unpack_from(payload)
+        return {
+            'seq': seq,
+            'started': started,
+            'duration': duration,
+            'exit_code': None if exit_code == self.NO_EXIT_CODE else exit_code,
+            'command': payload[self.HEADER.size:].decode(errors="replace"),
+        }
+
+    def get(self, user_id, seq):
+        """Record with sequence number seq, or None if compacted away"""
+        with self.lock:
+            index = self._index(user_id)
+            i = bisect.bisect_left(index['seqs'], seq)
+            if i == len(index['seqs']) or index['seqs'][i] != seq:
+                return None
+            return self._read(user_id, index['offsets'][i])
+
+    def search(self, user_id, prefix=None, limit=HISTORY_PAGE):
+        """Newest entries, or the latest run of each command starting with prefix"""
+        with self.lock:
+            index = self._index(user_id)
+            if prefix:
+                commands = index['commands']
+                i = bisect.bisect_left(commands, prefix)
+                seqs = []
+                while i < len(commands) and commands[i].startswith(prefix):
+                    seqs.append(index['latest'][commands[i]])
+                    i += 1
+                seqs = sorted(seqs, reverse=True)[:limit]
+                positions = [bisect.bisect_left(index['seqs'], seq) for seq in seqs]
+            else:
+                positions = range(len(index['seqs']) - 1, max(-1, len(index['seqs']) - 1 - limit), -1)
+            return [self._read(user_id, index['offsets'][i]) for i in positions]
+
+command_history = CommandHistory(HISTORY_DIR)
 
 def update_user_stats(user_id, username):
     """Update user statistics"""
@@ -225,81 +1281,1703 @@ def update_user_stats(user_id, username):
     user_stats[user_id_str]['commands'] += 1
     user_stats[user_id_str]['last_seen'] = datetime.now().isoformat()
     user_stats[user_id_str]['username'] = username
-    save_data()
+    save_data(user_id)
+
+# ========== OUTBOUND QUEUE ==========
+class TokenBucket:
+    """Token bucket refilled continuously at `rate` tokens per second"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.stamp = time.monotonic()
+
+    def wait_time(self, now):
+        """Seconds until a token is available (0 if one is available now)"""
+        self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        self.wait_time(now)
+        self.tokens -= 1
+
+class Outbox:
+    """Single dispatcher thread that every outgoing Telegram call goes through.
+
+    Each chat has an interactive lane (handler replies) and a bulk lane
+    (command output), served interactive-first and round-robin across
+    chats. Calls are paced by a global and a per-chat token bucket; a 429
+    blocks the chat for `retry_after` and the call is retried instead of
+    dropped. Plain text messages still waiting in a lane are merged.
+    """
+
+    INTERACTIVE, BULK = 0, 1
+    MAX_ATTEMPTS = 3
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.chats = {}
+        self.pending = {}  # chat_id -> None, ordered for round-robin
+        self.global_bucket = TokenBucket(OUTBOX_GLOBAL_RATE, OUTBOX_GLOBAL_RATE)
+        self.thread = None
+
+    def start(self):
+        with self.cond:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._loop, name="outbox", daemon=True)
+                self.thread.start()
+
+    def send(self, chat_id, text, bulk=False, **kwargs):
+        """Queue a text message, merging it into a queued one where possible"""
+        with self.cond:
+            lane = self._lane(chat_id, bulk)
+            last = lane[-1] if lane else None
+            if (last is not None and last['kind'] == 'text' and not last['started']
+                    and 'reply_markup' not in kwargs and 'reply_markup' not in last['kwargs']
+                    and last['kwargs'] == kwargs
+                    and len(last['text']) + 1 + len(text) <= MAX_MESSAGE_LENGTH):
+                last['text'] += "\n" + text
+            else:
+                lane.append(self._job('text', text=text, kwargs=kwargs))
+            self.cond.notify()
+        self.start()
+
+    def call(self, chat_id, fn, *args, bulk=False, **kwargs):
+        """Queue an arbitrary API call (documents, edits) for chat_id"""
+        with self.cond:
+            self._lane(chat_id, bulk).append(self._job('call', fn=fn, args=args, kwargs=kwargs))
+            self.cond.notify()
+        self.start()
+
+    def live(self, live):
+        """Queue a refresh of a LiveOutput unless one is already waiting"""
+        with self.cond:
+            job = live.queued
+            if job is not None:
+                # A refresh already in flight must look at the text again
+                job['again'] = job['started']
+                return
+            live.queued = self._job('live', live=live, again=False)
+            self._lane(live.chat_id, True).append(live.queued)
+            self.cond.notify()
+        self.start()
+
+    def _job(self, kind, **fields):
+        fields.update(kind=kind, started=False, attempts=0)
+        return fields
+
+    def _lane(self, chat_id, bulk):
+        state = self.chats.get(chat_id)
+        if state is None:
+            state = self.chats[chat_id] = {
+                'lanes': (collections.deque(), collections.deque()),
+                'bucket': TokenBucket(OUTBOX_CHAT_RATE, OUTBOX_CHAT_BURST),
+                'blocked_until': 0.0,
+            }
+        self.pending[chat_id] = None
+        return state['lanes'][self.BULK if bulk else self.INTERACTIVE]
+
+    def _pick(self, now):
+        """Choose the next (chat_id, lane) to serve, or the seconds to wait"""
+        wait = self.global_bucket.wait_time(now) or None
+        if wait:
+            return wait
+        choice = None
+        for chat_id in list(self.pending):
+            state = self.chats[chat_id]
+            interactive, bulk = state['lanes']
+            if not interactive and not bulk:
+                del self.pending[chat_id]
+                continue
+            delay = max(state['blocked_until'] - now, state['bucket'].wait_time(now))
+            if delay > 0:
+                wait = delay if wait is None else min(wait, delay)
+                continue
+            if interactive:
+                choice = (chat_id, interactive)
+                break
+            if choice is None:
+                choice = (chat_id, bulk)
+        if choice is None:
+            return wait
+        # Move the served chat to the back for round-robin fairness
+        del self.pending[choice[0]]
+        self.pending[choice[0]] = None
+        return choice
+
+    def _loop(self):
+        while True:
+            with self.cond:
+                while True:
+                    picked = self._pick(time.monotonic())
+                    if isinstance(picked, tuple):
+                        break
+                    self.cond.wait(picked)
+                chat_id, lane = picked
+                state = self.chats[chat_id]
+                job = lane[0]
+                job['started'] = True
+
+            done = self._run(chat_id, state, job)
+
+            with self.cond:
+                job['started'] = False
+                if done and job['kind'] == 'live' and job['again']:
+                    job['again'] = done = False
+                if done:
+                    lane.popleft()
+                    if job['kind'] == 'live':
+                        job['live'].queued = None
+
+    def _run(self, chat_id, state, job):
+        """Perform one API call for job; returns True once the job is finished"""
+        on_result = on_error = None
+        if job['kind'] == 'live':
+            call = job['live'].next_call()
+            if call is None:
+                return True
+            fn, args, kwargs, on_result, on_error = call
+        elif job['kind'] == 'text':
+            fn, args, kwargs = bot.send_message, (chat_id, job['text']), job['kwargs']
+        else:
+            fn, args, kwargs = job['fn'], job['args'], job['kwargs']
 
-def run_cmd(cmd, user_id, chat_id, session_id):
-    """Run command in isolated PTY for specific user"""
-    def task():
+        now = time.monotonic()
+        self.global_bucket.take(now)
+        state['bucket'].take(now)
+        method = getattr(fn, '__name__', 'call')
+        started = time.perf_counter()
         try:
-            proc_dict = get_user_dict(user_id, processes)
-            sess_dict = get_user_dict(user_id, active_sessions)
-            input_dict = get_user_dict(user_id, input_wait)
-            
-            user_dir = get_user_directory(user_id)
-            
-            pid, fd = pty.fork()
-            if pid == 0:
-                # Child process
-                os.chdir(user_dir)
-                # Use bash -c to execute the command
-                os.execvp("bash", ["bash", "-c", cmd])
+            result = fn(*args, **kwargs)
+        except telebot.apihelper.ApiTelegramException as e:
+            if e.error_code == 429:
+                telegram_rate_limited.inc()
+                retry_after = ((e.result_json or {}).get('parameters') or {}).get('retry_after', 1)
+                state['blocked_until'] = time.monotonic() + retry_after
+                logger.warning(f"Rate limited in chat {chat_id}, retrying in {retry_after}s")
+                return False
+            if "message is not modified" in str(e):
+                result = None
             else:
-                # Parent process
-                start_time = datetime.now().strftime("%H:%M:%S")
-                proc_dict[session_id] = (pid, fd, start_time, cmd)
-                sess_dict[session_id] = time.time()
+                telegram_failures.inc(method)
+                logger.error(f"Error sending message: {e}")
+                return self._failed(on_error)
+        except Exception as e:
+            telegram_failures.inc(method)
+            job['attempts'] += 1
+            if job['attempts'] >= self.MAX_ATTEMPTS:
+                logger.error(f"Error sending message, giving up: {e}")
+                job['attempts'] = 0
+                return self._failed(on_error)
+            state['blocked_until'] = time.monotonic() + job['attempts']
+            return False
+        finally:
+            telegram_request_seconds.observe(time.perf_counter() - started, method)
+
+        if on_result:
+            on_result(result)
+        # A live job stays queued until its message has caught up
+        return job['kind'] != 'live'
+
+    def _failed(self, on_error):
+        """Give up on a call; a live job stays queued to retry in its degraded form"""
+        if on_error is None:
+            return True
+        on_error()
+        return False
+
+outbox = Outbox()
+
+def send_message(chat_id, text, bulk=False, **kwargs):
+    """Queue a message for chat_id; bulk output yields to interactive replies"""
+    outbox.send(chat_id, text, bulk=bulk, **kwargs)
+
+# ========== ALERTS ==========
+class AlertRule:
+    """One alert rule, evaluated incrementally as samples arrive"""
+
+    def __init__(self, config):
+        self.name = config['name']
+        self.metric = config['metric']
+        self.kind = config.get('kind', 'threshold')
+        self.above = config['above']
+        self.clear = config.get('clear', config['above'])
+        self.needed = max(1, config.get('for', 1))
+        self.message = config.get('message', self.name)
+        self.window = collections.deque(maxlen=config.get('window', 10) + 1) if self.kind == 'rate' else None
+        self.firing = False
+        self.streak = 0
+        self.last_value = None
+
+    def value(self, snapshot):
+        value = snapshot[self.metric]
+        if self.window is None:
+            return value
+        self.window.append((snapshot['timestamp'], value))
+        (then, old), (now, _) = self.window[0], self.window[-1]
+        if len(self.window) < self.window.maxlen or now <= then:
+            return None
+        return (value - old) * 60 / (now - then)
+
+    def evaluate(self, snapshot):
+        """'fired' or 'resolved' when the rule changes state, else None"""
+        value = self.value(snapshot)
+        if value is None:
+            return None
+        self.last_value = value
+        crossed = value < self.clear if self.firing else value > self.above
+        self.streak = self.streak + 1 if crossed else 0
+        if self.streak < self.needed:
+            return None
+        self.firing = not self.firing
+        self.streak = 0
+        return 'fired' if self.firing else 'resolved'
+
+    def describe(self):
+        unit = "%/min" if self.kind == 'rate' else "%" if self.metric in HISTORY_METRICS else ""
+        return f"{self.message}: {self.metric} {self.last_value:.1f}{unit}"
+
+class AlertNotifier:
+    """Pushes alerts to admins, deduplicated per key and globally rate limited.
+
+    The same key and state is not pushed again within ALERT_REPEAT_INTERVAL;
+    notifications beyond the token bucket are dropped and counted in the
+    next one that goes out.
+    """
+
+    def __init__(self):
+        self.bucket = TokenBucket(ALERT_NOTIFY_RATE, ALERT_NOTIFY_BURST)
+        self.last_sent = {}
+        self.suppressed = 0
+        self.lock = threading.Lock()
+
+    def notify(self, key, text):
+        now = time.monotonic()
+        with self.lock:
+            last = self.last_sent.get(key)
+            if last is not None and now - last < ALERT_REPEAT_INTERVAL:
+                return
+            if self.bucket.wait_time(now) > 0:
+                self.suppressed += 1
+                return
+            self.bucket.take(now)
+            self.last_sent[key] = now
+            suppressed, self.suppressed = self.suppressed, 0
 
-                try:
-                    while True:
-                        rlist, _, _ = select.select([fd], [], [], 0.1)
-                        if fd in rlist:
-                            try:
-                                out = os.read(fd, 1024).decode(errors="ignore")
-                            except OSError:
-                                break
-
-                            if out:
-                                # Split long output into chunks
-                                for i in range(0, len(out), 3500):
-                                    chunk = out[i:i+3500]
-                                    try:
-                                        bot.send_message(chat_id, f"```\n{chunk}\n```", parse_mode="Markdown")
-                                    except Exception as e:
-                                        logger.error(f"Error sending message: {e}")
-
-                            if out.strip().endswith(":"):
-                                input_dict[session_id] = fd
-
-                        # Check if process is still alive
-                        try:
-                            os.kill(pid, 0)
-                        except OSError:
-                            break
+        if suppressed:
+            text += f"\n_(+{suppressed} more alerts suppressed)_"
+        for admin_id in {int(MAIN_ADMIN_ID)} | {int(uid) for uid in list(admins)}:
+            send_message(admin_id, text, parse_mode="Markdown")
 
-                        time.sleep(0.1)
-                except Exception as e:
-                    logger.error(f"Error in command execution: {e}")
-                finally:
-                    # Cleanup
-                    if session_id in proc_dict:
-                        del proc_dict[session_id]
-                    if session_id in input_dict:
-                        del input_dict[session_id]
-                    if session_id in sess_dict:
-                        del sess_dict[session_id]
-                    
+class AlertEngine:
+    """Evaluates ALERT_RULES on every sampler snapshot"""
+
+    def __init__(self, rules, notifier):
+        self.rules = [AlertRule(rule) for rule in rules]
+        self.notifier = notifier
+
+    def evaluate(self, snapshot):
+        for rule in self.rules:
+            try:
+                state = rule.evaluate(snapshot)
+            except (KeyError, TypeError) as e:
+                logger.error(f"Alert rule {rule.name} failed: {e}")
+                continue
+            if state == 'fired':
+                add_system_alert("WARNING", rule.describe())
+                self.notifier.notify((rule.name, state), f"⚠️ *ALERT* {rule.describe()}")
+            elif state == 'resolved':
+                add_system_alert("INFO", f"Resolved: {rule.describe()}")
+                self.notifier.notify((rule.name, state), f"✅ *RESOLVED* {rule.describe()}")
+
+alert_engine = AlertEngine(ALERT_RULES, AlertNotifier())
+system_sampler.subscribe(alert_engine.evaluate)
+
+# ========== DASHBOARD STREAM ==========
+class StatsStream:
+    """Fans sampler snapshots out to Server-Sent Events clients.
+
+    Each sample is reduced to the fields that changed and serialized once;
+    clients wait on a condition and write the events they have not seen,
+    or a full state event if they fell more than STREAM_BACKLOG behind.
+    """
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.state = {}
+        self.seq = 0
+        self.events = collections.deque(maxlen=STREAM_BACKLOG)
+
+    @staticmethod
+    def event(payload):
+        return f"data: {json.dumps(payload, separators=(',', ':'))}\n\n"
+
+    @staticmethod
+    def dashboard_state(snapshot):
+        return {
+            'cpu': round(snapshot['cpu'], 1),
+            'memory': round(snapshot['memory'], 1),
+            'disk': round(snapshot['disk'], 1),
+            'uptime': snapshot['uptime'],
+            'processes': snapshot['processes'],
+            'active_users': len(set(active_sessions.keys()) | set(processes.keys())),
+            'sessions': sum(len(sess) for sess in list(active_sessions.values())),
+        }
+
+    def publish(self, snapshot):
+        state = self.dashboard_state(snapshot)
+        changes = {key: value for key, value in state.items() if self.state.get(key) != value}
+        if not changes:
+            return
+        message = self.event(changes)
+        with self.cond:
+            self.state = state
+            self.seq += 1
+            self.events.append((self.seq, message))
+            self.cond.notify_all()
+
+    def stream(self):
+        """Generator of SSE messages for one client"""
+        with self.cond:
+            seq, state = self.seq, self.state
+        yield "retry: 5000\n" + self.event(state or self.dashboard_state(get_system_stats()))
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: self.seq != seq, timeout=STREAM_KEEPALIVE)
+                if self.seq == seq:
+                    pending = ": keepalive\n\n"
+                elif self.seq - seq > len(self.events):
+                    pending = self.event(self.state)
+                else:
+                    pending = "".join(message for event_seq, message in self.events if event_seq > seq)
+                seq = self.seq
+            yield pending
+
+stats_stream = StatsStream()
+system_sampler.subscribe(stats_stream.publish)
+
+# ========== LIVE OUTPUT ==========
+class LiveOutput:
+    """Stream command output into one Telegram message that is edited in place.
+
+    Output is buffered and a refresh is queued on the outbox at most once
+    per OUTPUT_REFRESH_INTERVAL; the outbox renders the latest text when it
+    gets to it. When the message reaches OUTPUT_WINDOW chars it is frozen
+    and the stream rolls over to a fresh message. A window Telegram keeps
+    rejecting is re-sent as a new message, then as plain text, and is
+    finally skipped so later output still gets through.
+    """
+
+    def __init__(self, chat_id):
+        self.chat_id = chat_id
+        self.message_id = None
+        self.text = ""
+        self.shown = ""
+        self.plain = False
+        self.dirty = False
+        self.queued = None
+        self.last_flush = 0.0
+        self.lock = threading.Lock()
+
+    def feed(self, out):
+        """Append output; the message is updated on the next due tick"""
+        with self.lock:
+            self.text += out
+            self.dirty = True
+
+    def due_in(self):
+        """Seconds until the next refresh, flushing now if one is due"""
+        if not self.dirty:
+            return None
+        remaining = self.last_flush + OUTPUT_REFRESH_INTERVAL - time.time()
+        if remaining <= 0:
+            self.flush()
+            return None
+        return remaining
+
+    def close(self):
+        """Flush whatever is left once the command has finished"""
+        self.flush()
+
+    def flush(self):
+        self.dirty = False
+        self.last_flush = time.time()
+        outbox.live(self)
+
+    def next_call(self):
+        """Next API call that brings the message up to date, or None"""
+        with self.lock:
+            window = self.text[:OUTPUT_WINDOW]
+            # Freeze full windows that are already on screen and roll over
+            while len(self.text) > OUTPUT_WINDOW and (window == self.shown or not window.strip()):
+                self._roll_over(OUTPUT_WINDOW)
+                window = self.text[:OUTPUT_WINDOW]
+
+            if window == self.shown or not window.strip():
+                return None
+
+            if self.plain:
+                body, kwargs = window, {}
+            else:
+                escaped = window.replace("\\", "\\\\").replace("`", "\\`")
+                body, kwargs = f"```\n{escaped}\n```", {'parse_mode': "MarkdownV2"}
+            on_error = lambda: self._failed(window)
+            if self.message_id is None:
+                return (bot.send_message, (self.chat_id, body), kwargs,
+                        lambda msg: self._shown(window, msg), on_error)
+            return (bot.edit_message_text, (body, self.chat_id, self.message_id), kwargs,
+                    lambda msg: self._shown(window, None), on_error)
+
+    def _roll_over(self, length):
+        self.text = self.text[length:]
+        self.message_id = None
+        self.shown = ""
+        self.plain = False
+
+    def _shown(self, window, msg):
+        with self.lock:
+            self.shown = window
+            if msg is not None:
+                self.message_id = msg.message_id
+
+    def _failed(self, window):
+        """Degrade after Telegram rejected window: new message, then plain text, then skip it"""
+        with self.lock:
+            if self.message_id is not None:
+                # The message may have been deleted; carry on in a fresh one
+                self.message_id = None
+                self.shown = ""
+            elif not self.plain:
+                self.plain = True
+            else:
+                logger.error(f"Dropping {len(window)} chars of live output for chat {self.chat_id}")
+                self._roll_over(len(window))
+
+# ========== OUTPUT SPILLOVER ==========
+class OutputSpill:
+    """Divert a session's output to a file once it passes SPILL_THRESHOLD bytes.
+
+    The file lands in the user's directory (gzip-compressed when
+    SPILL_COMPRESS is set) and holds the complete output. When the command
+    ends it is sent as one document with the tail shown inline.
+    """
+
+    def __init__(self, user_id, session_id):
+        self.user_id = user_id
+        self.session_id = session_id
+        self.head = bytearray()
+        self.tail = b""
+        self.file = None
+        self.path = None
+        self.size = 0
+        self.written = 0
+
+    @property
+    def active(self):
+        return self.path is not None
+
+    def add(self, data):
+        """Account for data; returns True once output is going to the file"""
+        self.size += len(data)
+        if not self.active:
+            self.head += data
+            if len(self.head) <= SPILL_THRESHOLD:
+                return False
+            data, self.head = bytes(self.head), None
+            self._open()
+
+        self.tail = (self.tail + data)[-SPILL_PREVIEW:]
+        if self.file is not None and self.written < SPILL_MAX_SIZE:
+            data = data[:SPILL_MAX_SIZE - self.written]
+            try:
+                self.file.write(data)
+                self.written += len(data)
+            except OSError as e:
+                logger.error(f"Error writing spill file {self.path}: {e}")
+                self._close()
+        return True
+
+    def _open(self):
+        name = f"output_{self.session_id[:8]}.log"
+        if SPILL_COMPRESS:
+            name += ".gz"
+        self.path = os.path.join(get_user_directory(self.user_id), name)
+        try:
+            self.file = gzip.open(self.path, "wb", compresslevel=6) if SPILL_COMPRESS else open(self.path, "wb")
+        except OSError as e:
+            logger.error(f"Error creating spill file {self.path}: {e}")
+            self.file = None
+
+    def _close(self):
+        if self.file is not None:
+            try:
+                self.file.close()
+            except OSError:
+                pass
+            self.file = None
+
+    def finish(self, chat_id):
+        """Close the file and queue the tail preview and the document"""
+        if not self.active:
+            return
+        self._close()
+        tail = self.tail.decode(errors="ignore")
+        if tail.strip():
+            send_message(chat_id, f"```\n…{tail}\n```", bulk=True, parse_mode="Markdown")
+
+        caption = f"📦 Full output: {self.size} bytes"
+        if self.size > self.written:
+            caption += f" (truncated to {self.written} bytes)"
+        outbox.call(chat_id, send_file, chat_id, self.path, caption=caption, bulk=True)
+
+def send_file(chat_id, path, caption=None):
+    """Upload a file from disk as a document"""
+    with open(path, "rb") as f:
+        return bot.send_document(chat_id, f, caption=caption)
+
+class CommandOutput:
+    """Route one command's output to its live message or spill file"""
+
+    def __init__(self, user_id, chat_id, session_id, fd):
+        self.user_id = user_id
+        self.chat_id = chat_id
+        self.session_id = session_id
+        self.fd = fd
+        self.live = LiveOutput(chat_id)
+        self.spill = OutputSpill(user_id, session_id)
+
+    def feed(self, out):
+        record_output(self.session_id, out.encode())
+        was_spilling = self.spill.active
+        if self.spill.add(out.encode()):
+            if not was_spilling:
+                self.live.feed(f"\n… output exceeds {SPILL_THRESHOLD} bytes, continuing in {os.path.basename(self.spill.path)}")
+        elif out:
+            self.live.feed(out)
+
+        if out.strip().endswith(":"):
+            get_user_dict(self.user_id, input_wait)[self.session_id] = self.fd
+            # Prompts must be visible before the user can answer
+            self.live.flush()
+
+    def due_in(self):
+        return self.live.due_in()
+
+    def close(self):
+        self.live.close()
+        self.spill.finish(self.chat_id)
+
+# ========== OUTPUT HISTORY ==========
+class OutputRing:
+    """Fixed-capacity byte ring holding a session's most recent output.
+
+    Offsets are absolute byte positions in the session's output stream;
+    only the last `capacity` bytes can be read back. The buffer grows on
+    demand up to its capacity, so short commands stay small.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.buf = bytearray()
+        self.end = 0
+
+    @property
+    def start(self):
+        return max(0, self.end - self.capacity)
+
+    @property
+    def allocated(self):
+        return len(self.buf)
+
+    def write(self, data):
+        if len(self.buf) < self.capacity:
+            if self.end + len(data) <= self.capacity:
+                self.buf += data
+                self.end += len(data)
+                return
+            # Switch to ring mode: from here on byte n lives at n % capacity
+            self.buf.extend(bytes(self.capacity - len(self.buf)))
+        if len(data) > self.capacity:
+            self.end += len(data) - self.capacity
+            data = data[-self.capacity:]
+        pos = self.end % self.capacity
+        first = min(len(data), self.capacity - pos)
+        self.buf[pos:pos + first] = data[:first]
+        self.buf[:len(data) - first] = data[first:]
+        self.end += len(data)
+
+    def read(self, offset, length):
+        """Bytes from absolute offset, clamped to what is still buffered"""
+        offset = max(offset, self.start)
+        length = max(0, min(length, self.end - offset))
+        if len(self.buf) < self.capacity:
+            return bytes(self.buf[offset:offset + length])
+        pos = offset % self.capacity
+        first = min(length, self.capacity - pos)
+        return bytes(self.buf[pos:pos + first] + self.buf[:length - first])
+
+output_history_lock = threading.Lock()
+
+def open_output_history(user_id, session_id, cmd):
+    """Start keeping recent output for a session"""
+    with output_history_lock:
+        session_outputs[session_id] = {
+            'user_id': user_id,
+            'cmd': cmd,
+            'ring': OutputRing(RING_BUFFER_SIZE),
+            'finished': None,
+        }
+        _prune_output_history()
+
+def record_output(session_id, data):
+    with output_history_lock:
+        entry = session_outputs.get(session_id)
+        if entry is None:
+            return
+        before = entry['ring'].allocated
+        entry['ring'].write(data)
+        if entry['ring'].allocated != before:
+            _prune_output_history()
+
+def close_output_history(session_id):
+    """Mark a session finished; its output is kept for RING_BUFFER_GRACE"""
+    with output_history_lock:
+        entry = session_outputs.get(session_id)
+        if entry is not None and entry['finished'] is None:
+            entry['finished'] = time.time()
+
+def _prune_output_history():
+    """Expire finished sessions and evict LRU finished ones over budget"""
+    now = time.time()
+    total = 0
+    for session_id, entry in list(session_outputs.items()):
+        if entry['finished'] is not None and now - entry['finished'] > RING_BUFFER_GRACE:
+            del session_outputs[session_id]
+        else:
+            total += entry['ring'].allocated
+    for session_id, entry in list(session_outputs.items()):
+        if total <= RING_BUFFER_TOTAL:
+            break
+        if entry['finished'] is not None:
+            total -= entry['ring'].allocated
+            del session_outputs[session_id]
+
+def find_output_history(user_id, prefix=None):
+    """Most recent session of user_id matching prefix (admins see all)"""
+    with output_history_lock:
+        for session_id in reversed(session_outputs):
+            entry = session_outputs[session_id]
+            if entry['user_id'] != user_id and not (prefix and is_admin(user_id)):
+                continue
+            if prefix and not session_id.startswith(prefix):
+                continue
+            session_outputs.move_to_end(session_id)
+            return session_id, entry
+    return None, None
+
+def render_output_page(session_id, entry, offset=None):
+    """Text and paging keyboard for one page of a session's output"""
+    ring = entry['ring']
+    with output_history_lock:
+        if offset is None:
+            offset = max(ring.start, ring.end - TAIL_PAGE_SIZE)
+        offset = min(max(offset, ring.start), max(ring.start, ring.end - 1))
+        chunk = ring.read(offset, TAIL_PAGE_SIZE).decode(errors="ignore")
+        start, end = ring.start, ring.end
+
+    state = "running" if entry['finished'] is None else "finished"
+    text = (f"📜 `{session_id[:8]}` ({state}) bytes {offset}-{offset + len(chunk.encode())} of {end}\n"
+            f"```\n{chunk if chunk.strip() else '(no output)'}\n```")
+
+    markup = types.InlineKeyboardMarkup(row_width=2)
+    buttons = []
+    if offset > start:
+        buttons.append(types.InlineKeyboardButton("⬅️ Older", callback_data=f"tail_{session_id[:8]}_{max(start, offset - TAIL_PAGE_SIZE)}"))
+    if offset + TAIL_PAGE_SIZE < end:
+        buttons.append(types.InlineKeyboardButton("Newer ➡️", callback_data=f"tail_{session_id[:8]}_{offset + TAIL_PAGE_SIZE}"))
+    if buttons:
+        markup.add(*buttons)
+    return text, offset, markup
+
+# ========== RESOURCE LIMITS ==========
+RLIMITS = {
+    'cpu': resource.RLIMIT_CPU,
+    'as': resource.RLIMIT_AS,
+    'nproc': resource.RLIMIT_NPROC,
+    'nofile': resource.RLIMIT_NOFILE,
+}
+_cgroup_root = None  # None = not probed yet, "" = unavailable
+
+def cgroup_root():
+    """Delegated cgroup v2 directory for per-session cgroups, or None"""
+    global _cgroup_root
+    if _cgroup_root is None:
+        try:
+            if not os.path.exists("/sys/fs/cgroup/cgroup.controllers"):
+                raise OSError("cgroup v2 is not mounted")
+            os.makedirs(CGROUP_ROOT, exist_ok=True)
+            with open(os.path.join(CGROUP_ROOT, "cgroup.subtree_control"), "w") as f:
+                f.write("+memory +cpu")
+            try:
+                with open(os.path.join(CGROUP_ROOT, "cgroup.subtree_control"), "w") as f:
+                    f.write("+pids")
+            except OSError as e:
+                logger.info(f"cgroup pids controller unavailable, pids_max not enforced: {e}")
+            _cgroup_root = CGROUP_ROOT
+        except OSError as e:
+            logger.info(f"cgroup v2 limits unavailable, using rlimits only: {e}")
+            _cgroup_root = ""
+    return _cgroup_root or None
+
+def prepare_resource_limits(user_id, session_id):
+    """Pick the user's profile and create its cgroup; runs in the parent"""
+    name = 'admin' if is_admin(user_id) else 'user'
+    profile = RESOURCE_PROFILES.get(name, {})
+    limits = {'profile': name, 'values': profile, 'cgroup': None}
+
+    root = cgroup_root()
+    if root and (profile.get('memory_max') or profile.get('cpu_max') or profile.get('pids_max')):
+        path = os.path.join(root, f"s-{session_id[:8]}")
+        try:
+            os.makedirs(path, exist_ok=True)
+            if profile.get('memory_max'):
+                with open(os.path.join(path, "memory.max"), "w") as f:
+                    f.write(str(profile['memory_max']))
+            if profile.get('cpu_max'):
+                with open(os.path.join(path, "cpu.max"), "w") as f:
+                    f.write(str(profile['cpu_max']))
+            if profile.get('pids_max') and os.path.exists(os.path.join(path, "pids.max")):
+                with open(os.path.join(path, "pids.max"), "w") as f:
+                    f.write(str(profile['pids_max']))
+            limits['cgroup'] = path
+        except OSError as e:
+            logger.error(f"Error creating cgroup {path}: {e}")
+    return limits
+
+def apply_resource_limits(limits):
+    """Join the session cgroup and set rlimits; runs in the child before exec"""
+    if limits['cgroup']:
+        try:
+            with open(os.path.join(limits['cgroup'], "cgroup.procs"), "w") as f:
+                f.write("0")
+        except OSError:
+            pass  # rlimits below still apply
+    for key, kind in RLIMITS.items():
+        value = limits['values'].get(key)
+        if value is None:
+            continue
+        _, hard = resource.getrlimit(kind)
+        if hard != resource.RLIM_INFINITY:
+            value = min(value, hard)
+        # CPU gets a grace second between SIGXCPU and SIGKILL
+        soft_hard = (value, value + 1 if key == 'cpu' and hard == resource.RLIM_INFINITY else value)
+        try:
+            resource.setrlimit(kind, soft_hard)
+        except (ValueError, OSError) as e:
+            raise OSError(f"cannot set the {key} limit to {value}: {e}") from e
+
+def release_resource_limits(limits):
+    """Kill stragglers left in the session cgroup and remove it"""
+    path = limits and limits['cgroup']
+    if not path:
+        return
+    try:
+        with open(os.path.join(path, "cgroup.kill"), "w") as f:
+            f.write("1")
+    except OSError:
+        pass
+    try:
+        os.rmdir(path)
+    except OSError as e:
+        logger.warning(f"Could not remove cgroup {path}: {e}")
+
+def cgroup_pids(path):
+    """PIDs currently in a session cgroup"""
+    with open(os.path.join(path, "cgroup.procs")) as f:
+        return [int(line) for line in f if line.strip()]
+
+# ========== TIMERS ==========
+class TimerHeap:
+    """One thread firing callbacks at deadlines kept in a min-heap.
+
+    Scheduling and cancelling are O(log n); cancelled entries are skipped
+    lazily and the heap is compacted once they make up half of it.
+    """
+
+    def __init__(self):
+        self.heap = []
+        self.cancelled = 0
+        self.counter = itertools.count()
+        self.cond = threading.Condition()
+        self.thread = None
+
+    def schedule(self, delay, fn, *args):
+        """Run fn(*args) after delay seconds; returns a handle for cancel()"""
+        entry = [time.monotonic() + delay, next(self.counter), fn, args, False]
+        with self.cond:
+            heapq.heappush(self.heap, entry)
+            if self.heap[0] is entry:
+                self.cond.notify()
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._loop, name="timers", daemon=True)
+                self.thread.start()
+        return entry
+
+    def cancel(self, entry):
+        with self.cond:
+            if entry[4]:
+                return
+            entry[4] = True
+            self.cancelled += 1
+            if self.cancelled > len(self.heap) // 2:
+                self.heap = [e for e in self.heap if not e[4]]
+                heapq.heapify(self.heap)
+                self.cancelled = 0
+
+    def _loop(self):
+        while True:
+            with self.cond:
+                while True:
+                    while self.heap and self.heap[0][4]:
+                        heapq.heappop(self.heap)
+                        self.cancelled -= 1
+                    if not self.heap:
+                        self.cond.wait()
+                        continue
+                    delay = self.heap[0][0] - time.monotonic()
+                    if delay <= 0:
+                        break
+                    self.cond.wait(delay)
+                entry = heapq.heappop(self.heap)
+                entry[4] = True
+            try:
+                entry[2](*entry[3])
+            except Exception as e:
+                logger.error(f"Timer callback error: {e}")
+
+timers = TimerHeap()
+
+def effective_timeout(user_id, timeout=None):
+    """Explicit timeout, else the user's default, else COMMAND_TIMEOUT"""
+    if timeout is None:
+        timeout = user_stats.get(str(user_id), {}).get('timeout', COMMAND_TIMEOUT)
+    return timeout or None
+
+def arm_timeout(user_id, chat_id, session_id, timeout):
+    """Start the wall-clock timer for a session that just started"""
+    if timeout:
+        session_timers[session_id] = timers.schedule(timeout, _timeout_fired, user_id, chat_id, session_id, timeout, signal.SIGTERM)
+
+def disarm_timeout(session_id):
+    entry = session_timers.pop(session_id, None)
+    if entry is not None:
+        timers.cancel(entry)
+
+def signal_session(user_id, session_id, sig):
+    """Signal the process groups of a running session; False if it is gone"""
+    proc = processes.get(user_id, {}).get(session_id)
+    if proc is None:
+        return False
+    pid, fd = proc[0], proc[1]
+    groups = {pid}
+    try:
+        foreground = os.tcgetpgrp(fd)
+        if foreground > 0:
+            groups.add(foreground)
+    except OSError:
+        pass
+    if pid in persistent_pids():
+        # Only the running command, never the persistent shell itself
+        groups.discard(pid)
+    for pgid in groups:
+        try:
+            os.killpg(pgid, sig)
+        except OSError:
+            pass
+    return True
+
+def persistent_pids():
+    return {shell_session.pid for shell_session in list(persistent_shells.values())}
+
+def _timeout_fired(user_id, chat_id, session_id, timeout, sig):
+    with log_context(user_id=user_id, chat_id=chat_id, session_id=session_id):
+        _expire_session(user_id, chat_id, session_id, timeout, sig)
+
+def _expire_session(user_id, chat_id, session_id, timeout, sig):
+    if not signal_session(user_id, session_id, sig):
+        session_timers.pop(session_id, None)
+        return
+    if sig == signal.SIGTERM:
+        send_message(chat_id, f"⏰ Command `{session_id[:8]}` timed out after {timeout}s, terminating.", parse_mode="Markdown")
+        session_timers[session_id] = timers.schedule(TIMEOUT_KILL_GRACE, _timeout_fired, user_id, chat_id, session_id, timeout, signal.SIGKILL)
+    else:
+        session_timers.pop(session_id, None)
+        add_system_alert("WARNING", f"Killed session {session_id[:8]} of user {user_id} after {timeout}s timeout")
+
+# ========== PTY REACTOR ==========
+class PtyReactor:
+    """Single thread that multiplexes every PTY master fd through epoll.
+
+    Handlers are registered per fd with a data callback, a close callback
+    (EOF/HUP) and an optional tick callback that returns the seconds until
+    it next wants to run, or None when idle. With nothing pending the
+    thread blocks in epoll without waking up.
+    """
+
+    READ_SIZE = 4096
+
+    def __init__(self):
+        self.epoll = select.epoll()
+        self.handlers = {}
+        self.lock = threading.Lock()
+        self.thread = None
+        self.wake_r, self.wake_w = os.pipe()
+        os.set_blocking(self.wake_r, False)
+        os.set_blocking(self.wake_w, False)
+        self.epoll.register(self.wake_r, select.EPOLLIN)
+        self.wake_handlers = []
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._loop, name="pty-reactor", daemon=True)
+                self.thread.start()
+
+    def register(self, fd, on_data, on_close, on_tick=None):
+        """Watch fd; with on_data=None, on_close fires once fd is readable"""
+        if on_data is not None:
+            os.set_blocking(fd, False)
+        with self.lock:
+            self.handlers[fd] = (on_data, on_close, on_tick)
+        self.epoll.register(fd, select.EPOLLIN | select.EPOLLHUP | select.EPOLLERR)
+        self.start()
+        self.wakeup()
+
+    def wakeup(self):
+        """Interrupt epoll so timeouts are recomputed"""
+        try:
+            os.write(self.wake_w, b"\0")
+        except OSError:
+            pass
+
+    def close(self, fd, on_close=None):
+        """Drain whatever is still buffered on fd, then run its close handler.
+
+        With on_close given, nothing happens unless fd is still registered
+        with that handler: once closed, the fd number may belong to someone else.
+        """
+        if on_close is not None and not self._owned(fd, on_close):
+            return
+        while self._read(fd):
+            pass
+        self._close(fd, on_close)
+
+    def _owned(self, fd, on_close):
+        with self.lock:
+            handler = self.handlers.get(fd)
+        return handler is not None and handler[1] == on_close
+
+    def _close(self, fd, on_close=None):
+        with self.lock:
+            handler = self.handlers.get(fd)
+            if handler is None or (on_close is not None and handler[1] != on_close):
+                return
+            del self.handlers[fd]
+        try:
+            self.epoll.unregister(fd)
+        except (OSError, ValueError):
+            pass
+        try:
+            handler[1]()
+        except Exception as e:
+            logger.error(f"Reactor close handler error: {e}")
+
+    def _read(self, fd):
+        """Dispatch one read; False on EOF, None when nothing is buffered"""
+        handler = self.handlers.get(fd)
+        if handler is None or handler[0] is None:
+            return False
+        try:
+            data = os.read(fd, self.READ_SIZE)
+        except BlockingIOError:
+            return None
+        except OSError:
+            # EIO: the slave side of the PTY has been closed
+            return False
+        if not data:
+            return False
+        pty_read_bytes.inc(amount=len(data))
+        try:
+            handler[0](data)
+        except Exception as e:
+            logger.error(f"Reactor data handler error: {e}")
+        return True
+
+    def _next_timeout(self):
+        timeout = None
+        with self.lock:
+            handlers = list(self.handlers.values())
+        for _, _, on_tick in handlers:
+            if on_tick is None:
+                continue
+            try:
+                delay = on_tick()
+            except Exception as e:
+                logger.error(f"Reactor tick handler error: {e}")
+                continue
+            if delay is not None and (timeout is None or delay < timeout):
+                timeout = max(delay, 0)
+        return -1 if timeout is None else timeout
+
+    def _loop(self):
+        while True:
+            try:
+                events = self.epoll.poll(self._next_timeout())
+            except InterruptedError:
+                continue
+            for fd, mask in events:
+                if fd == self.wake_r:
                     try:
-                        os.close(fd)
-                    except:
+                        while os.read(self.wake_r, 512):
+                            pass
+                    except OSError:
                         pass
-        except Exception as e:
-            logger.error(f"Fatal error in run_cmd: {e}")
+                    for handler in list(self.wake_handlers):
+                        try:
+                            handler()
+                        except Exception as e:
+                            logger.error(f"Reactor wake handler error: {e}")
+                    continue
+                alive = True
+                if mask & select.EPOLLIN:
+                    alive = self._read(fd) is not False
+                elif mask & (select.EPOLLHUP | select.EPOLLERR):
+                    alive = False
+                if not alive:
+                    self._close(fd)
+
+reactor = PtyReactor()
+
+# ========== CHILD REAPER ==========
+class ChildReaper:
+    """Reap finished commands with os.wait4 the moment they exit.
+
+    Each child gets a pidfd registered with the reactor where the kernel
+    supports it; otherwise a SIGCHLD handler (installed from the main
+    thread) wakes the reactor, which then reaps every watched pid. Exit
+    callbacks always run on the reactor thread.
+    """
+
+    def __init__(self, reactor):
+        self.reactor = reactor
+        self.watched = {}
+        self.lock = threading.Lock()
+        self.use_pidfd = False
+        if hasattr(os, "pidfd_open"):
             try:
-                bot.send_message(chat_id, f"❌ Error executing command: {str(e)[:200]}")
+                os.close(os.pidfd_open(os.getpid()))
+                self.use_pidfd = True
+            except OSError:
+                pass
+        if not self.use_pidfd:
+            reactor.wake_handlers.append(self.reap_pending)
+
+    def install(self):
+        """Install the SIGCHLD fallback; must be called from the main thread"""
+        if not self.use_pidfd:
+            signal.signal(signal.SIGCHLD, lambda signum, frame: self.reactor.wakeup())
+
+    def watch(self, pid, on_exit):
+        """Call on_exit(status, rusage) once pid has terminated"""
+        with self.lock:
+            self.watched[pid] = on_exit
+        if self.use_pidfd:
+            try:
+                pidfd = os.pidfd_open(pid)
+            except OSError:
+                pidfd = None
+            if pidfd is not None:
+                self.reactor.register(pidfd, None, lambda: self._on_pidfd(pid, pidfd))
+                return
+        # The child may have exited before it was watched
+        self.reactor.wakeup()
+
+    def _on_pidfd(self, pid, pidfd):
+        try:
+            os.close(pidfd)
+        except OSError:
+            pass
+        self.reap(pid)
+
+    def reap_pending(self):
+        with self.lock:
+            pids = list(self.watched)
+        for pid in pids:
+            self.reap(pid)
+
+    def unwatch(self, pid):
+        with self.lock:
+            self.watched.pop(pid, None)
+
+    def reap(self, pid):
+        """Collect pid if it has exited; returns False while it is running.
+
+        Unwatched pids are left alone, so a child is never collected before
+        its exit callback is in place.
+        """
+        with self.lock:
+            if pid not in self.watched:
+                return False
+        try:
+            wpid, status, rusage = os.wait4(pid, os.WNOHANG)
+        except ChildProcessError:
+            # Already collected elsewhere; no status available
+            wpid, status, rusage = pid, None, None
+        if wpid == 0:
+            return False
+        with self.lock:
+            on_exit = self.watched.pop(pid, None)
+        if on_exit:
+            try:
+                on_exit(status, rusage)
+            except Exception as e:
+                logger.error(f"Reaper exit handler error: {e}")
+        return True
+
+reaper = ChildReaper(reactor)
+
+def format_exit_report(exit_code, wall_time, rusage=None):
+    """One-line summary of how a command finished"""
+    if exit_code is None:
+        head = "⚪ Finished"
+    elif exit_code < 0:
+        head = f"🛑 Killed by signal {-exit_code}"
+    elif exit_code == 0:
+        head = "✅ Exit 0"
+    else:
+        head = f"❌ Exit {exit_code}"
+
+    report = f"{head} • ⏱️ {wall_time:.2f}s"
+    if rusage is not None:
+        cpu = rusage.ru_utime + rusage.ru_stime
+        # ru_maxrss is reported in KB on Linux
+        report += f" • 🖥️ CPU {cpu:.2f}s • 💾 {rusage.ru_maxrss / 1024:.1f} MB"
+    return report
+
+def start_session(user_id, session_id, pid, fd, cmd, limits=None):
+    """Register a running command in processes/active_sessions"""
+    start_time = datetime.now().strftime("%H:%M:%S")
+    get_user_dict(user_id, processes)[session_id] = (pid, fd, start_time, cmd)
+    get_user_dict(user_id, active_sessions)[session_id] = time.time()
+    if limits is not None:
+        session_resources[session_id] = limits
+    commands_started.inc()
+    open_output_history(user_id, session_id, cmd)
+
+def end_session(user_id, session_id):
+    """Drop a finished command from processes/active_sessions/input_wait"""
+    for registry in (processes, active_sessions, input_wait):
+        get_user_dict(user_id, registry).pop(session_id, None)
+    session_resources.pop(session_id, None)
+    disarm_timeout(session_id)
+    close_output_history(session_id)
+    scheduler.release(session_id)
+
+def run_cmd(cmd, user_id, chat_id, session_id, timeout=None):
+    """Run command in isolated PTY for specific user"""
+    limits = None
+    pid = fd = None
+    try:
+        user_dir = get_user_directory(user_id)
+        limits = prepare_resource_limits(user_id, session_id)
+
+        pid, fd = pty.fork()
+        if pid == 0:
+            # Child process
+            try:
+                apply_resource_limits(limits)
+                os.chdir(user_dir)
+                # Use bash -c to execute the command
+                os.execvp("bash", ["bash", "-c", cmd])
+            except BaseException as e:
+                # stderr is the PTY, so this reaches the user's output
+                os.write(2, f"❌ Could not start command: {e}\n".encode(errors="replace"))
+            finally:
+                os._exit(127)
+
+        # Parent process
+        started = time.time()
+        start_session(user_id, session_id, pid, fd, cmd, limits)
+        arm_timeout(user_id, chat_id, session_id, timeout)
+        output = CommandOutput(user_id, chat_id, session_id, fd)
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="ignore")
+
+        def on_data(data):
+            output.feed(decoder.decode(data))
+
+        def on_close():
+            output.close()
+            get_user_dict(user_id, input_wait).pop(session_id, None)
+            try:
+                os.close(fd)
             except:
                 pass
+            # The PTY usually hangs up as the child exits
+            reaper.reap(pid)
+
+        def on_exit(status, rusage):
+            with log_context(user_id=user_id, chat_id=chat_id, session_id=session_id):
+                finish(status, rusage)
+
+        def finish(status, rusage):
+            # Flush remaining output and close the PTY before reporting,
+            # unless the hang-up already did (fd is closed only by on_close)
+            reactor.close(fd, on_close)
+            end_session(user_id, session_id)
+            release_resource_limits(limits)
+
+            exit_code = None if status is None else os.waitstatus_to_exitcode(status)
+            record_command(user_id, session_id, cmd, started, time.time() - started, exit_code)
+            try:
+                send_message(chat_id, format_exit_report(exit_code, time.time() - started, rusage), bulk=True)
+            except Exception as e:
+                logger.error(f"Error sending exit report: {e}")
+
+        reaper.watch(pid, on_exit)
+        reactor.register(fd, on_data, on_close, output.due_in)
+    except Exception as e:
+        logger.error(f"Fatal error in run_cmd: {e}")
+        if pid:
+            reaper.unwatch(pid)
+            with contextlib.suppress(OSError):
+                os.kill(pid, signal.SIGKILL)
+                os.waitpid(pid, 0)
+        if fd is not None:
+            with contextlib.suppress(OSError):
+                os.close(fd)
+        end_session(user_id, session_id)
+        release_resource_limits(limits)
+        try:
+            send_message(chat_id, f"❌ Error executing command: {str(e)[:200]}")
+        except:
+            pass
+
+# ========== PERSISTENT SHELLS ==========
+class PersistentShell:
+    """One long-lived bash per user that runs commands written to its PTY.
+
+    Each command goes out as a single `eval <cmd>; printf <sentinel>` line,
+    so cd, exports and venv activation carry over between messages. The
+    sentinel marks where the command's output ends and carries its exit
+    status. Commands run one at a time; later ones wait their turn so they
+    see the state the earlier ones left behind.
+    """
+
+    def __init__(self, user_id, chat_id):
+        self.user_id = user_id
+        self.chat_id = chat_id
+        self.token = uuid.uuid4().hex[:12]
+        self.marker = f"__TMX_{self.token}_"
+        self.ready = False
+        self.closed = False
+        self.current = None
+        self.pending = None
+        self.waiting = collections.deque()  # (cmd, session_id, timeout) queued behind current
+        self.startup = ""
+        self.carry = ""
+        self.idle = LiveOutput(chat_id)
+        self.decoder = codecs.getincrementaldecoder("utf-8")(errors="ignore")
+        self.lock = threading.Lock()
+
+        user_dir = get_user_directory(user_id)
+        self.limits = prepare_resource_limits(user_id, self.token)
+        pid, fd = pty.fork()
+        if pid == 0:
+            try:
+                apply_resource_limits(self.limits)
+                os.chdir(user_dir)
+                os.execvp("bash", ["bash", "--noediting", "-i"])
+            except BaseException as e:
+                os.write(2, f"❌ Could not start persistent shell: {e}\n".encode(errors="replace"))
+            finally:
+                os._exit(127)
+
+        self.pid, self.fd = pid, fd
+        # Output before the first sentinel (rc noise, the setup line) is dropped
+        setup = f"stty -echo; PS1=''; PS2=''; unset PROMPT_COMMAND; set +o history; {self._sentinel()}\n"
+        os.write(fd, setup.encode())
+        reaper.watch(pid, self.on_exit)
+        reactor.register(fd, self.on_data, self.on_close, self.due_in)
+
+    def _sentinel(self):
+        # The marker is assembled by printf so the echoed line never matches it
+        return f"printf '\\n__TMX_%s_%s__\\n' {self.token} \"$?\""
+
+    @property
+    def busy(self):
+        return self.current is not None
+
+    def run(self, cmd, session_id, timeout=None):
+        """Start cmd in this shell or queue it behind the running one; False if the shell has exited"""
+        with self.lock:
+            if self.closed:
+                return False
+            if self.current is not None or self.waiting:
+                self.waiting.append((cmd, session_id, timeout))
+                position = len(self.waiting)
+            else:
+                position = 0
+                line = self._start(cmd, session_id)
+                if not self.ready:
+                    # The clock starts once the shell has actually received the command
+                    self.pending = (line, session_id, timeout)
+                    return True
+        if position:
+            send_message(self.chat_id, f"⏳ Waiting for your persistent shell (position {position}); "
+                                       f"it runs after the current command. /stop cancels it.")
+            return True
+        self._send(line, session_id, timeout)
+        return True
+
+    def _start(self, cmd, session_id):
+        """Make cmd the current command (lock held); returns the line to send"""
+        self.current = {
+            'session_id': session_id,
+            'cmd': cmd,
+            'started': time.time(),
+            'output': CommandOutput(self.user_id, self.chat_id, session_id, self.fd),
+        }
+        start_session(self.user_id, session_id, self.pid, self.fd, cmd, self.limits)
+        return f"eval {shlex.quote(cmd)}; {self._sentinel()}\n"
+
+    def _send(self, line, session_id, timeout):
+        os.write(self.fd, line.encode())
+        arm_timeout(self.user_id, self.chat_id, session_id, timeout)
+
+    def cancel_waiting(self):
+        """Drop the commands queued behind the current one; returns how many"""
+        with self.lock:
+            waiting = list(self.waiting)
+            self.waiting.clear()
+        for _, session_id, _ in waiting:
+            scheduler.release(session_id)
+        return len(waiting)
+
+    def on_data(self, data):
+        text = self.carry + self.decoder.decode(data)
+        self.carry = ""
+        while True:
+            idx = text.find(self.marker)
+            end = text.find("__", idx + len(self.marker)) if idx >= 0 else -1
+            if end < 0:
+                break
+            status = text[idx + len(self.marker):end]
+            before = text[:idx]
+            if before.endswith("\r\n"):
+                before = before[:-2]
+            self._emit(before)
+            self._command_done(int(status) if status.isdigit() else None)
+            text = text[end + 2:]
+            if text.startswith("\r\n"):
+                text = text[2:]
+
+        # Hold back anything that might be the start of a split sentinel,
+        # including the line break printf puts in front of it
+        hold = text.find(self.marker)
+        if hold < 0:
+            for k in range(min(len(self.marker), len(text)), 0, -1):
+                if text.endswith(self.marker[:k]):
+                    hold = len(text) - k
+                    break
+            else:
+                hold = len(text.rstrip("\r\n")) if text.endswith(("\r", "\n")) else -1
+        if hold >= 0:
+            text, self.carry = text[:hold], text[hold:]
+        self._emit(text)
+
+    def _emit(self, out):
+        if not out:
+            return
+        if not self.ready:
+            # Kept only to explain a shell that dies before its first sentinel
+            self.startup = (self.startup + out)[-4096:]
+            return
+        current = self.current
+        if current is not None:
+            current['output'].feed(out)
+        else:
+            # Background jobs writing between commands
+            self.idle.feed(out)
+
+    def _command_done(self, exit_code):
+        with self.lock:
+            if not self.ready:
+                self.ready = True
+                pending, self.pending = self.pending, None
+                if pending:
+                    self._send(*pending)
+                return
+            current, self.current = self.current, None
+            # Start the next queued command before anything else can claim the shell
+            following = None
+            if self.waiting and not self.closed:
+                cmd, session_id, timeout = self.waiting.popleft()
+                following = (self._start(cmd, session_id), session_id, timeout)
+        if following:
+            self._send(*following)
+        if current is None:
+            return
+        with log_context(user_id=self.user_id, chat_id=self.chat_id, session_id=current['session_id']):
+            self._finish(current, exit_code)
+
+    def _finish(self, current, exit_code):
+        current['output'].close()
+        end_session(self.user_id, current['session_id'])
+        duration = time.time() - current['started']
+        record_command(self.user_id, current['session_id'], current['cmd'], current['started'], duration, exit_code)
+        send_message(self.chat_id, format_exit_report(exit_code, duration), bulk=True)
+
+    def due_in(self):
+        delays = [self.idle.due_in()]
+        current = self.current
+        if current is not None:
+            delays.append(current['output'].due_in())
+        delays = [d for d in delays if d is not None]
+        return min(delays) if delays else None
+
+    def on_close(self):
+        if self.carry:
+            self.carry, text = "", self.carry
+            self._emit(text)
+        self.idle.close()
+        try:
+            os.close(self.fd)
+        except OSError:
+            pass
+        reaper.reap(self.pid)
+
+    def on_exit(self, status, rusage):
+        reactor.close(self.fd, self.on_close)
+        with self.lock:
+            started = self.ready
+            self.closed = True
+            self.ready = True
+        if not started:
+            for line in self.startup.splitlines():
+                if "Could not start" in line:
+                    send_message(self.chat_id, line.strip())
+        if persistent_shells.get(self.user_id) is self:
+            del persistent_shells[self.user_id]
+        if self.current is not None:
+            exit_code = None if status is None else os.waitstatus_to_exitcode(status)
+            self._command_done(exit_code)
+        release_resource_limits(self.limits)
+        dropped = self.cancel_waiting()
+        send_message(self.chat_id, "🐚 Persistent shell exited; a new one starts with your next command."
+                     + (f" {dropped} waiting command(s) were dropped." if dropped else ""), bulk=True)
+
+def uses_persistent_shell(user_id):
+    """Whether the user opted into a persistent shell (see /persist)"""
+    return user_stats.get(str(user_id), {}).get('persistent_shell', PERSISTENT_SHELL_DEFAULT)
+
+def run_in_persistent_shell(cmd, user_id, chat_id, session_id, timeout=None):
+    """Run or queue cmd in the user's persistent shell; False if no shell could take it"""
+    shell_session = persistent_shells.get(user_id)
+    if shell_session is None or shell_session.closed:
+        try:
+            shell_session = persistent_shells[user_id] = PersistentShell(user_id, chat_id)
+        except Exception as e:
+            logger.error(f"Error starting persistent shell: {e}")
+            return False
+    return shell_session.run(cmd, session_id, timeout)
+
+# ========== JOB SCHEDULER ==========
+class JobScheduler:
+    """Admission control between incoming commands and process launch.
+
+    At most MAX_CONCURRENT_JOBS commands run at once and at most
+    MAX_JOBS_PER_USER per user. Excess jobs wait in per-user queues that
+    are served round-robin, with admins' queues served first.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.running = {}  # session_id -> user_id
+        self.per_user = collections.Counter()
+        self.lanes = (collections.OrderedDict(), collections.OrderedDict())  # admin, normal
+
+    def submit(self, user_id, session_id, launch, priority=False):
+        """Start launch() now or queue it; returns the queue position (0 = started)"""
+        with self.lock:
+            if self._can_run(user_id) and not self._waiting(user_id):
+                self._mark_running(user_id, session_id)
+                position = 0
+            else:
+                lane = self.lanes[0 if priority else 1]
+                lane.setdefault(user_id, collections.deque()).append((session_id, launch))
+                position = len(lane[user_id])
+        if position == 0:
+            self._launch(session_id, launch)
+        return position
+
+    def release(self, session_id):
+        """A job finished (idempotent); start whatever can run next"""
+        with self.lock:
+            user_id = self.running.pop(session_id, None)
+            if user_id is None:
+                return
+            self.per_user[user_id] -= 1
+            if self.per_user[user_id] <= 0:
+                del self.per_user[user_id]
+            ready = self._take_ready()
+        for session_id, launch in ready:
+            self._launch(session_id, launch)
+
+    def cancel(self, user_id):
+        """Drop a user's queued jobs; returns how many were dropped"""
+        with self.lock:
+            return sum(len(lane.pop(user_id, ())) for lane in self.lanes)
+
+    def clear(self):
+        with self.lock:
+            dropped = sum(len(q) for lane in self.lanes for q in lane.values())
+            for lane in self.lanes:
+                lane.clear()
+            return dropped
+
+    def queued(self):
+        with self.lock:
+            return sum(len(q) for lane in self.lanes for q in lane.values())
+
+    def _can_run(self, user_id):
+        return len(self.running) < MAX_CONCURRENT_JOBS and self.per_user[user_id] < MAX_JOBS_PER_USER
+
+    def _waiting(self, user_id):
+        return any(user_id in lane for lane in self.lanes)
+
+    def _mark_running(self, user_id, session_id):
+        self.running[session_id] = user_id
+        self.per_user[user_id] += 1
+
+    def _take_ready(self):
+        """Pop runnable jobs round-robin, admin lane first"""
+        ready = []
+        for lane in self.lanes:
+            progress = True
+            while progress and len(self.running) < MAX_CONCURRENT_JOBS:
+                progress = False
+                for user_id in list(lane):
+                    if len(self.running) >= MAX_CONCURRENT_JOBS:
+                        break
+                    if self.per_user[user_id] >= MAX_JOBS_PER_USER:
+                        continue
+                    queue = lane.pop(user_id)
+                    session_id, launch = queue.popleft()
+                    if queue:
+                        # Re-append so the next user gets the following turn
+                        lane[user_id] = queue
+                    self._mark_running(user_id, session_id)
+                    ready.append((session_id, launch))
+                    progress = True
+        return ready
+
+    def _launch(self, session_id, launch):
+        try:
+            launch()
+        except Exception as e:
+            logger.error(f"Error launching job {session_id}: {e}")
+            self.release(session_id)
 
-    threading.Thread(target=task, daemon=True).start()
+scheduler = JobScheduler()
+
+def launch_command(cmd, user_id, chat_id, session_id, timeout=None):
+    """Start cmd in the user's persistent shell or a fresh PTY"""
+    if uses_persistent_shell(user_id):
+        if run_in_persistent_shell(cmd, user_id, chat_id, session_id, timeout):
+            return
+        send_message(chat_id, "⚠️ Persistent shell unavailable, running this command in a fresh shell "
+                              "(your cd/env changes do not apply).")
+    run_cmd(cmd, user_id, chat_id, session_id, timeout)
+
+def schedule_command(cmd, user_id, chat_id, timeout=None):
+    """Queue cmd behind the user's running jobs and tell them where it stands"""
+    session_id = generate_session_id()
+
+    def launch():
+        if queued:
+            send_message(chat_id, f"▶️ Starting queued command:\n```\n$ {cmd}\n```", parse_mode="Markdown")
+        launch_command(cmd, user_id, chat_id, session_id, effective_timeout(user_id, timeout))
+
+    queued = False
+    position = scheduler.submit(user_id, session_id, launch, priority=is_admin(user_id))
+    if position:
+        queued = True
+        send_message(chat_id, f"⏳ Queued (position {position} of your jobs, {scheduler.queued()} waiting overall). "
+                              f"It starts when one of your running commands finishes. /stop cancels the queue.")
+    return session_id
+
+# ========== PROFILER ==========
+def profile_thread_label(name):
+    """Thread name as shown in profiles; Flask's per-request threads are grouped"""
+    if name.endswith("(process_request_thread)"):
+        return "flask-request"
+    return name
+
+class SamplingProfiler:
+    """Samples every thread's stack via sys._current_frames().
+
+    Stacks are counted as tuples of code objects and only turned into
+    text once sampling ends, so each tick costs a frame walk per thread.
+    Output is in collapsed-stack format ("thread;outer;...;inner count"),
+    ready for flamegraph.pl or speedscope. One profile runs at a time.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+
+    def profile(self, seconds, rate=PROFILE_RATE):
+        """(samples, collapsed stacks text), or None if a profile is already running"""
+        if not self.lock.acquire(blocking=False):
+            return None
+        try:
+            me = threading.get_ident()
+            counts = collections.Counter()
+            labels = {}
+            samples = 0
+            interval = 1 / rate
+            deadline = time.monotonic() + seconds
+            while time.monotonic() < deadline:
+                frames = sys._current_frames()
+                if not frames.keys() <= labels.keys():
+                    labels = {thread.ident: profile_thread_label(thread.name) for thread in threading.enumerate()}
+                for ident, frame in frames.items():
+                    if ident == me:
+                        continue
+                    codes = []
+                    while frame is not None:
+                        codes.append(frame.f_code)
+                        frame = frame.f_back
+                    counts[ident, tuple(codes)] += 1
+                samples += 1
+                time.sleep(interval)
+        finally:
+            self.lock.release()
+
+        names = {}
+        collapsed = collections.Counter()
+        for (ident, codes), count in counts.items():
+            frames = []
+            for code in reversed(codes):
+                name = names.get(code)
+                if name is None:
+                    name = names[code] = f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+                frames.append(name)
+            collapsed[";".join([labels.get(ident, f"thread-{ident}")] + frames)] += count
+        return samples, "".join(f"{stack} {count}\n" for stack, count in collapsed.most_common())
+
+profiler = SamplingProfiler()
 
 # ========== KEYBOARDS ==========
 def main_menu_keyboard(is_admin_user=False):
@@ -335,6 +3013,7 @@ def admin_keyboard():
         types.InlineKeyboardButton("📊 User Stats", callback_data="user_stats"),
         types.InlineKeyboardButton("⚠️ System Alerts", callback_data="system_alerts"),
         types.InlineKeyboardButton("📈 Performance", callback_data="performance"),
+        types.InlineKeyboardButton("🔄 Sessions", callback_data="sessions"),
         types.InlineKeyboardButton("👥 Authorize User", callback_data="authorize_user"),
         types.InlineKeyboardButton("🚫 Deauthorize User", callback_data="deauthorize_user")
     )
@@ -348,7 +3027,9 @@ def start(m):
     first_name = m.from_user.first_name or "User"
     
     # Always allow /start command
-    authorized_users.add(cid)
+    if cid not in authorized_users:
+        authorized_users.add(cid)
+        save_data()
     update_user_stats(cid, username)
     
     # Get system stats
@@ -382,7 +3063,7 @@ def start(m):
 
 ▬▬▬▬▬▬▬▬▬▬▬▬▬▬▬▬▬▬▬
 """
-    bot.send_message(cid, welcome_msg, 
+    send_message(cid, welcome_msg, 
                      parse_mode="Markdown", 
                      reply_markup=main_menu_keyboard(is_admin(cid)))
     
@@ -404,11 +3085,18 @@ def help_cmd(m):
 • 𝚄𝚂𝙴 𝙱𝚄𝚃𝚃𝙾𝙽𝚂 𝙵𝙾𝚁 𝚀𝚄𝙸𝙲𝙺 𝙲𝙾𝙼𝙼𝙰𝙽𝙳𝚂
 • /start - 𝚁𝙴𝚂𝚃𝙰𝚁𝚃 𝙱𝙾𝚃
 • /help - 𝚂𝙷𝙾𝚆 𝚃𝙷𝙸𝚂 𝙷𝙴𝙻𝙿
+• /persist on|off - 𝙺𝙴𝙴𝙿 𝙲𝙳/𝙴𝙽𝚅 𝙱𝙴𝚃𝚆𝙴𝙴𝙽 𝙲𝙾𝙼𝙼𝙰𝙽𝙳𝚂
+• /tail [session] - 𝚁𝙴𝙲𝙴𝙽𝚃 𝙲𝙾𝙼𝙼𝙰𝙽𝙳 𝙾𝚄𝚃𝙿𝚄𝚃
+• /more - 𝙽𝙴𝚇𝚃 𝙿𝙰𝙶𝙴 𝙾𝙵 𝙾𝚄𝚃𝙿𝚄𝚃
+• /timeout {sec} {cmd} - 𝚁𝚄𝙽 𝚆𝙸𝚃𝙷 𝙰 𝚃𝙸𝙼𝙴 𝙻𝙸𝙼𝙸𝚃
+• /history [prefix] - 𝚂𝙴𝙰𝚁𝙲𝙷 & 𝚁𝙴-𝚁𝚄𝙽 𝙲𝙾𝙼𝙼𝙰𝙽𝙳𝚂
 
 ━━━━━━━━━━━━━━━━━━━━━━━━━━━
           📝 𝗙𝗜𝗟𝗘 𝗘𝗗𝗜𝗧𝗜𝗡𝗚
 ━━━━━━━━━━━━━━━━━━━━━━━━━━━
 • /nano {filename} - 𝙴𝙳𝙸𝚃 𝙵𝙸𝙻𝙴𝚂 𝙸𝙽 𝙱𝚁𝙾𝚆𝚂𝙴𝚁
+• /versions {filename} - 𝚂𝙰𝚅𝙴𝙳 𝚅𝙴𝚁𝚂𝙸𝙾𝙽𝚂 𝙾𝙵 𝙰 𝙵𝙸𝙻𝙴
+• /restore {filename} {n} - 𝚄𝙽𝙳𝙾 𝚃𝙾 𝙰 𝚂𝙰𝚅𝙴𝙳 𝚅𝙴𝚁𝚂𝙸𝙾𝙽
 • 𝚅𝙸𝙴𝚆 𝙵𝙸𝙻𝙴𝚂 𝙸𝙽 𝚈𝙾𝚄𝚁 𝙿𝚁𝙸𝚅𝙰𝚃𝙴 𝙳𝙸𝚁𝙴𝙲𝚃𝙾𝚁𝚈
 • 𝚂𝙰𝚅𝙴 𝙲𝙷𝙰𝙽𝙶𝙴𝚂 𝙵𝚁𝙾𝙼 𝚆𝙴𝙱 𝙸𝙽𝚃𝙴𝚁𝙵𝙰𝙲𝙴
 
@@ -424,19 +3112,21 @@ def help_cmd(m):
 • /𝙰𝙳𝙼𝙸𝙽 - 𝙾𝙿𝙴𝙽 𝙰𝙳𝙼𝙸𝙽 𝙿𝙰𝙽𝙴𝙻
 • /𝚂𝚃𝙰𝚃𝚄𝚂 - 𝙳𝙴𝚃𝙰𝙸𝙻𝙴𝙳 𝚂𝚈𝚂𝚃𝙴𝙼 𝚂𝚃𝙰𝚃𝚄𝚂
 • /𝚂𝙴𝚂𝚂𝙸𝙾𝙽𝚂 - 𝚅𝙸𝙴𝚆 𝙰𝙲𝚃𝙸𝚅𝙴 𝚂𝙴𝚂𝚂𝙸𝙾𝙽𝚂
+• /𝚃𝙾𝙿 [𝙲𝙿𝚄|𝙼𝙴𝙼] - 𝚃𝙾𝙿 𝙿𝚁𝙾𝙲𝙴𝚂𝚂𝙴𝚂
+• /𝙿𝚁𝙾𝙵𝙸𝙻𝙴 [𝚂𝙴𝙲𝙾𝙽𝙳𝚂] - 𝙿𝚁𝙾𝙵𝙸𝙻𝙴 𝙱𝙾𝚃 𝚃𝙷𝚁𝙴𝙰𝙳𝚂
 
 ▬▬▬▬▬▬▬▬▬▬▬▬▬▬▬▬▬▬▬
 """
-    bot.send_message(cid, help_msg, parse_mode="Markdown")
+    send_message(cid, help_msg, parse_mode="Markdown")
 
 @bot.message_handler(commands=["admin"])
 def admin_panel(m):
     cid = m.chat.id
     if not is_admin(cid):
-        bot.send_message(cid, "❌ This command is for admins only!")
+        send_message(cid, "❌ This command is for admins only!")
         return
     
-    bot.send_message(cid, "🔐 *ADMIN CONTROL PANEL*", 
+    send_message(cid, "🔐 *ADMIN CONTROL PANEL*", 
                      parse_mode="Markdown", 
                      reply_markup=admin_keyboard())
 
@@ -444,7 +3134,7 @@ def admin_panel(m):
 def status_cmd(m):
     cid = m.chat.id
     if not is_admin(cid):
-        bot.send_message(cid, "❌ This command is for admins only!")
+        send_message(cid, "❌ This command is for admins only!")
         return
     
     stats = get_system_stats()
@@ -452,6 +3142,11 @@ def status_cmd(m):
     total_processes = sum(len(procs) for procs in processes.values())
     total_sessions = sum(len(sess) for sess in active_sessions.values())
     total_users = len(set(active_sessions.keys()) | set(processes.keys()))
+
+    trends = {}
+    for metric in HISTORY_METRICS:
+        _, points = metrics_history.query(metric, SPARKLINE_POINTS * 60, step=60)
+        trends[metric] = sparkline(point[2] for point in points[-SPARKLINE_POINTS:]) or "-"
     
     status_msg = f"""
  📊 𝗦𝗬𝗦𝗧𝗘𝗠 𝗦𝗧𝗔𝗧𝗨𝗦 𝗥𝗘𝗣𝗢𝗥𝗧 📊
@@ -467,6 +3162,12 @@ def status_cmd(m):
  [🔄] 𝗣𝗥𝗢𝗖𝗘𝗦𝗦𝗘𝗦     : {stats['processes']}
  [🚀] 𝗕𝗢𝗢𝗧 𝗧𝗜𝗠𝗘      : {stats['boot_time']}
 
+📈 𝗟𝗔𝗦𝗧 {SPARKLINE_POINTS} 𝗠𝗜𝗡𝗨𝗧𝗘𝗦
+──────────────────
+𝗖𝗣𝗨    : `{trends['cpu']}`
+𝗠𝗘𝗠𝗢𝗥𝗬 : `{trends['memory']}`
+𝗗𝗜𝗦𝗞   : `{trends['disk']}`
+
 ━━━━━━━━━━━━━━━━━━━━━━━━━━━
 👥 𝗨𝗦𝗘𝗥 𝗦𝗧𝗔𝗧𝗜𝗦𝗧𝗜𝗖𝗦
 ──────────────────
@@ -478,59 +3179,108 @@ def status_cmd(m):
 ▬▬▬▬▬▬▬▬▬▬▬▬▬▬▬▬▬▬▬
 """
     
-    bot.send_message(cid, status_msg, parse_mode="Markdown")
+    send_message(cid, status_msg, parse_mode="Markdown")
 
 @bot.message_handler(commands=["sessions"])
 def sessions_cmd(m):
     cid = m.chat.id
     if not is_admin(cid):
-        bot.send_message(cid, "❌ Not authorized!")
+        send_message(cid, "❌ Not authorized!")
         return
     
-    sessions_msg = "🔄 *ACTIVE SESSIONS*\n\n"
-    has_sessions = False
-    
-    for user_id, sess_dict in active_sessions.items():
-        if sess_dict:
-            has_sessions = True
-            sessions_msg += f"👤 User {user_id}:\n"
-            for session_id, last_active in sess_dict.items():
-                elapsed = int(time.time() - last_active)
-                sessions_msg += f"  • `{session_id[:8]}`: {elapsed}s ago\n"
-    
-    if not has_sessions:
-        sessions_msg += "📭 No active sessions"
-    
-    bot.send_message(cid, sessions_msg, parse_mode="Markdown")
+    args = m.text.strip().split()
+    sort = args[1].lower() if len(args) > 1 else 'cpu'
+    if sort not in SESSION_SORTS:
+        send_message(cid, f"❌ Usage: /sessions [{'|'.join(SESSION_SORTS)}]")
+        return
+
+    text, markup = render_sessions(sort)
+    send_message(cid, text, parse_mode="Markdown", reply_markup=markup)
+
+@bot.message_handler(commands=["top"])
+def top_cmd(m):
+    cid = m.chat.id
+    if not is_admin(cid):
+        send_message(cid, "❌ This command is for admins only!")
+        return
+
+    args = m.text.strip().split()
+    key = 'rss' if len(args) > 1 and args[1].lower() in ("mem", "rss", "memory") else 'cpu'
+    top = process_tracker.latest()
+
+    top_msg = f"🔝 *TOP PROCESSES BY {'MEMORY' if key == 'rss' else 'CPU'}* ({top['count']} total)\n\n"
+    top_msg += "```\n"
+    top_msg += f"{'PID':>7} {'CPU%':>6} {'RSS MB':>8}  NAME\n"
+    for proc in top[key][:15]:
+        top_msg += f"{proc['pid']:>7} {proc['cpu']:>6.1f} {proc['rss'] / 1024**2:>8.1f}  {proc['name'][:20]}\n"
+    top_msg += "```"
+    send_message(cid, top_msg, parse_mode="Markdown")
+
+@bot.message_handler(commands=["profile"])
+def profile_cmd(m):
+    cid = m.chat.id
+    if not is_admin(cid):
+        send_message(cid, "❌ This command is for admins only!")
+        return
+
+    args = m.text.strip().split()
+    try:
+        seconds = float(args[1]) if len(args) > 1 else 10
+    except ValueError:
+        send_message(cid, "❌ Usage: /profile [seconds]")
+        return
+    if not 0 < seconds <= PROFILE_MAX_SECONDS:
+        send_message(cid, f"❌ Duration must be between 0 and {PROFILE_MAX_SECONDS} seconds")
+        return
+
+    def run():
+        result = profiler.profile(seconds)
+        if result is None:
+            send_message(cid, "⏳ A profile is already running, try again shortly.")
+            return
+        samples, stacks = result
+        name = f"profile-{datetime.now().strftime('%Y%m%d-%H%M%S')}.txt"
+        caption = f"🔬 {samples} samples over {seconds:g}s at {PROFILE_RATE} Hz (collapsed stacks)"
+        outbox.call(cid, bot.send_document, cid, stacks.encode(), visible_file_name=name, caption=caption)
+
+    send_message(cid, f"🔬 Profiling all threads for {seconds:g}s...")
+    threading.Thread(target=run, name="profiler", daemon=True).start()
 
 @bot.message_handler(commands=["stop"])
 def stop_cmd(m):
     cid = m.chat.id
     if not is_authorized(cid):
-        bot.send_message(cid, "❌ Please /start the bot first!")
+        send_message(cid, "❌ Please /start the bot first!")
         return
     
     proc_dict = get_user_dict(cid, processes)
     input_dict = get_user_dict(cid, input_wait)
     sess_dict = get_user_dict(cid, active_sessions)
     
+    # Commands queued behind the persistent shell go first so none starts meanwhile
+    shell_session = persistent_shells.get(cid)
+    cancelled = shell_session.cancel_waiting() if shell_session is not None else 0
+
+    # Signal process groups via signal_session, which spares a persistent shell
+    # itself and stops only the command running in its foreground
     stopped = 0
-    for session_id in list(proc_dict.keys()):
+    session_ids = list(proc_dict.keys())
+    for session_id in session_ids:
         try:
-            pid, fd, _, _ = proc_dict[session_id]
             # Try graceful termination first
-            os.kill(pid, signal.SIGTERM)
-            time.sleep(0.5)
-            # Force kill if still running
-            try:
-                os.kill(pid, 0)  # Check if process exists
-                os.kill(pid, signal.SIGKILL)
-            except OSError:
-                pass  # Process already terminated
-            stopped += 1
+            if signal_session(cid, session_id, signal.SIGTERM):
+                stopped += 1
         except Exception as e:
             logger.error(f"Error stopping process {session_id}: {e}")
-        
+    if stopped:
+        time.sleep(0.5)
+    for session_id in session_ids:
+        try:
+            # Force kill whatever is still running
+            signal_session(cid, session_id, signal.SIGKILL)
+        except Exception as e:
+            logger.error(f"Error killing process {session_id}: {e}")
+
         # Clean up regardless
         if session_id in proc_dict:
             del proc_dict[session_id]
@@ -538,38 +3288,42 @@ def stop_cmd(m):
             del input_dict[session_id]
         if session_id in sess_dict:
             del sess_dict[session_id]
-    
+
+    cancelled += scheduler.cancel(cid)
+    if cancelled:
+        send_message(cid, f"🗑️ Cancelled {cancelled} queued command(s).")
+
     if stopped > 0:
-        bot.send_message(cid, f"✅ Stopped {stopped} process(es) successfully!")
+        send_message(cid, f"✅ Stopped {stopped} process(es) successfully!")
         add_system_alert("INFO", f"User {cid} stopped {stopped} processes")
-    else:
-        bot.send_message(cid, "⚠️ No running process to stop.")
+    elif not cancelled:
+        send_message(cid, "⚠️ No running process to stop.")
 
 @bot.message_handler(commands=["nano"])
 def nano_cmd(m):
     cid = m.chat.id
     if not is_authorized(cid):
-        bot.send_message(cid, "❌ Please /start the bot first!")
+        send_message(cid, "❌ Please /start the bot first!")
         return
 
     args = m.text.strip().split(maxsplit=1)
     if len(args) < 2:
-        bot.send_message(cid, "📝 *Usage:* `/nano <filename>`\nExample: `/nano script.py`", parse_mode="Markdown")
+        send_message(cid, "📝 *Usage:* `/nano <filename>`\nExample: `/nano script.py`", parse_mode="Markdown")
         return
 
     filename = args[1].strip()
     safe_path = sanitize_path(cid, filename)
 
     if not safe_path:
-        bot.send_message(cid, "❌ Invalid filename or path traversal attempt!")
+        send_message(cid, "❌ Invalid filename or path traversal attempt!")
         return
 
     try:
         if not os.path.exists(safe_path):
             open(safe_path, 'w').close()
-            bot.send_message(cid, f"✅ Created new file: `{filename}`", parse_mode="Markdown")
+            send_message(cid, f"✅ Created new file: `{filename}`", parse_mode="Markdown")
     except Exception as e:
-        bot.send_message(cid, f"❌ Error creating file: {e}")
+        send_message(cid, f"❌ Error creating file: {e}")
         return
     
     sid = str(uuid.uuid4())
@@ -598,7 +3352,7 @@ def nano_cmd(m):
         types.InlineKeyboardButton("📁 Browse Directory", callback_data=f"browse_{os.path.dirname(filename) or '.'}")
     )
 
-    bot.send_message(
+    send_message(
         cid,
         f"📝 *EDIT FILE*\n\n"
         f"📄 *File:* `{filename}`\n"
@@ -609,6 +3363,209 @@ def nano_cmd(m):
         reply_markup=markup
     )
 
+@bot.message_handler(commands=["versions"])
+def versions_cmd(m):
+    cid = m.chat.id
+    if not is_authorized(cid):
+        send_message(cid, "❌ Please /start the bot first!")
+        return
+
+    args = m.text.strip().split(maxsplit=1)
+    if len(args) < 2:
+        send_message(cid, "📝 *Usage:* `/versions <filename>`", parse_mode="Markdown")
+        return
+
+    filename = args[1].strip()
+    safe_path = sanitize_path(cid, filename)
+    if not safe_path or not os.path.isfile(safe_path):
+        send_message(cid, "❌ File not found!")
+        return
+
+    try:
+        versions, restorable = file_versions(cid, safe_path)
+    except Exception as e:
+        send_message(cid, f"❌ Error reading versions: {e}")
+        return
+
+    if not versions:
+        send_message(cid, f"📭 No saved versions of `{filename}` yet.", parse_mode="Markdown")
+        return
+    if not restorable:
+        send_message(cid, f"⚠️ `{filename}` was changed outside the editor; its earlier versions can no longer be restored.",
+                     parse_mode="Markdown")
+        return
+
+    versions_msg = f"🕘 *VERSIONS* of `{filename}`\n\n"
+    for entry in versions[:VERSION_PAGE]:
+        when = datetime.fromtimestamp(entry['time']).strftime("%d/%m %H:%M:%S")
+        versions_msg += f"`#{entry['n']}` {when} • {entry['size']} bytes{' • changed outside the editor' if entry.get('external') else ''}\n"
+    if len(versions) > VERSION_PAGE:
+        versions_msg += f"\n… and {len(versions) - VERSION_PAGE} older\n"
+    versions_msg += f"\nEach version is the content before that save.\nRestore with `/restore {filename} <n>`"
+    send_message(cid, versions_msg, parse_mode="Markdown")
+
+@bot.message_handler(commands=["restore"])
+def restore_cmd(m):
+    cid = m.chat.id
+    if not is_authorized(cid):
+        send_message(cid, "❌ Please /start the bot first!")
+        return
+
+    args = m.text.strip().split(maxsplit=1)
+    parts = args[1].rsplit(maxsplit=1) if len(args) > 1 else []
+    if len(parts) < 2 or not parts[1].lstrip("#").isdigit():
+        send_message(cid, "📝 *Usage:* `/restore <filename> <n>`\nSee `/versions <filename>` for the numbers.", parse_mode="Markdown")
+        return
+
+    filename, n = parts[0].strip(), int(parts[1].lstrip("#"))
+    safe_path = sanitize_path(cid, filename)
+    if not safe_path or not os.path.isfile(safe_path):
+        send_message(cid, "❌ File not found!")
+        return
+
+    try:
+        restore_version(cid, safe_path, n)
+    except KeyError:
+        send_message(cid, f"❌ No version #{n} of `{filename}`", parse_mode="Markdown")
+        return
+    except ValueError:
+        send_message(cid, "❌ The file changed outside the editor; its earlier versions can no longer be restored.")
+        return
+    except StaleWrite:
+        send_message(cid, "❌ The file changed while restoring, please try again.")
+        return
+    except Exception as e:
+        send_message(cid, f"❌ Error restoring file: {e}")
+        return
+
+    send_message(cid, f"✅ Restored `{filename}` to version #{n}\n📊 *Size:* {os.path.getsize(safe_path)} bytes\n"
+                      f"The replaced content was saved as a new version.", parse_mode="Markdown")
+
+@bot.message_handler(commands=["tail"])
+def tail_cmd(m):
+    cid = m.chat.id
+    if not is_authorized(cid):
+        send_message(cid, "❌ Please /start the bot first!")
+        return
+
+    args = m.text.strip().split(maxsplit=1)
+    prefix = args[1].strip() if len(args) > 1 else None
+    session_id, entry = find_output_history(cid, prefix)
+    if entry is None:
+        send_message(cid, "📭 No output kept for that session.\n*Usage:* `/tail [session]`", parse_mode="Markdown")
+        return
+
+    text, offset, markup = render_output_page(session_id, entry)
+    tail_cursors[cid] = (session_id, offset)
+    send_message(cid, text, parse_mode="Markdown", reply_markup=markup)
+
+@bot.message_handler(commands=["more"])
+def more_cmd(m):
+    cid = m.chat.id
+    if not is_authorized(cid):
+        send_message(cid, "❌ Please /start the bot first!")
+        return
+
+    session_id, offset = tail_cursors.get(cid, (None, None))
+    entry = session_outputs.get(session_id) if session_id else None
+    if entry is None:
+        send_message(cid, "📭 Nothing to page through. Use `/tail [session]` first.", parse_mode="Markdown")
+        return
+
+    if offset + TAIL_PAGE_SIZE >= entry['ring'].end:
+        send_message(cid, "✅ No newer output yet.")
+        return
+    text, offset, markup = render_output_page(session_id, entry, offset + TAIL_PAGE_SIZE)
+    tail_cursors[cid] = (session_id, offset)
+    send_message(cid, text, parse_mode="Markdown", reply_markup=markup)
+
+@bot.message_handler(commands=["timeout"])
+def timeout_cmd(m):
+    cid = m.chat.id
+    if not is_authorized(cid):
+        send_message(cid, "❌ Please /start the bot first!")
+        return
+
+    args = m.text.strip().split(maxsplit=2)
+    if len(args) < 2 or not (args[1].isdigit() or args[1].lower() == "off"):
+        current = effective_timeout(cid)
+        send_message(cid, f"⏰ *Default timeout:* {f'{current}s' if current else 'none'}\n"
+                          f"*Usage:* `/timeout <seconds> <command>` or `/timeout <seconds|off>`", parse_mode="Markdown")
+        return
+
+    seconds = 0 if args[1].lower() == "off" else int(args[1])
+    update_user_stats(cid, m.from_user.username or "Unknown")
+    if len(args) == 2:
+        user_stats[str(cid)]['timeout'] = seconds
+        save_data(cid)
+        send_message(cid, f"⏰ Default timeout set to {f'{seconds}s' if seconds else 'none'}.")
+        return
+
+    cmd = args[2].strip()
+    send_message(cid, f"```\n$ {cmd}\n```", parse_mode="Markdown")
+    schedule_command(cmd, cid, cid, timeout=seconds)
+
+@bot.message_handler(commands=["history"])
+def history_cmd(m):
+    cid = m.chat.id
+    if not is_authorized(cid):
+        send_message(cid, "❌ Please /start the bot first!")
+        return
+
+    args = m.text.strip().split(maxsplit=1)
+    prefix = args[1].strip() if len(args) > 1 else None
+    try:
+        entries = command_history.search(cid, prefix)
+    except Exception as e:
+        send_message(cid, f"❌ Error reading history: {e}")
+        return
+
+    if not entries:
+        send_message(cid, "📭 No matching commands in your history.")
+        return
+
+    history_msg = f"📜 *COMMAND HISTORY*{f' for `{markdown_code(prefix)}`' if prefix else ''}\n\n"
+    markup = types.InlineKeyboardMarkup(row_width=5)
+    buttons = []
+    for entry in entries:
+        code = entry['exit_code']
+        emoji = "✅" if code == 0 else "⚪" if code is None else "❌"
+        when = datetime.fromtimestamp(entry['started']).strftime("%d/%m %H:%M")
+        command = entry['command'] if len(entry['command']) <= 80 else entry['command'][:77] + "..."
+        history_msg += f"`#{entry['seq']}` {emoji} {when} ({entry['duration']:.1f}s)\n`{markdown_code(command)}`\n"
+        buttons.append(types.InlineKeyboardButton(f"🔁 #{entry['seq']}", callback_data=f"rerun_{entry['seq']}"))
+    markup.add(*buttons)
+    send_message(cid, history_msg, parse_mode="Markdown", reply_markup=markup)
+
+@bot.message_handler(commands=["persist"])
+def persist_cmd(m):
+    cid = m.chat.id
+    if not is_authorized(cid):
+        send_message(cid, "❌ Please /start the bot first!")
+        return
+
+    args = m.text.strip().split(maxsplit=1)
+    if len(args) < 2 or args[1].strip().lower() not in ("on", "off"):
+        state = "ON" if uses_persistent_shell(cid) else "OFF"
+        send_message(cid, f"🐚 *Persistent shell:* {state}\n*Usage:* `/persist on|off`", parse_mode="Markdown")
+        return
+
+    enabled = args[1].strip().lower() == "on"
+    update_user_stats(cid, m.from_user.username or "Unknown")
+    user_stats[str(cid)]['persistent_shell'] = enabled
+    save_data(cid)
+
+    if not enabled and cid in persistent_shells:
+        try:
+            os.kill(persistent_shells[cid].pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+    if enabled:
+        send_message(cid, "🐚 Persistent shell enabled: `cd`, exports and venvs now carry over between commands.", parse_mode="Markdown")
+    else:
+        send_message(cid, "🐚 Persistent shell disabled: every command runs in a fresh shell.")
+
 @bot.message_handler(func=lambda m: True)
 def shell(m):
     cid = m.chat.id
@@ -616,7 +3573,7 @@ def shell(m):
     username = m.from_user.username or "Unknown"
     
     if not is_authorized(cid):
-        bot.send_message(cid, "❌ Please /start the bot first!")
+        send_message(cid, "❌ Please /start the bot first!")
         return
 
     # Update user stats
@@ -655,13 +3612,13 @@ def shell(m):
     
     if text in quick_map:
         if text == "🗑️ clear":
-            bot.send_message(cid, "🗑️ Chat cleared (bot-side)")
+            send_message(cid, "🗑️ Chat cleared (bot-side)")
             return
         elif text == "🛑 stop":
             stop_cmd(m)
             return
         elif text == "📝 nano":
-            bot.send_message(cid, "📝 *Usage:* `/nano filename`\nExample: `/nano script.py`", parse_mode="Markdown")
+            send_message(cid, "📝 *Usage:* `/nano filename`\nExample: `/nano script.py`", parse_mode="Markdown")
             return
         elif text == "📊 system stats":
             stats = get_system_stats()
@@ -678,14 +3635,14 @@ def shell(m):
 🔄  𝗣𝗥𝗢𝗖𝗘𝗦𝗦𝗘𝗦   : {stats['processes']}
 ▬▬▬▬▬▬▬▬▬▬▬▬▬▬▬▬▬▬▬
 """
-            bot.send_message(cid, stats_msg, parse_mode="Markdown")
+            send_message(cid, stats_msg, parse_mode="Markdown")
             return
         elif text == "📁 my files":
             user_dir = get_user_directory(cid)
             try:
                 files = os.listdir(user_dir)
                 if not files:
-                    bot.send_message(cid, "📁 Your directory is empty.")
+                    send_message(cid, "📁 Your directory is empty.")
                 else:
                     file_list = []
                     for f in files[:15]:  # Limit to 15 files
@@ -701,9 +3658,9 @@ def shell(m):
                     if len(files) > 15:
                         msg += f"\n\n... and {len(files) - 15} more files"
                     
-                    bot.send_message(cid, msg, parse_mode="Markdown")
+                    send_message(cid, msg, parse_mode="Markdown")
             except Exception as e:
-                bot.send_message(cid, f"❌ Error listing files: {e}")
+                send_message(cid, f"❌ Error listing files: {e}")
             return
         elif text == "ℹ️ my info":
             user_dir = get_user_directory(cid)
@@ -723,70 +3680,58 @@ def shell(m):
 
 ━━━━━━━━━━━━━━━━━━━━━━
 """
-            bot.send_message(cid, info_msg, parse_mode="Markdown")
+            send_message(cid, info_msg, parse_mode="Markdown")
             return
         elif text == "👑 admin panel":
             if is_admin(cid):
                 admin_panel(m)
             else:
-                bot.send_message(cid, "❌ Admin only feature!")
+                send_message(cid, "❌ Admin only feature!")
             return
         elif text == "📈 performance":
             if is_admin(cid):
                 show_performance(cid)
             else:
-                bot.send_message(cid, "❌ Admin only feature!")
+                send_message(cid, "❌ Admin only feature!")
             return
         else:
             text = quick_map[text]
     
     # Execute command
-    session_id = generate_session_id()
-    
-    bot.send_message(cid, f"```\n$ {text}\n```", parse_mode="Markdown")
-    run_cmd(text, cid, cid, session_id)
+    send_message(cid, f"```\n$ {text}\n```", parse_mode="Markdown")
+    schedule_command(text, cid, cid)
 
 def show_performance(cid):
     """Show performance metrics"""
     stats = get_system_stats()
-    
-    # Get process list
-    processes_list = []
-    for proc in psutil.process_iter(['pid', 'name', 'cpu_percent', 'memory_percent']):
-        try:
-            processes_list.append(proc.info)
-        except:
-            pass
-    
-    # Sort by CPU usage
-    processes_list.sort(key=lambda x: x['cpu_percent'], reverse=True)
+    top = process_tracker.latest()
     
     perf_msg = f"""
     📈 𝗣𝗘𝗥𝗙𝗢𝗥𝗠𝗔𝗡𝗖𝗘 𝗠𝗘𝗧𝗥𝗜𝗖𝗦 📈
 ▬▬▬▬▬▬▬▬▬▬▬▬▬▬▬▬▬▬▬
 🖥️  𝗖𝗣𝗨
 • 𝗨𝗦𝗔𝗚𝗘        : {stats['cpu']:.1f}%
-• 𝗖𝗢𝗥𝗘𝗦        : {psutil.cpu_count()}
+• 𝗖𝗢𝗥𝗘𝗦        : {stats['cpu_count']}
 
 💾  𝗠𝗘𝗠𝗢𝗥𝗬
-• 𝗧𝗢𝗧𝗔𝗟        : {psutil.virtual_memory().total / (1024**3):.1f} GB
-• 𝗨𝗦𝗘𝗗         : {psutil.virtual_memory().used / (1024**3):.1f} GB
-• 𝗔𝗩𝗔𝗜𝗟𝗔𝗕𝗟𝗘    : {psutil.virtual_memory().available / (1024**3):.1f} GB
+• 𝗧𝗢𝗧𝗔𝗟        : {stats['memory_total'] / (1024**3):.1f} GB
+• 𝗨𝗦𝗘𝗗         : {stats['memory_used'] / (1024**3):.1f} GB
+• 𝗔𝗩𝗔𝗜𝗟𝗔𝗕𝗟𝗘    : {stats['memory_available'] / (1024**3):.1f} GB
 
 💿  𝗗𝗜𝗦𝗞
-• 𝗧𝗢𝗧𝗔𝗟        : {psutil.disk_usage('/').total / (1024**3):.1f} GB
-• 𝗨𝗦𝗘𝗗         : {psutil.disk_usage('/').used / (1024**3):.1f} GB
-• 𝗙𝗥𝗘𝗘         : {psutil.disk_usage('/').free / (1024**3):.1f} GB
+• 𝗧𝗢𝗧𝗔𝗟        : {stats['disk_total'] / (1024**3):.1f} GB
+• 𝗨𝗦𝗘𝗗         : {stats['disk_used'] / (1024**3):.1f} GB
+• 𝗙𝗥𝗘𝗘         : {stats['disk_free'] / (1024**3):.1f} GB
 
 ━━━━━━━━━━━━━━━━━━━━━━━━━━━━
          🔝 𝗧𝗢𝗣 𝗣𝗥𝗢𝗖𝗘𝗦𝗦𝗘𝗦
 ━━━━━━━━━━━━━━━━━━━━━━━━━━━━
 """
     
-    for proc in processes_list[:5]:
-        perf_msg += f"• {proc['name']}: {proc['cpu_percent']:.1f}% CPU, {proc['memory_percent']:.1f}% MEM\n"
+    for proc in top['cpu'][:5]:
+        perf_msg += f"• {proc['name']}: {proc['cpu']:.1f}% CPU, {proc['memory']:.1f}% MEM\n"
     
-    bot.send_message(cid, perf_msg, parse_mode="Markdown")
+    send_message(cid, perf_msg, parse_mode="Markdown")
 
 # ========== CALLBACK HANDLERS ==========
 @bot.callback_query_handler(func=lambda call: True)
@@ -821,9 +3766,10 @@ def callback_handler(call):
             processes.clear()
             input_wait.clear()
             active_sessions.clear()
+            scheduler.clear()
             
             bot.answer_callback_query(call.id, f"✅ Stopped {stopped} processes")
-            bot.send_message(cid, f"🛑 Stopped all {stopped} processes")
+            send_message(cid, f"🛑 Stopped all {stopped} processes")
             add_system_alert("WARNING", f"Admin {cid} stopped all processes")
         
         elif call.data == "admin_list":
@@ -838,7 +3784,7 @@ def callback_handler(call):
             main_admin_text = f"👑 Main Admin: `{MAIN_ADMIN_ID}`"
             
             bot.answer_callback_query(call.id)
-            bot.send_message(cid, f"*ADMIN LIST*\n\n{main_admin_text}\n\n*Other Admins:*\n{admin_list_text if admin_list_text else 'None'}", parse_mode="Markdown")
+            send_message(cid, f"*ADMIN LIST*\n\n{main_admin_text}\n\n*Other Admins:*\n{admin_list_text if admin_list_text else 'None'}", parse_mode="Markdown")
         
         elif call.data == "add_admin":
             if not is_admin(cid):
@@ -848,8 +3794,8 @@ def callback_handler(call):
                 bot.answer_callback_query(call.id, "❌ Main admin only!")
                 return
             
-            msg = bot.send_message(cid, "Send the user ID to add as admin (numeric ID):")
-            bot.register_next_step_handler(msg, add_admin_step)
+            send_message(cid, "Send the user ID to add as admin (numeric ID):")
+            bot.register_next_step_handler_by_chat_id(cid, add_admin_step)
             bot.answer_callback_query(call.id)
         
         elif call.data == "remove_admin":
@@ -860,8 +3806,8 @@ def callback_handler(call):
                 bot.answer_callback_query(call.id, "❌ Main admin only!")
                 return
             
-            msg = bot.send_message(cid, "Send the user ID to remove from admins:")
-            bot.register_next_step_handler(msg, remove_admin_step)
+            send_message(cid, "Send the user ID to remove from admins:")
+            bot.register_next_step_handler_by_chat_id(cid, remove_admin_step)
             bot.answer_callback_query(call.id)
         
         elif call.data == "list_files":
@@ -873,7 +3819,7 @@ def callback_handler(call):
                 user_dir = get_user_directory(cid)
                 files = os.listdir(user_dir)
                 if not files:
-                    bot.send_message(cid, "📁 Directory is empty.")
+                    send_message(cid, "📁 Directory is empty.")
                 else:
                     file_list = []
                     for f in files[:20]:
@@ -888,9 +3834,9 @@ def callback_handler(call):
                     if len(files) > 20:
                         msg += f"\n\n... and {len(files)-20} more"
                     
-                    bot.send_message(cid, msg, parse_mode="Markdown")
+                    send_message(cid, msg, parse_mode="Markdown")
             except Exception as e:
-                bot.send_message(cid, f"❌ Error: {e}")
+                send_message(cid, f"❌ Error: {e}")
             bot.answer_callback_query(call.id)
         
         elif call.data == "clean_logs":
@@ -923,7 +3869,7 @@ def callback_handler(call):
                         cleaned_processes += 1
             
             bot.answer_callback_query(call.id, f"✅ Cleaned {cleaned_sessions} sessions, {cleaned_processes} processes")
-            bot.send_message(cid, f"🧹 *Cleanup Complete*\n\n• Removed {cleaned_sessions} stale sessions\n• Removed {cleaned_processes} zombie processes", parse_mode="Markdown")
+            send_message(cid, f"🧹 *Cleanup Complete*\n\n• Removed {cleaned_sessions} stale sessions\n• Removed {cleaned_processes} zombie processes", parse_mode="Markdown")
         
         elif call.data == "user_stats":
             if not is_admin(cid):
@@ -933,14 +3879,17 @@ def callback_handler(call):
                 bot.answer_callback_query(call.id, "❌ Main admin only!")
                 return
             
-            stats_msg = "*USER STATISTICS*\n\n"
-            for user_id, data in user_stats.items():
-                stats_msg += f"👤 User {user_id} (@{data.get('username', 'N/A')}):\n"
+            # Pending changes first, so the query sees current numbers
+            flush_data()
+            recent, total = get_storage().recent_users(USER_STATS_LIMIT)
+            stats_msg = f"*USER STATISTICS* ({len(recent)} most recent of {total})\n\n"
+            for data in recent:
+                stats_msg += f"👤 User {data.get('user_id')} (@{data.get('username') or 'N/A'}):\n"
                 stats_msg += f"  • Commands: {data.get('commands', 0)}\n"
-                stats_msg += f"  • First seen: {data.get('first_seen', 'N/A')[:10]}\n"
-                stats_msg += f"  • Last seen: {data.get('last_seen', 'N/A')[:10]}\n\n"
+                stats_msg += f"  • First seen: {(data.get('first_seen') or 'N/A')[:10]}\n"
+                stats_msg += f"  • Last seen: {(data.get('last_seen') or 'N/A')[:10]}\n\n"
             
-            bot.send_message(cid, stats_msg, parse_mode="Markdown")
+            send_message(cid, stats_msg, parse_mode="Markdown")
             bot.answer_callback_query(call.id)
         
         elif call.data == "system_alerts":
@@ -952,14 +3901,14 @@ def callback_handler(call):
                 return
             
             if not system_alerts:
-                bot.send_message(cid, "✅ No system alerts")
+                send_message(cid, "✅ No system alerts")
             else:
                 alerts_msg = "*SYSTEM ALERTS*\n\n"
-                for alert in system_alerts[-10:]:  # Show last 10 alerts
+                for alert in list(system_alerts)[-10:]:  # Show last 10 alerts
                     emoji = "⚠️" if alert['type'] == "WARNING" else "ℹ️" if alert['type'] == "INFO" else "❌"
                     alerts_msg += f"{emoji} [{alert['time']}] {alert['message']}\n"
                 
-                bot.send_message(cid, alerts_msg, parse_mode="Markdown")
+                send_message(cid, alerts_msg, parse_mode="Markdown")
             bot.answer_callback_query(call.id)
         
         elif call.data == "performance":
@@ -969,6 +3918,27 @@ def callback_handler(call):
             show_performance(cid)
             bot.answer_callback_query(call.id)
         
+        elif call.data == "sessions":
+            if not is_admin(cid):
+                bot.answer_callback_query(call.id, "❌ Not authorized!")
+                return
+            text, markup = render_sessions()
+            send_message(cid, text, parse_mode="Markdown", reply_markup=markup)
+            bot.answer_callback_query(call.id)
+
+        elif call.data.startswith("sessions_"):
+            if not is_admin(cid):
+                bot.answer_callback_query(call.id, "❌ Not authorized!")
+                return
+            sort = call.data[9:]
+            if sort not in SESSION_SORTS:
+                bot.answer_callback_query(call.id)
+                return
+            text, markup = render_sessions(sort)
+            outbox.call(cid, bot.edit_message_text, text, cid, call.message.message_id,
+                        parse_mode="Markdown", reply_markup=markup)
+            bot.answer_callback_query(call.id)
+
         elif call.data == "authorize_user":
             if not is_admin(cid):
                 bot.answer_callback_query(call.id, "❌ Not authorized!")
@@ -977,8 +3947,8 @@ def callback_handler(call):
                 bot.answer_callback_query(call.id, "❌ Main admin only!")
                 return
             
-            msg = bot.send_message(cid, "Send the user ID to authorize:")
-            bot.register_next_step_handler(msg, authorize_user_step)
+            send_message(cid, "Send the user ID to authorize:")
+            bot.register_next_step_handler_by_chat_id(cid, authorize_user_step)
             bot.answer_callback_query(call.id)
         
         elif call.data == "deauthorize_user":
@@ -989,10 +3959,33 @@ def callback_handler(call):
                 bot.answer_callback_query(call.id, "❌ Main admin only!")
                 return
             
-            msg = bot.send_message(cid, "Send the user ID to deauthorize:")
-            bot.register_next_step_handler(msg, deauthorize_user_step)
+            send_message(cid, "Send the user ID to deauthorize:")
+            bot.register_next_step_handler_by_chat_id(cid, deauthorize_user_step)
             bot.answer_callback_query(call.id)
         
+        elif call.data.startswith("tail_"):
+            _, prefix, offset = call.data.split("_", 2)
+            session_id, entry = find_output_history(cid, prefix)
+            if entry is None:
+                bot.answer_callback_query(call.id, "❌ Output no longer available!")
+                return
+
+            text, offset, markup = render_output_page(session_id, entry, int(offset))
+            tail_cursors[cid] = (session_id, offset)
+            outbox.call(cid, bot.edit_message_text, text, cid, call.message.message_id,
+                        parse_mode="Markdown", reply_markup=markup)
+            bot.answer_callback_query(call.id)
+
+        elif call.data.startswith("rerun_"):
+            entry = command_history.get(cid, int(call.data[6:]))
+            if entry is None:
+                bot.answer_callback_query(call.id, "❌ History entry no longer available!")
+                return
+
+            bot.answer_callback_query(call.id, "🔁 Running again")
+            send_message(cid, f"```\n$ {entry['command']}\n```", parse_mode="Markdown")
+            schedule_command(entry['command'], cid, cid)
+
         elif call.data.startswith("view_"):
             filename = call.data[5:]
             safe_path = sanitize_path(cid, filename)
@@ -1010,10 +4003,10 @@ def callback_handler(call):
                     content = f.read(3500)  # Limit to 3500 chars
                 
                 if len(content) < 3500:
-                    bot.send_message(cid, f"```\n{content}\n```", parse_mode="Markdown")
+                    send_message(cid, f"```\n{content}\n```", parse_mode="Markdown")
                 else:
-                    bot.send_message(cid, f"```\n{content}\n```", parse_mode="Markdown")
-                    bot.send_message(cid, "📝 File truncated (max 3500 chars shown)")
+                    send_message(cid, f"```\n{content}\n```", parse_mode="Markdown")
+                    send_message(cid, "📝 File truncated (max 3500 chars shown)")
                 
                 bot.answer_callback_query(call.id)
             except Exception as e:
@@ -1050,7 +4043,7 @@ def callback_handler(call):
 • /nano {filename} - Edit file
 • view_{filename} - View content
 """
-                    bot.send_message(cid, info_msg, parse_mode="Markdown")
+                    send_message(cid, info_msg, parse_mode="Markdown")
                 else:
                     # List directory
                     files = os.listdir(safe_path)
@@ -1067,7 +4060,7 @@ def callback_handler(call):
                     if len(files) > 15:
                         dir_msg += f"\n... and {len(files)-15} more"
                     
-                    bot.send_message(cid, dir_msg, parse_mode="Markdown")
+                    send_message(cid, dir_msg, parse_mode="Markdown")
                 
                 bot.answer_callback_query(call.id)
             except Exception as e:
@@ -1086,16 +4079,16 @@ def add_admin_step(m):
     try:
         new_admin = int(m.text.strip())
         if new_admin in admins:
-            bot.send_message(cid, f"❌ Admin {new_admin} already exists!")
+            send_message(cid, f"❌ Admin {new_admin} already exists!")
         else:
             admins.add(new_admin)
             save_data()
-            bot.send_message(cid, f"✅ Added admin: `{new_admin}`", parse_mode="Markdown")
+            send_message(cid, f"✅ Added admin: `{new_admin}`", parse_mode="Markdown")
             add_system_alert("INFO", f"Added new admin: {new_admin}")
     except ValueError:
-        bot.send_message(cid, "❌ Invalid user ID. Please send numeric ID only.")
+        send_message(cid, "❌ Invalid user ID. Please send numeric ID only.")
     except Exception as e:
-        bot.send_message(cid, f"❌ Error: {e}")
+        send_message(cid, f"❌ Error: {e}")
 
 def remove_admin_step(m):
     cid = m.chat.id
@@ -1106,20 +4099,20 @@ def remove_admin_step(m):
         admin_id = int(m.text.strip())
         
         if admin_id == MAIN_ADMIN_ID:
-            bot.send_message(cid, "❌ Cannot remove the main admin.")
+            send_message(cid, "❌ Cannot remove the main admin.")
             return
         
         if admin_id in admins:
             admins.remove(admin_id)
             save_data()
-            bot.send_message(cid, f"✅ Removed admin: `{admin_id}`", parse_mode="Markdown")
+            send_message(cid, f"✅ Removed admin: `{admin_id}`", parse_mode="Markdown")
             add_system_alert("INFO", f"Removed admin: {admin_id}")
         else:
-            bot.send_message(cid, f"❌ Admin ID `{admin_id}` not found.", parse_mode="Markdown")
+            send_message(cid, f"❌ Admin ID `{admin_id}` not found.", parse_mode="Markdown")
     except ValueError:
-        bot.send_message(cid, "❌ Invalid user ID. Please send numeric ID only.")
+        send_message(cid, "❌ Invalid user ID. Please send numeric ID only.")
     except Exception as e:
-        bot.send_message(cid, f"❌ Error: {e}")
+        send_message(cid, f"❌ Error: {e}")
 
 def authorize_user_step(m):
     cid = m.chat.id
@@ -1130,12 +4123,12 @@ def authorize_user_step(m):
         user_id = int(m.text.strip())
         authorized_users.add(user_id)
         save_data()
-        bot.send_message(cid, f"✅ Authorized user: `{user_id}`", parse_mode="Markdown")
+        send_message(cid, f"✅ Authorized user: `{user_id}`", parse_mode="Markdown")
         add_system_alert("INFO", f"Authorized user: {user_id}")
     except ValueError:
-        bot.send_message(cid, "❌ Invalid user ID. Please send numeric ID only.")
+        send_message(cid, "❌ Invalid user ID. Please send numeric ID only.")
     except Exception as e:
-        bot.send_message(cid, f"❌ Error: {e}")
+        send_message(cid, f"❌ Error: {e}")
 
 def deauthorize_user_step(m):
     cid = m.chat.id
@@ -1147,17 +4140,607 @@ def deauthorize_user_step(m):
         if user_id in authorized_users:
             authorized_users.remove(user_id)
             save_data()
-            bot.send_message(cid, f"✅ Deauthorized user: `{user_id}`", parse_mode="Markdown")
+            send_message(cid, f"✅ Deauthorized user: `{user_id}`", parse_mode="Markdown")
             add_system_alert("INFO", f"Deauthorized user: {user_id}")
         else:
-            bot.send_message(cid, f"❌ User ID `{user_id}` not found.", parse_mode="Markdown")
+            send_message(cid, f"❌ User ID `{user_id}` not found.", parse_mode="Markdown")
     except ValueError:
-        bot.send_message(cid, "❌ Invalid user ID. Please send numeric ID only.")
+        send_message(cid, "❌ Invalid user ID. Please send numeric ID only.")
     except Exception as e:
-        bot.send_message(cid, f"❌ Error: {e}")
+        send_message(cid, f"❌ Error: {e}")
 
 # ========== WEB INTERFACE ==========
+class FileView:
+    """Read-only mmap of a file with a sparse line-offset index.
+
+    Offsets are cached every EDITOR_LINE_STRIDE lines as they are first
+    reached, so a line window is found by scanning forward from the nearest
+    checkpoint instead of from the start of the file.
+    """
+
+    def __init__(self, path, st):
+        self.key = (st.st_ino, st.st_size, st.st_mtime_ns)
+        self.size = st.st_size
+        self.etag = file_etag(st)
+        self.checkpoints = [0]
+        self.lock = threading.Lock()
+        self.refs = 0  # readers holding the view, guarded by file_views_lock
+        self.retired = False
+        if self.size:
+            with open(path, "rb") as f:
+                self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self.data = b""
+
+    def close(self):
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+
+    def retire(self):
+        """Close once the last reader lets go (file_views_lock held)"""
+        self.retired = True
+        if not self.refs:
+            self.close()
+
+    def line_offset(self, line):
+        """Byte offset where line (0-based) starts, or None past the end of the file"""
+        with self.lock:
+            index = min(line // EDITOR_LINE_STRIDE, len(self.checkpoints) - 1)
+            current, pos = index * EDITOR_LINE_STRIDE, self.checkpoints[index]
+            while current < line:
+                # Advance to the next checkpoint or to the target, whichever comes first
+                step = min(EDITOR_LINE_STRIDE - current % EDITOR_LINE_STRIDE, line - current)
+                pos = self._skip_lines(pos, step)
+                if pos is None or pos >= self.size:
+                    return None
+                current += step
+                if current == len(self.checkpoints) * EDITOR_LINE_STRIDE:
+                    self.checkpoints.append(pos)
+            return pos
+
+    def _skip_lines(self, pos, count):
+        """Offset just past the count-th newline from pos, or None if the file has fewer"""
+        while count:
+            chunk = self.data[pos:pos + EDITOR_CHUNK_SIZE]
+            if not chunk:
+                return None
+            found = chunk.count(b"\n")
+            if found < count:
+                pos += len(chunk)
+                count -= found
+                continue
+            pos += sum(len(part) for part in chunk.split(b"\n", count)[:-1]) + count
+            count = 0
+        return pos
+
+    def lines(self, start, count):
+        """(text, eof) for up to count lines from line start"""
+        begin = self.line_offset(start)
+        if begin is None or (begin == 0 and not self.size):
+            return "", True
+        end = self.line_offset(start + count)
+        text = self.data[begin:self.size if end is None else end].decode("utf-8", errors="replace")
+        return text, end is None
+
+    def line_start(self, line):
+        """Byte offset of line, or the file size for lines at or past the end"""
+        offset = self.line_offset(line)
+        return self.size if offset is None else offset
+
+    def chunks(self, start, stop):
+        for pos in range(start, stop, EDITOR_CHUNK_SIZE):
+            yield self.data[pos:min(pos + EDITOR_CHUNK_SIZE, stop)]
+
+file_views = collections.OrderedDict()  # path -> FileView, LRU order
+file_views_lock = threading.Lock()
+file_save_locks = {}  # path -> lock serializing editor saves
+
+def file_etag(st):
+    """Strong validator for a file's current contents, from its inode, size and mtime"""
+    return f"{st.st_ino:x}-{st.st_size:x}-{st.st_mtime_ns:x}"
+
+def get_file_view(path):
+    """Cached FileView of path, reopened when the file has changed.
+
+    The caller holds a reference until release_file_view(); views that are
+    evicted or replaced meanwhile are only unmapped once released.
+    """
+    st = os.stat(path)
+    with file_views_lock:
+        view = file_views.get(path)
+        if view is None or view.key != (st.st_ino, st.st_size, st.st_mtime_ns):
+            if view is not None:
+                view.retire()
+            view = file_views[path] = FileView(path, st)
+            while len(file_views) > MAX_FILE_VIEWS:
+                file_views.popitem(last=False)[1].retire()
+        file_views.move_to_end(path)
+        view.refs += 1
+        return view
+
+def release_file_view(view):
+    with file_views_lock:
+        view.refs -= 1
+        if view.retired and not view.refs:
+            view.close()
+
+@contextlib.contextmanager
+def file_view(path):
+    """get_file_view() for the duration of a with block"""
+    view = get_file_view(path)
+    try:
+        yield view
+    finally:
+        release_file_view(view)
+
+def close_file_view(path):
+    """Drop the cached view of path once a save has replaced the file"""
+    with file_views_lock:
+        view = file_views.pop(path, None)
+        if view is not None:
+            view.retire()
+
+class StaleWrite(Exception):
+    """The file no longer matches the ETag the edit was based on"""
+
+class VersionHistory:
+    """Prior versions of one file, kept as compressed reverse deltas in the owner's version store.
+
+    Entry n holds the delta that turns the content written by save n back
+    into the content it replaced, so storage grows with the size of the
+    edits rather than the file. The chain is anchored to a compressed
+    snapshot of the last saved content (head.z, one per file), and
+    restoring version n applies the deltas of the newest save down to n to
+    it. `head` is the ETag that save produced; when the next save finds the
+    file changed by something else in between, that change is recorded as
+    a version of its own so the older chain still applies.
+    """
+
+    DELTA = struct.Struct("<QQI")  # offset and length in the newer content, length of the older bytes
+
+    def __init__(self, user_id, name, relative=None):
+        self.user_id = user_id
+        self.dir = os.path.join(version_root(user_id), name)
+        self.index_path = os.path.join(self.dir, "index.json")
+        self.index = {'path': relative, 'head': None, 'head_bytes': 0, 'next': 1, 'versions': []}
+        try:
+            with open(self.index_path) as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            return
+        if not isinstance(index, dict) or not isinstance(index.get('versions'), list):
+            return
+        # Nothing read back is trusted: entry numbers become file names
+        versions = [entry for entry in index['versions'] if self._valid(entry)]
+        head, head_bytes = index.get('head'), index.get('head_bytes')
+        self.index = {
+            'path': index.get('path') if isinstance(index.get('path'), str) else relative,
+            'head': head if isinstance(head, str) else None,
+            'head_bytes': head_bytes if type(head_bytes) is int and head_bytes >= 0 else 0,
+            'next': max([entry['n'] + 1 for entry in versions] + [index['next'] if type(index.get('next')) is int else 1]),
+            'versions': versions,
+        }
+
+    @staticmethod
+    def _valid(entry):
+        return (isinstance(entry, dict) and type(entry.get('n')) is int and entry['n'] > 0
+                and all(type(entry.get(key)) in (int, float) and entry[key] >= 0 for key in ('time', 'size', 'bytes')))
+
+    @classmethod
+    def of(cls, user_id, path):
+        relative = os.path.relpath(path, get_user_directory(user_id))
+        return cls(user_id, hashlib.sha1(relative.encode()).hexdigest()[:16], relative)
+
+    @property
+    def versions(self):
+        return self.index['versions']
+
+    def _delta_path(self, n):
+        return os.path.join(self.dir, f"{n}.z")
+
+    @property
+    def _head_path(self):
+        return os.path.join(self.dir, "head.z")
+
+    def _head_content(self):
+        """The last saved content, or None without a snapshot"""
+        try:
+            with open(self._head_path, "rb") as f:
+                return zlib.decompress(f.read())
+        except (OSError, zlib.error):
+            return None
+
+    def _save_index(self):
+        os.makedirs(self.dir, exist_ok=True)
+        write_file_atomic(self.index_path, json.dumps(self.index).encode())
+
+    def is_current(self, etag):
+        return self.index['head'] == etag
+
+    def restorable(self, etag):
+        """Whether versions can be rebuilt: from the snapshot, or from a file still at head"""
+        return os.path.exists(self._head_path) or self.is_current(etag)
+
+    def record(self, old_data, old_etag, ops, new_etag, snapshot):
+        """Store the reverse delta of a save that replaced old_etag with new_etag (user's version lock held).
+
+        old_data is the replaced content and snapshot the compressed new one.
+        """
+        version_store_bytes(self.user_id)
+        os.makedirs(self.dir, exist_ok=True)
+        if not self.is_current(old_etag):
+            base = self._head_content()
+            if base is None:
+                self._drop(len(self.versions))
+            else:
+                # Changed outside the editor since the last save: keep that change as a version
+                prefix, suffix = common_affixes(base, old_data)
+                self._append([(prefix, len(old_data) - prefix - suffix, base[prefix:len(base) - suffix])],
+                             len(base), external=True)
+        self._append(ops, len(old_data))
+
+        write_file_atomic(self._head_path, snapshot)
+        version_bytes[self.user_id] += len(snapshot) - self.index['head_bytes']
+        self.index['head'] = new_etag
+        self.index['head_bytes'] = len(snapshot)
+        self._drop(len(self.versions) - VERSION_MAX_PER_FILE)
+        self._save_index()
+        prune_versions(self.user_id)
+
+    def _append(self, ops, old_size, external=False):
+        payload = zlib.compress(b"".join(self.DELTA.pack(offset, length, len(old)) + old
+                                         for offset, length, old in ops))
+        n = self.index['next']
+        write_file_atomic(self._delta_path(n), payload)
+        entry = {'n': n, 'time': time.time(), 'size': old_size, 'bytes': len(payload)}
+        if external:
+            entry['external'] = True
+        self.versions.append(entry)
+        version_bytes[self.user_id] += len(payload)
+        self.index['next'] = n + 1
+
+    def _drop(self, count):
+        """Forget the count oldest versions"""
+        for entry in self.versions[:max(0, count)]:
+            with contextlib.suppress(OSError):
+                os.remove(self._delta_path(entry['n']))
+            version_bytes[self.user_id] -= entry['bytes']
+        del self.versions[:max(0, count)]
+        if count > 0 and not self.versions:
+            # Nothing left to rebuild from the snapshot
+            with contextlib.suppress(OSError):
+                os.remove(self._head_path)
+            version_bytes[self.user_id] -= self.index['head_bytes']
+            self.index['head'], self.index['head_bytes'] = None, 0
+
+    def content(self, n, current):
+        """Content of version n, rebuilt from the head snapshot.
+
+        Stores written before snapshots existed fall back to the current
+        content (bytes or mmap) and its ETag, which must then match head.
+        """
+        if not any(entry['n'] == n for entry in self.versions):
+            raise KeyError(n)
+        base = self._head_content()
+        if base is None:
+            data, etag = current
+            if not self.is_current(etag):
+                raise ValueError("file was changed outside the editor since its last saved version")
+            base = data
+        content = bytearray(base)
+        for entry in reversed(self.versions):
+            if entry['n'] < n:
+                break
+            with open(self._delta_path(entry['n']), "rb") as f:
+                payload = zlib.decompress(f.read())
+            ops, pos = [], 0
+            while pos < len(payload):
+                offset, length, size = self.DELTA.unpack_from(payload, pos)
+                pos += self.DELTA.size
+                ops.append((offset, length, payload[pos:pos + size]))
+                pos += size
+            for offset, length, old in reversed(ops):
+                content[offset:offset + length] = old
+        return bytes(content)
+
+def version_root(user_id):
+    return os.path.join(VERSIONS_DIR, str(user_id))
+
+version_locks = {}  # user_id -> lock serializing writes to the user's version store
+version_bytes = {}  # user_id -> compressed delta bytes in the store, counted on first use
+
+def version_store_bytes(user_id):
+    """Size of a user's version store (version lock held)"""
+    if user_id not in version_bytes:
+        root = version_root(user_id)
+        names = os.listdir(root) if os.path.isdir(root) else []
+        histories = [VersionHistory(user_id, name) for name in names]
+        version_bytes[user_id] = sum(history.index['head_bytes'] + sum(entry['bytes'] for entry in history.versions)
+                                     for history in histories)
+    return version_bytes[user_id]
+
+def prune_versions(user_id):
+    """Drop the oldest versions across a user's files until the store fits VERSION_MAX_BYTES"""
+    total = version_store_bytes(user_id)
+    if total <= VERSION_MAX_BYTES:
+        return
+    root = version_root(user_id)
+    histories, entries = {}, []
+    for name in os.listdir(root):
+        history = histories[name] = VersionHistory(user_id, name)
+        entries.extend((entry['time'], name, entry['bytes']) for entry in history.versions)
+    drop = collections.Counter()
+    for _, name, size in sorted(entries):
+        if total <= VERSION_MAX_BYTES:
+            break
+        drop[name] += 1
+        total -= size
+        if drop[name] == len(histories[name].versions):
+            total -= histories[name].index['head_bytes']
+    for name, count in drop.items():
+        histories[name]._drop(count)
+        histories[name]._save_index()
+
+def replace_file(path, write):
+    """Atomically replace path with what write(f) produces, keeping its permissions.
+
+    The content goes to a hidden temp file in the same directory, is fsynced
+    and renamed over path, so readers (and mmaps of the old file) only ever
+    see the complete old or the complete new version. Returns the new stat.
+    """
+    directory, name = os.path.split(path)
+    tmp_file = os.path.join(directory, f".{name}.{uuid.uuid4().hex[:8]}.tmp")
+    try:
+        with open(tmp_file, "wb") as f:
+            write(f)
+            f.flush()
+            os.fsync(f.fileno())
+        with contextlib.suppress(FileNotFoundError):
+            os.chmod(tmp_file, stat.S_IMODE(os.stat(path).st_mode))
+        os.replace(tmp_file, path)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(tmp_file)
+        raise
+    dir_fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+    return os.stat(path)
+
+def common_affixes(old, new):
+    """Lengths of the common prefix and (non-overlapping) common suffix of two byte strings"""
+    limit = min(len(old), len(new))
+    prefix = 0
+    while prefix < limit:
+        step = min(EDITOR_CHUNK_SIZE, limit - prefix)
+        if old[prefix:prefix + step] != new[prefix:prefix + step]:
+            while old[prefix] == new[prefix]:
+                prefix += 1
+            break
+        prefix += step
+    limit -= prefix
+    suffix = 0
+    while suffix < limit:
+        step = min(EDITOR_CHUNK_SIZE, limit - suffix)
+        if old[len(old) - suffix - step:len(old) - suffix] != new[len(new) - suffix - step:len(new) - suffix]:
+            while old[len(old) - suffix - 1] == new[len(new) - suffix - 1]:
+                suffix += 1
+            break
+        suffix += step
+    return prefix, suffix
+
+class SnapshotWriter:
+    """File wrapper that compresses everything written through it"""
+
+    def __init__(self, f):
+        self.f = f
+        self.compressor = zlib.compressobj()
+        self.parts = []
+
+    def write(self, data):
+        self.f.write(data)
+        self.parts.append(self.compressor.compress(data))
+
+    def snapshot(self):
+        return b"".join(self.parts) + self.compressor.flush()
+
+def save_file_version(user_id, path, view, write, ops):
+    """Write a new version of path over view and record the reverse delta ops; returns the new ETag"""
+    writers = []
+
+    def write_snapshot(f):
+        writers.append(SnapshotWriter(f))
+        write(writers[-1])
+
+    st = replace_file(path, write_snapshot)
+    close_file_view(path)
+    etag = file_etag(st)
+    with version_locks.setdefault(user_id, threading.Lock()):
+        VersionHistory.of(user_id, path).record(view.data, view.etag, ops, etag, writers[-1].snapshot())
+    return etag
+
+def apply_line_edits(user_id, path, etag, edits):
+    """Apply line-range edits made against version etag of path; returns the new ETag.
+
+    Each edit replaces lines [start, end) of that version with text. The new
+    file is written beside the old one and renamed over it, and the replaced
+    bytes are kept as a reverse delta in the version history. Raises
+    StaleWrite if the file changed.
+    """
+    with file_save_locks.setdefault(path, threading.Lock()), file_view(path) as view:
+        if view.etag != etag:
+            raise StaleWrite(view.etag)
+        edits = sorted(edits, key=lambda edit: edit['start'])
+        spans = [(view.line_start(edit['start']), view.line_start(edit['end']), edit['text'].encode()) for edit in edits]
+        if not spans:
+            return view.etag
+        for (_, end, _), (start, _, _) in zip(spans, spans[1:]):
+            if start < end:
+                raise ValueError("edits overlap")
+
+        ops, shift = [], 0
+        for start, end, text in spans:
+            ops.append((start + shift, len(text), view.data[start:end]))
+            shift += len(text) - (end - start)
+
+        def write(f):
+            pos = 0
+            for start, end, text in spans:
+                for chunk in view.chunks(pos, start):
+                    f.write(chunk)
+                f.write(text)
+                pos = end
+            for chunk in view.chunks(pos, view.size):
+                f.write(chunk)
+        return save_file_version(user_id, path, view, write, ops)
+
+def write_file_content(user_id, path, content, etag=None):
+    """Replace path with content as a new version; returns the new ETag.
+
+    Raises StaleWrite if etag is given and the file no longer matches it.
+    """
+    with file_save_locks.setdefault(path, threading.Lock()), file_view(path) as view:
+        if etag is not None and view.etag != etag:
+            raise StaleWrite(view.etag)
+        prefix, suffix = common_affixes(view.data, content)
+        ops = [(prefix, len(content) - prefix - suffix, view.data[prefix:view.size - suffix])]
+        return save_file_version(user_id, path, view, lambda f: f.write(content), ops)
+
+def file_versions(user_id, path):
+    """(versions newest first, whether they can be restored)"""
+    history = VersionHistory.of(user_id, path)
+    return list(reversed(history.versions)), history.restorable(file_etag(os.stat(path)))
+
+def version_content(user_id, path, n):
+    """Content of version n of path; raises KeyError for unknown versions"""
+    with file_view(path) as view:
+        return VersionHistory.of(user_id, path).content(n, (view.data, view.etag))
+
+def restore_version(user_id, path, n):
+    """Make version n the current content, itself saved as a new version; returns the new ETag"""
+    with file_view(path) as view:
+        content = VersionHistory.of(user_id, path).content(n, (view.data, view.etag))
+    return write_file_content(user_id, path, content, etag=view.etag)
+
+def edit_session_file(sid):
+    """Absolute path of an edit session's file, or None if expired or outside the user's directory"""
+    session_data = edit_sessions.get(sid)
+    if session_data is None:
+        return None
+    abs_path = os.path.abspath(session_data.get("file"))
+    if not abs_path.startswith(os.path.abspath(get_user_directory(session_data.get("user_id")))):
+        return None
+    return abs_path
+
+@app.route("/edit/<sid>/content", methods=["GET", "PATCH"])
+@timed(editor_seconds, lambda sid: "patch" if request.method == "PATCH" else "content")
+def edit_content(sid):
+    """File content for the editor: a line window (?start=&lines=) or bytes, honouring Range.
+
+    PATCH applies {"edits": [{"start", "end", "text"}, ...]} line-range
+    edits; If-Match must carry the ETag the edits were made against.
+    """
+    abs_path = edit_session_file(sid)
+    if abs_path is None:
+        return jsonify({'error': "invalid or expired session"}), 404
+
+    if request.method == "PATCH":
+        return patch_content(sid, abs_path)
+    try:
+        view = get_file_view(abs_path)
+    except (OSError, ValueError) as e:
+        return jsonify({'error': str(e)}), 404
+    try:
+        response = view_response(view)
+    except BaseException:
+        release_file_view(view)
+        raise
+    # A streamed body keeps reading the mapping after the view returns
+    response.call_on_close(lambda: release_file_view(view))
+    return response
+
+def view_response(view):
+    if 'start' in request.args:
+        try:
+            start = max(0, int(request.args['start']))
+            count = min(max(1, int(request.args.get('lines', EDITOR_WINDOW_LINES))), EDITOR_WINDOW_LINES * 10)
+        except ValueError:
+            response = jsonify({'error': "invalid start or lines"})
+            response.status_code = 400
+            return response
+        text, eof = view.lines(start, count)
+        lines = text.count("\n") + (1 if text and not text.endswith("\n") else 0)
+        response = jsonify({'start': start, 'lines': lines, 'text': text, 'eof': eof, 'size': view.size})
+        response.set_etag(view.etag)
+        return response
+
+    status, start, stop = 200, 0, view.size
+    headers = {'Accept-Ranges': 'bytes', 'ETag': f'"{view.etag}"', 'Cache-Control': 'no-cache'}
+    if request.range is not None:
+        span = request.range.range_for_length(view.size)
+        if span is None:
+            headers['Content-Range'] = f"bytes */{view.size}"
+            return app.response_class("", status=416, headers=headers)
+        (start, stop), status = span, 206
+        headers['Content-Range'] = f"bytes {start}-{stop - 1}/{view.size}"
+    headers['Content-Length'] = str(stop - start)
+    return app.response_class(view.chunks(start, stop), status=status, headers=headers,
+                              mimetype='text/plain', direct_passthrough=True)
+
+@app.route("/edit/<sid>/versions")
+@app.route("/edit/<sid>/versions/<int:n>")
+@timed(editor_seconds, lambda sid, n=None: "versions")
+def edit_versions(sid, n=None):
+    """Saved versions of the session's file, or the content of version n"""
+    abs_path = edit_session_file(sid)
+    if abs_path is None:
+        return jsonify({'error': "invalid or expired session"}), 404
+    user_id = edit_sessions[sid]['user_id']
+    try:
+        if n is None:
+            versions, restorable = file_versions(user_id, abs_path)
+            return jsonify({'versions': versions if restorable else [], 'restorable': restorable})
+        return app.response_class(version_content(user_id, abs_path, n), mimetype='text/plain')
+    except KeyError:
+        return jsonify({'error': f"no version {n}"}), 404
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 409
+    except OSError as e:
+        return jsonify({'error': str(e)}), 404
+
+def patch_content(sid, abs_path):
+    etags = list(request.if_match)
+    if len(etags) != 1:
+        return jsonify({'error': "If-Match with the file's ETag is required"}), 428
+    body = request.get_json(silent=True) or {}
+    edits = body.get('edits')
+    try:
+        if not isinstance(edits, list):
+            raise ValueError("edits must be a list")
+        for edit in edits:
+            if not (isinstance(edit.get('start'), int) and isinstance(edit.get('end'), int)
+                    and 0 <= edit['start'] <= edit['end'] and isinstance(edit.get('text'), str)):
+                raise ValueError("each edit needs 0 <= start <= end and a text string")
+        etag = apply_line_edits(edit_sessions[sid]['user_id'], abs_path, etags[0], edits)
+    except StaleWrite as e:
+        return jsonify({'error': "file changed since it was loaded", 'etag': str(e)}), 409
+    except (ValueError, AttributeError) as e:
+        return jsonify({'error': str(e)}), 400
+    except OSError as e:
+        return jsonify({'error': f"error saving file: {e}"}), 500
+
+    session_data = edit_sessions.get(sid)
+    if session_data is not None:
+        session_data['saved'] = True
+        session_data['save_time'] = time.time()
+    response = jsonify({'etag': etag, 'size': os.path.getsize(abs_path)})
+    response.set_etag(etag)
+    return response
+
 @app.route("/edit/<sid>", methods=["GET", "POST"])
+@timed(editor_seconds, lambda sid: "save" if request.method == "POST" else "load")
 def edit(sid):
     if sid not in edit_sessions:
         return """
@@ -1199,8 +4782,7 @@ def edit(sid):
     if request.method == "POST":
         try:
             code_content = request.form.get("code", "")
-            with open(abs_path, "w", encoding='utf-8') as f:
-                f.write(code_content)
+            write_file_content(user_id, abs_path, code_content.encode())
 
             # Don't delete session immediately, keep for 5 minutes
             session_data['saved'] = True
@@ -1246,11 +4828,13 @@ def edit(sid):
             </html>
             """
             
-    try:
-        with open(abs_path, "r", encoding='utf-8', errors='ignore') as f:
-            code = f.read()
-    except Exception as e:
-        code = f"# Error loading file: {e}\n# File may be binary or corrupted"
+    file_size = os.path.getsize(abs_path) if os.path.exists(abs_path) else 0
+    config = {
+        'content_url': f"/edit/{sid}/content",
+        'windowed': file_size > EDITOR_WINDOW_THRESHOLD,
+        'window_lines': EDITOR_WINDOW_LINES,
+        'versions_url': f"/edit/{sid}/versions",
+    }
 
     return render_template_string("""
 <!DOCTYPE html>
@@ -1415,17 +4999,32 @@ def edit(sid):
     <span><i class="fas fa-code-branch"></i> Session: {{ sid[:8] }}</span>
     <span><i class="far fa-clock"></i> {{ timestamp }}</span>
     <span><i class="fas fa-hdd"></i> {{ file_size }}</span>
+    <span id="versionPicker" style="display: none;" title="Load an earlier version into the editor; save to restore it">
+        <i class="fas fa-history"></i>
+        <select id="versionSelect" onchange="loadVersion(this.value)" style="background: var(--bg-dark); color: var(--text); border: 1px solid var(--border); border-radius: 4px; font-size: 12px;"></select>
+    </span>
 </div>
 
-<div id="editor">{{ code }}</div>
+<div id="editor"></div>
 
 <form id="saveForm" method="post">
     <input type="hidden" name="code" id="hiddenCode">
     <div class="footer">
+        <div id="windowNav" style="display: none; gap: 12px; align-items: center; margin-right: auto;">
+            <span id="windowInfo" style="font-size: 12px; color: #8b949e;"><i class="fas fa-lock"></i> Read-only</span>
+            <button type="button" id="prevWindow" onclick="loadWindow(windowStart - config.window_lines)" class="btn btn-cancel">
+                <i class="fas fa-chevron-up"></i> Prev
+            </button>
+            <button type="button" id="nextWindow" onclick="loadWindow(windowStart + config.window_lines)" class="btn btn-cancel">
+                <i class="fas fa-chevron-down"></i> Next
+            </button>
+            <input type="number" id="gotoLine" min="1" placeholder="Line" style="width: 90px; padding: 6px; background: var(--bg-dark); color: var(--text); border: 1px solid var(--border); border-radius: 6px;"
+                   onkeydown="if (event.key === 'Enter') { event.preventDefault(); loadWindow(parseInt(this.value || '1', 10) - 1); }">
+        </div>
         <button type="button" onclick="window.close()" class="btn btn-cancel">
             <i class="fas fa-times"></i> Cancel
         </button>
-        <button type="button" onclick="saveData()" class="btn btn-save">
+        <button type="button" onclick="saveData()" class="btn btn-save" disabled>
             <i class="fas fa-save"></i> Save Changes
         </button>
     </div>
@@ -1478,13 +5077,139 @@ def edit(sid):
         useSoftTabs: true
     });
 
+    // Content is fetched separately so the page stays small; big files are paged read-only
+    var config = {{ config|tojson }};
+    var windowStart = 0;
+
+    function loadWindow(start) {
+        start = Math.max(0, start || 0);
+        fetch(config.content_url + '?start=' + start + '&lines=' + config.window_lines)
+            .then(function(response) { return response.json(); })
+            .then(function(data) {
+                windowStart = data.start;
+                editor.session.setOption('firstLineNumber', data.start + 1);
+                editor.setValue(data.text, -1);
+                document.getElementById('windowInfo').innerHTML = '<i class="fas fa-lock"></i> Read-only, lines ' +
+                    (data.start + 1) + '-' + (data.start + data.lines) + (data.eof ? ' (end)' : '');
+                document.getElementById('prevWindow').disabled = data.start === 0;
+                document.getElementById('nextWindow').disabled = data.eof;
+            });
+    }
+
+    // Saves send only the changed line range, checked against the version that was loaded
+    var baseText = null;
+    var baseEtag = null;
+
+    if (config.windowed) {
+        editor.setReadOnly(true);
+        document.querySelector('.btn-save').style.display = 'none';
+        document.getElementById('windowNav').style.display = 'flex';
+        loadWindow(0);
+    } else {
+        fetch(config.content_url)
+            .then(function(response) {
+                baseEtag = response.headers.get('ETag');
+                return response.text();
+            })
+            .then(function(text) {
+                baseText = text;
+                editor.setValue(text, -1);
+                document.querySelector('.btn-save').disabled = false;
+                loadVersions();
+            });
+    }
+
+    // Earlier versions are loaded as unsaved changes, so restoring one is an ordinary save
+    function loadVersions() {
+        fetch(config.versions_url)
+            .then(function(response) { return response.json(); })
+            .then(function(data) {
+                var select = document.getElementById('versionSelect');
+                select.innerHTML = '<option value="">Current version</option>';
+                (data.versions || []).forEach(function(version) {
+                    var option = document.createElement('option');
+                    option.value = version.n;
+                    option.textContent = '#' + version.n + ' ' + new Date(version.time * 1000).toLocaleString() +
+                        ' (' + version.size + ' bytes' + (version.external ? ', changed outside the editor' : '') + ')';
+                    select.appendChild(option);
+                });
+                document.getElementById('versionPicker').style.display = data.versions && data.versions.length ? '' : 'none';
+            });
+    }
+
+    function loadVersion(n) {
+        if (!n) {
+            editor.setValue(baseText, -1);
+            return;
+        }
+        fetch(config.versions_url + '/' + n)
+            .then(function(response) {
+                if (!response.ok) {
+                    return response.json().then(function(data) { throw data.error; });
+                }
+                return response.text();
+            })
+            .then(function(text) { editor.setValue(text, -1); })
+            .catch(function(error) { alert('Error loading version: ' + error); });
+    }
+
+    function buildEdit(oldText, newText) {
+        // Replace the lines between the common prefix and the common suffix
+        var oldLines = oldText.split('\n'), newLines = newText.split('\n');
+        var prefix = 0, suffix = 0;
+        var limit = Math.min(oldLines.length, newLines.length) - 1;
+        while (prefix < limit && oldLines[prefix] === newLines[prefix]) {
+            prefix++;
+        }
+        while (suffix < Math.min(oldLines.length, newLines.length) - prefix &&
+               oldLines[oldLines.length - 1 - suffix] === newLines[newLines.length - 1 - suffix]) {
+            suffix++;
+        }
+        var middle = newLines.slice(prefix, newLines.length - suffix);
+        var text = middle.join('\n') + (suffix > 0 && middle.length ? '\n' : '');
+        return {start: prefix, end: oldLines.length - suffix, text: text};
+    }
+
     function saveData() {
         var saveBtn = document.querySelector('.btn-save');
+        if (config.windowed || saveBtn.disabled) {
+            return;
+        }
+        var text = editor.getValue();
+        if (text === baseText) {
+            return;
+        }
         saveBtn.innerHTML = '<i class="fas fa-spinner fa-spin"></i> Saving...';
         saveBtn.disabled = true;
-        
-        document.getElementById('hiddenCode').value = editor.getValue();
-        document.getElementById('saveForm').submit();
+
+        fetch(config.content_url, {
+            method: 'PATCH',
+            headers: {'Content-Type': 'application/json', 'If-Match': baseEtag},
+            body: JSON.stringify({edits: [buildEdit(baseText, text)]})
+        })
+            .then(function(response) {
+                return response.json().then(function(data) { return {status: response.status, data: data}; });
+            })
+            .then(function(result) {
+                saveBtn.disabled = false;
+                if (result.status === 200) {
+                    baseText = text;
+                    baseEtag = '"' + result.data.etag + '"';
+                    loadVersions();
+                    saveBtn.innerHTML = '<i class="fas fa-check"></i> Saved';
+                    setTimeout(function() { saveBtn.innerHTML = '<i class="fas fa-save"></i> Save Changes'; }, 1500);
+                } else {
+                    saveBtn.innerHTML = '<i class="fas fa-save"></i> Save Changes';
+                    alert(result.status === 409
+                        ? 'The file changed on disk since it was opened. Reload the page to get the latest version.'
+                        : 'Error saving file: ' + result.data.error);
+                }
+            })
+            .catch(function(error) {
+                saveBtn.disabled = false;
+                saveBtn.innerHTML = '<i class="fas fa-save"></i> Save Changes';
+                alert('Error saving file: ' + error);
+            });
     }
 
     // Auto-save indicator
@@ -1510,15 +5235,11 @@ def edit(sid):
 
 </body>
 </html>
-""", code=code, file=file, filename=filename, sid=sid, 
+""", config=config, file=file, filename=filename, sid=sid, 
            timestamp=datetime.now().strftime("%H:%M:%S"),
-           file_size=f"{os.path.getsize(abs_path)} bytes")
+           file_size=f"{file_size} bytes")
 
-@app.route('/')
-def home():
-    stats = get_system_stats()
-    
-    return f"""
+HOME_PAGE = """
 <!DOCTYPE html>
 <html lang="en">
 <head>
@@ -1527,13 +5248,13 @@ def home():
     <title>THARMUX BOT | System Monitor</title>
     <link rel="stylesheet" href="https://cdnjs.cloudflare.com/ajax/libs/font-awesome/6.4.0/css/all.min.css">
     <style>
-        * {{
+        * {
             margin: 0;
             padding: 0;
             box-sizing: border-box;
-        }}
+        }
         
-        body {{ 
+        body { 
             background: #0a0c0f; 
             min-height: 100vh; 
             display: flex; 
@@ -1542,40 +5263,40 @@ def home():
             font-family: 'Segoe UI', system-ui, -apple-system, sans-serif;
             position: relative;
             overflow-x: hidden;
-        }}
+        }
 
-        .particles {{
+        .particles {
             position: absolute;
             width: 100%;
             height: 100%;
             background: radial-gradient(circle at 20% 50%, rgba(0, 212, 255, 0.05) 0%, transparent 50%),
                         radial-gradient(circle at 80% 80%, rgba(0, 255, 136, 0.05) 0%, transparent 50%);
             z-index: 1;
-        }}
+        }
 
-        .container {{
+        .container {
             position: relative;
             z-index: 10;
             max-width: 800px;
             width: 90%;
             padding: 30px;
-        }}
+        }
 
-        .status-card {{
+        .status-card {
             background: rgba(22, 27, 34, 0.95);
             backdrop-filter: blur(10px);
             border-radius: 30px;
             padding: 40px;
             box-shadow: 0 20px 40px rgba(0,0,0,0.5);
             border: 1px solid rgba(255,255,255,0.05);
-        }}
+        }
 
-        .header {{
+        .header {
             text-align: center;
             margin-bottom: 40px;
-        }}
+        }
 
-        .bot-icon {{
+        .bot-icon {
             width: 100px;
             height: 100px;
             margin: 0 auto 20px;
@@ -1588,22 +5309,22 @@ def home():
             color: white;
             box-shadow: 0 10px 30px rgba(0, 212, 255, 0.3);
             animation: float 3s ease-in-out infinite;
-        }}
+        }
 
-        @keyframes float {{
-            0%, 100% {{ transform: translateY(0px); }}
-            50% {{ transform: translateY(-10px); }}
-        }}
+        @keyframes float {
+            0%, 100% { transform: translateY(0px); }
+            50% { transform: translateY(-10px); }
+        }
 
-        h1 {{
+        h1 {
             color: white;
             font-size: 32px;
             font-weight: 600;
             letter-spacing: 1px;
             margin-bottom: 5px;
-        }}
+        }
 
-        .status-badge {{
+        .status-badge {
             display: inline-block;
             padding: 8px 20px;
             background: rgba(0, 212, 255, 0.1);
@@ -1613,100 +5334,100 @@ def home():
             font-size: 14px;
             font-weight: 500;
             margin-top: 10px;
-        }}
+        }
 
-        .stats-grid {{
+        .stats-grid {
             display: grid;
             grid-template-columns: repeat(3, 1fr);
             gap: 20px;
             margin: 40px 0;
-        }}
+        }
 
-        .stat-item {{
+        .stat-item {
             background: rgba(255,255,255,0.03);
             border-radius: 20px;
             padding: 25px 20px;
             text-align: center;
             border: 1px solid rgba(255,255,255,0.05);
             transition: 0.3s;
-        }}
+        }
 
-        .stat-item:hover {{
+        .stat-item:hover {
             transform: translateY(-5px);
             background: rgba(255,255,255,0.05);
             border-color: rgba(0, 212, 255, 0.2);
-        }}
+        }
 
-        .stat-icon {{
+        .stat-icon {
             font-size: 30px;
             color: #00d4ff;
             margin-bottom: 15px;
-        }}
+        }
 
-        .stat-label {{
+        .stat-label {
             color: #8b949e;
             font-size: 14px;
             margin-bottom: 10px;
             text-transform: uppercase;
             letter-spacing: 1px;
-        }}
+        }
 
-        .stat-value {{
+        .stat-value {
             color: white;
             font-size: 28px;
             font-weight: 600;
             margin-bottom: 10px;
-        }}
+        }
 
-        .progress-bar {{
+        .progress-bar {
             width: 100%;
             height: 6px;
             background: rgba(255,255,255,0.1);
             border-radius: 3px;
             overflow: hidden;
             margin-top: 10px;
-        }}
+        }
 
-        .progress-fill {{
+        .progress-fill {
             height: 100%;
             border-radius: 3px;
             transition: width 0.3s;
-        }}
+        }
 
-        .progress-fill.cpu {{ background: linear-gradient(90deg, #00d4ff, #0066ff); }}
-        .progress-fill.memory {{ background: linear-gradient(90deg, #00ff88, #00cc66); }}
-        .progress-fill.disk {{ background: linear-gradient(90deg, #ff6b6b, #ff4757); }}
+        .progress-fill.cpu { background: linear-gradient(90deg, #00d4ff, #0066ff); }
+        .progress-fill.memory { background: linear-gradient(90deg, #00ff88, #00cc66); }
+        .progress-fill.disk { background: linear-gradient(90deg, #ff6b6b, #ff4757); }
 
-        .info-grid {{
+        .info-grid {
             display: grid;
             grid-template-columns: repeat(2, 1fr);
             gap: 15px;
             margin: 30px 0;
-        }}
+        }
 
-        .info-item {{
+        .info-item {
             padding: 15px;
             background: rgba(255,255,255,0.02);
             border-radius: 15px;
             border: 1px solid rgba(255,255,255,0.05);
-        }}
+        }
 
-        .info-label {{
+        .info-label {
             color: #8b949e;
             font-size: 13px;
             margin-bottom: 5px;
             display: flex;
             align-items: center;
             gap: 8px;
-        }}
+        }
 
-        .info-value {{
+        .info-value {
             color: white;
             font-size: 16px;
             font-weight: 500;
-        }}
+        }
 
-        .btn-telegram {{
+        .btn-telegram {
             display: inline-flex;
             align-items: center;
             justify-content: center;
@@ -1723,24 +5444,24 @@ def home():
             width: 100%;
             margin-top: 30px;
             box-shadow: 0 10px 20px rgba(0, 212, 255, 0.2);
-        }}
+        }
 
-        .btn-telegram:hover {{
+        .btn-telegram:hover {
             transform: translateY(-2px);
             box-shadow: 0 15px 30px rgba(0, 212, 255, 0.3);
-        }}
+        }
 
-        .footer {{
+        .footer {
             margin-top: 30px;
             text-align: center;
             color: #484f58;
             font-size: 13px;
-        }}
+        }
 
-        .footer a {{
+        .footer a {
             color: #00d4ff;
             text-decoration: none;
-        }}
+        }
     </style>
 </head>
 <body>
@@ -1765,9 +5486,9 @@ def home():
                         <i class="fas fa-microchip"></i>
                     </div>
                     <div class="stat-label">CPU</div>
-                    <div class="stat-value">{stats['cpu']:.1f}%</div>
+                    <div class="stat-value" id="cpu">–</div>
                     <div class="progress-bar">
-                        <div class="progress-fill cpu" style="width: {stats['cpu']}%"></div>
+                        <div class="progress-fill cpu" id="cpu-bar" style="width: 0%"></div>
                     </div>
                 </div>
 
@@ -1776,9 +5497,9 @@ def home():
                         <i class="fas fa-memory"></i>
                     </div>
                     <div class="stat-label">MEMORY</div>
-                    <div class="stat-value">{stats['memory']:.1f}%</div>
+                    <div class="stat-value" id="memory">–</div>
                     <div class="progress-bar">
-                        <div class="progress-fill memory" style="width: {stats['memory']}%"></div>
+                        <div class="progress-fill memory" id="memory-bar" style="width: 0%"></div>
                     </div>
                 </div>
 
@@ -1787,9 +5508,9 @@ def home():
                         <i class="fas fa-hdd"></i>
                     </div>
                     <div class="stat-label">DISK</div>
-                    <div class="stat-value">{stats['disk']:.1f}%</div>
+                    <div class="stat-value" id="disk">–</div>
                     <div class="progress-bar">
-                        <div class="progress-fill disk" style="width: {stats['disk']}%"></div>
+                        <div class="progress-fill disk" id="disk-bar" style="width: 0%"></div>
                     </div>
                 </div>
             </div>
@@ -1800,28 +5521,28 @@ def home():
                         <i class="fas fa-clock" style="color: #00d4ff;"></i>
                         Uptime
                     </div>
-                    <div class="info-value">{stats['uptime']}</div>
+                    <div class="info-value" id="uptime">–</div>
                 </div>
                 <div class="info-item">
                     <div class="info-label">
                         <i class="fas fa-tasks" style="color: #00ff88;"></i>
                         Processes
                     </div>
-                    <div class="info-value">{stats['processes']}</div>
+                    <div class="info-value" id="processes">–</div>
                 </div>
                 <div class="info-item">
                     <div class="info-label">
                         <i class="fas fa-users" style="color: #ff6b6b;"></i>
                         Active Users
                     </div>
-                    <div class="info-value">{len(set(active_sessions.keys()) | set(processes.keys()))}</div>
+                    <div class="info-value" id="active_users">–</div>
                 </div>
                 <div class="info-item">
                     <div class="info-label">
                         <i class="fas fa-code-branch" style="color: #ffd700;"></i>
                         Sessions
                     </div>
-                    <div class="info-value">{sum(len(sess) for sess in active_sessions.values())}</div>
+                    <div class="info-value" id="sessions">–</div>
                 </div>
             </div>
 
@@ -1839,9 +5560,50 @@ def home():
             </div>
         </div>
     </div>
+    <script>
+        // Live stats pushed by /api/stats/stream; each event carries only the changed fields
+        const percent = ['cpu', 'memory', 'disk'];
+        const source = new EventSource('/api/stats/stream');
+        const badge = document.querySelector('.status-badge');
+
+        source.onmessage = (event) => {
+            const changes = JSON.parse(event.data);
+            for (const [key, value] of Object.entries(changes)) {
+                const el = document.getElementById(key);
+                if (!el) continue;
+                if (percent.includes(key)) {
+                    el.textContent = value.toFixed(1) + '%';
+                    document.getElementById(key + '-bar').style.width = Math.min(value, 100) + '%';
+                } else {
+                    el.textContent = value;
+                }
+            }
+            badge.style.opacity = 1;
+        };
+        source.onerror = () => { badge.style.opacity = 0.5; };
+    </script>
 </body>
 </html>
 """
+HOME_PAGE_ETAG = hashlib.sha1(HOME_PAGE.encode()).hexdigest()
+
+@app.route('/')
+def home():
+    """Static dashboard shell; live numbers arrive over /api/stats/stream"""
+    response = app.response_class(HOME_PAGE, mimetype='text/html')
+    response.set_etag(HOME_PAGE_ETAG)
+    response.cache_control.public = True
+    response.cache_control.max_age = 3600
+    return response.make_conditional(request)
+
+@app.route('/api/stats/stream')
+def api_stats_stream():
+    """Server-Sent Events feed of dashboard stats"""
+    return app.response_class(
+        stats_stream.stream(),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
 
 @app.route('/health')
 def health():
@@ -1864,6 +5626,86 @@ def api_stats():
     })
     return jsonify(stats)
 
+def api_admin_authorized():
+    """True if the request carries ADMIN_API_TOKEN as a bearer token or ?token="""
+    if not ADMIN_API_TOKEN:
+        return False
+    header = request.headers.get('Authorization', '')
+    token = header[7:] if header.startswith("Bearer ") else request.args.get('token', '')
+    return hmac.compare_digest(token.encode(), ADMIN_API_TOKEN.encode())
+
+@app.route('/metrics')
+def metrics():
+    """Prometheus scrape endpoint, admin only (series carry Telegram user IDs)"""
+    if not api_admin_authorized():
+        return jsonify({'error': "admin token required"}), 403
+    return render_metrics(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+@app.route('/api/processes')
+def api_processes():
+    """Top processes by CPU or RSS from the process tracker, admin only"""
+    if not api_admin_authorized():
+        return jsonify({'error': "admin token required"}), 403
+    key = request.args.get('sort', 'cpu')
+    if key not in ('cpu', 'rss'):
+        return jsonify({'error': "invalid sort, expected cpu or rss"}), 400
+    try:
+        limit = int(request.args.get('limit', 10))
+    except ValueError:
+        return jsonify({'error': "invalid limit"}), 400
+    if limit < 1:
+        return jsonify({'error': "limit must be positive"}), 400
+    limit = min(limit, TOP_PROCESSES)
+
+    top = process_tracker.latest()
+    return jsonify({
+        'timestamp': top['timestamp'],
+        'count': top['count'],
+        'sort': key,
+        'processes': top[key][:limit]
+    })
+
+@app.route('/debug/profile')
+def debug_profile():
+    """Collapsed-stack profile of all threads, admin only"""
+    if not api_admin_authorized():
+        return jsonify({'error': "admin token required"}), 403
+    try:
+        seconds = float(request.args.get('seconds', 10))
+        rate = int(request.args.get('rate', PROFILE_RATE))
+    except ValueError:
+        return jsonify({'error': "invalid seconds or rate"}), 400
+    if not 0 < seconds <= PROFILE_MAX_SECONDS or not 0 < rate <= 1000:
+        return jsonify({'error': f"seconds must be in (0, {PROFILE_MAX_SECONDS}] and rate in (0, 1000]"}), 400
+
+    result = profiler.profile(seconds, rate)
+    if result is None:
+        return jsonify({'error': "a profile is already running"}), 409
+    samples, stacks = result
+    return stacks, 200, {'Content-Type': 'text/plain; charset=utf-8', 'X-Profile-Samples': str(samples)}
+
+@app.route('/api/stats/history')
+def api_stats_history():
+    """Min/avg/max history for one metric"""
+    metric = request.args.get('metric', 'cpu')
+    if metric not in HISTORY_METRICS:
+        return jsonify({'error': f"unknown metric, expected one of {', '.join(HISTORY_METRICS)}"}), 400
+    try:
+        seconds = parse_duration(request.args.get('range', '1h'))
+    except (ValueError, OverflowError):
+        return jsonify({'error': "invalid range, expected e.g. 300, 15m, 6h or 7d"}), 400
+    if seconds <= 0:
+        return jsonify({'error': "range must be positive"}), 400
+
+    step, points = metrics_history.query(metric, seconds)
+    return jsonify({
+        'metric': metric,
+        'range': seconds,
+        'resolution': step,
+        'fields': ['timestamp', 'min', 'avg', 'max'],
+        'points': points
+    })
+
 # ========== MAIN ==========
 if __name__ == "__main__":
     print("🤖 Starting Termux Bot Pro v5.0...")
@@ -1883,6 +5725,20 @@ if __name__ == "__main__":
 
     # Load saved data
     load_data()
+    instrument_handlers()
+    reaper.install()
+    system_sampler.start()
+    process_tracker.start()
+    atexit.register(flush_data)
+
+    def shutdown(signum, frame):
+        print(f"\n👋 Received signal {signum}, shutting down...")
+        flush_data()
+        logger.info("Bot shutdown complete")
+        sys.exit(0)
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGHUP, shutdown)
 
     # ========== FLASK SERVER ==========
     def run_flask():
@@ -1917,8 +5773,8 @@ if __name__ == "__main__":
                 time.sleep(5)
 
     # ========== START THREADS ==========
-    flask_thread = threading.Thread(target=run_flask, daemon=True)
-    bot_thread = threading.Thread(target=run_bot, daemon=True)
+    flask_thread = threading.Thread(target=run_flask, name="flask", daemon=True)
+    bot_thread = threading.Thread(target=run_bot, name="poller", daemon=True)
 
     flask_thread.start()
     bot_thread.start()
@@ -1943,14 +5799,7 @@ if __name__ == "__main__":
                 f"Disk: {stats['disk']:.1f}%"
             )
 
-            if stats['cpu'] > 80:
-                add_system_alert("WARNING", f"High CPU usage: {stats['cpu']:.1f}%")
-            if stats['memory'] > 80:
-                add_system_alert("WARNING", f"High memory usage: {stats['memory']:.1f}%")
-            if stats['disk'] > 90:
-                add_system_alert("WARNING", f"Low disk space: {stats['disk']:.1f}%")
-
     except KeyboardInterrupt:
         print("\n👋 Shutting down gracefully...")
-        save_data()
+        flush_data()
         logger.info("Bot shutdown complete")